@@ -0,0 +1,130 @@
+"""
+Compares the cost of describing EC2 instances with full descriptions filtered
+on the client against descriptions filtered by state on the server side and
+projected to slim records, on large synthetic DescribeInstances pages parsed
+by botocore.
+
+Run it with: python3 -m benchmarks.describe [--instances N] [--terminated-ratio R]
+"""
+import argparse
+import time
+import tracemalloc
+import botocore.parsers
+import botocore.session
+from cloudunmap.aws import slimEC2Instance
+from cloudunmap.unmap import indexRunningInstances, isRunningEC2Instance
+
+PAGE_SIZE = 1000
+
+
+def buildInstanceXml(index: int, state: str) -> str:
+    privateIp = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+    secondaryIp = f"10.{(index >> 16 & 255) + 100}.{index >> 8 & 255}.{index & 255}"
+
+    return f"""<item>
+  <instanceId>i-{index:017x}</instanceId><imageId>ami-0123456789abcdef0</imageId>
+  <instanceState><code>16</code><name>{state}</name></instanceState>
+  <privateDnsName>ip-{privateIp.replace(".", "-")}.ec2.internal</privateDnsName><dnsName/>
+  <keyName>deploy</keyName><amiLaunchIndex>0</amiLaunchIndex><instanceType>c6i.xlarge</instanceType>
+  <launchTime>2023-10-01T10:00:00.000Z</launchTime>
+  <placement><availabilityZone>us-east-1a</availabilityZone><groupName/><tenancy>default</tenancy></placement>
+  <monitoring><state>disabled</state></monitoring>
+  <subnetId>subnet-0123456789abcdef0</subnetId><vpcId>vpc-0123456789abcdef0</vpcId>
+  <privateIpAddress>{privateIp}</privateIpAddress>
+  <groupSet><item><groupId>sg-0123456789abcdef0</groupId><groupName>web</groupName></item></groupSet>
+  <architecture>x86_64</architecture><rootDeviceType>ebs</rootDeviceType><rootDeviceName>/dev/xvda</rootDeviceName>
+  <blockDeviceMapping>
+    <item><deviceName>/dev/xvda</deviceName><ebs><volumeId>vol-0123456789abcdef0</volumeId><status>attached</status><attachTime>2023-10-01T10:00:01.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></ebs></item>
+    <item><deviceName>/dev/xvdb</deviceName><ebs><volumeId>vol-0123456789abcdef1</volumeId><status>attached</status><attachTime>2023-10-01T10:00:01.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></ebs></item>
+  </blockDeviceMapping>
+  <virtualizationType>hvm</virtualizationType>
+  <tagSet>
+    <item><key>Name</key><value>web-{index}</value></item>
+    <item><key>aws:autoscaling:groupName</key><value>web-asg</value></item>
+    <item><key>team</key><value>platform</value></item>
+  </tagSet>
+  <networkInterfaceSet><item>
+    <networkInterfaceId>eni-{index:017x}</networkInterfaceId><subnetId>subnet-0123456789abcdef0</subnetId><vpcId>vpc-0123456789abcdef0</vpcId>
+    <status>in-use</status><macAddress>0e:00:00:00:00:00</macAddress><privateIpAddress>{privateIp}</privateIpAddress><sourceDestCheck>true</sourceDestCheck>
+    <groupSet><item><groupId>sg-0123456789abcdef0</groupId><groupName>web</groupName></item></groupSet>
+    <attachment><attachmentId>eni-attach-0123456789abcdef0</attachmentId><deviceIndex>0</deviceIndex><status>attached</status><attachTime>2023-10-01T10:00:00.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></attachment>
+    <privateIpAddressesSet>
+      <item><privateIpAddress>{privateIp}</privateIpAddress><primary>true</primary></item>
+      <item><privateIpAddress>{secondaryIp}</privateIpAddress><primary>false</primary></item>
+    </privateIpAddressesSet>
+  </item></networkInterfaceSet>
+</item>"""
+
+
+def buildPageXml(instancesXml: list) -> bytes:
+    return (
+        '<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><requestId>00000000-0000-0000-0000-000000000000</requestId>'
+        '<reservationSet><item><reservationId>r-0123456789abcdef0</reservationId><ownerId>123456789012</ownerId><groupSet/>'
+        f'<instancesSet>{"".join(instancesXml)}</instancesSet></item></reservationSet></DescribeInstancesResponse>').encode()
+
+
+def buildPages(instancesCount: int, terminatedRatio: float, filterByState: bool) -> list:
+    terminatedEvery = round(1 / terminatedRatio) if terminatedRatio > 0 else 0
+    instancesXml = []
+
+    for index in range(instancesCount):
+        state = "terminated" if terminatedEvery and index % terminatedEvery == 0 else "running"
+
+        # EC2 doesn't return the instances not matching the state filter
+        if not filterByState or state == "running":
+            instancesXml.append(buildInstanceXml(index, state))
+
+    return [buildPageXml(instancesXml[i:i + PAGE_SIZE]) for i in range(0, len(instancesXml), PAGE_SIZE)]
+
+
+def parsePages(pages: list):
+    operationModel = botocore.session.get_session().get_service_model("ec2").operation_model("DescribeInstances")
+    parser = botocore.parsers.create_parser("ec2")
+
+    for page in pages:
+        response = parser.parse({"body": page, "headers": {}, "status_code": 200}, operationModel.output_shape)
+
+        for reservation in response["Reservations"]:
+            yield from reservation["Instances"]
+
+
+def runFullPipeline(pages: list):
+    # Full descriptions are retained until filtered and indexed, like when batches are fetched concurrently
+    instances = list(parsePages(pages))
+    return indexRunningInstances(filter(lambda i: i["State"]["Name"] not in ("shutting-down", "terminated"), instances))
+
+
+def runSlimPipeline(pages: list):
+    instances = list(map(slimEC2Instance, parsePages(pages)))
+    return indexRunningInstances(filter(isRunningEC2Instance, instances))
+
+
+def measure(name: str, pipeline, pages: list):
+    startTime = time.perf_counter()
+    cpuStartTime = time.process_time()
+    index = pipeline(pages)
+    elapsedTime = time.perf_counter() - startTime
+    cpuTime = time.process_time() - cpuStartTime
+
+    tracemalloc.start()
+    pipeline(pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<14} pages: {len(pages):4d}   payload: {sum(map(len, pages)) / 1024 / 1024:7.1f} MB   cpu time: {cpuTime:6.2f} sec   wall time: {elapsedTime:6.2f} sec   peak memory: {peak / 1024 / 1024:7.1f} MB   running: {len(index)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", metavar="N", type=int, default=5000, help="Number of described instances")
+    parser.add_argument("--terminated-ratio", metavar="R", type=float, default=0.1, help="Ratio of described instances which are terminated")
+    args = parser.parse_args()
+
+    print(f"Describing {args.instances} EC2 instances, {args.terminated_ratio:.0%} of them terminated")
+
+    measure("full", runFullPipeline, buildPages(args.instances, args.terminated_ratio, filterByState=False))
+    measure("filtered+slim", runSlimPipeline, buildPages(args.instances, args.terminated_ratio, filterByState=True))
+
+
+if __name__ == "__main__":
+    main()
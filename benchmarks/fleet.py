@@ -0,0 +1,26 @@
+from typing import List
+from tests.mocks import MockClientPool, MockEC2Client, MockServiceDiscoveryClient
+
+REGIONS = ["eu-west-1", "us-east-1", "us-west-2"]
+
+
+def buildFleet(instancesCount: int, regions: List[str] = REGIONS, terminatedRatio: float = 0.01) -> MockClientPool:
+    # Synthetic Cloud Map service and EC2 inventory, with instances spread
+    # across regions and a share of them terminated. The Cloud Map client is
+    # in the first region
+    terminatedEvery = round(1 / terminatedRatio) if terminatedRatio > 0 else 0
+    serviceInstances = []
+    ec2Instances = {region: {} for region in regions}
+
+    for index in range(instancesCount):
+        instanceId = f"i-{index:017x}"
+        privateIp = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+        state = "terminated" if terminatedEvery and index % terminatedEvery == 0 else "running"
+
+        serviceInstances.append((instanceId, privateIp))
+        ec2Instances[regions[index % len(regions)]][instanceId] = (privateIp, None, state)
+
+    clients = {("servicediscovery", regions[0]): MockServiceDiscoveryClient(serviceInstances)}
+    clients.update({("ec2", region): MockEC2Client(ec2Instances[region]) for region in regions})
+
+    return MockClientPool(clients)
@@ -0,0 +1,62 @@
+"""
+Compares the peak memory of the reconcile pipeline against a pipeline
+materializing full lists of API responses (as done before streaming).
+
+Run it with: python3 -m benchmarks.memory [--instances N]
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+from cloudunmap.aws import listEC2InstancesById, listServiceInstances, slimServiceInstance
+from cloudunmap.unmap import indexRunningInstances, matchServiceInstanceInIndex, unmapTerminatedInstancesFromService
+from tests.mocks import MockClientPool
+from .fleet import REGIONS, buildFleet
+
+
+def runMaterializedPipeline(clientPool: MockClientPool):
+    serviceInstances = listServiceInstances("srv-1", clientPool.getClient("servicediscovery", REGIONS[0]))
+    serviceInstances = list(filter(lambda i: "AWS_INSTANCE_IPV4" in i["Attributes"], serviceInstances))
+    serviceInstancesId = list(map(lambda i: i["Id"], serviceInstances))
+
+    runningInstances = []
+
+    for region in REGIONS:
+        instances = listEC2InstancesById(serviceInstancesId, clientPool.getClient("ec2", region))
+        runningInstances += list(filter(lambda i: i["State"]["Name"] not in ("shutting-down", "terminated"), instances))
+
+    runningInstancesIndex = indexRunningInstances(runningInstances)
+    return list(filter(lambda i: not matchServiceInstanceInIndex(slimServiceInstance(i), runningInstancesIndex), serviceInstances))
+
+
+def runStreamingPipeline(clientPool: MockClientPool):
+    return unmapTerminatedInstancesFromService("srv-1", REGIONS[0], REGIONS, clientPool=clientPool)
+
+
+def measure(name: str, pipeline, clientPool: MockClientPool):
+    tracemalloc.start()
+    startTime = time.perf_counter()
+
+    pipeline(clientPool)
+
+    elapsedTime = time.perf_counter() - startTime
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<14} peak memory: {peak / 1024 / 1024:8.1f} MB   wall time: {elapsedTime:6.2f} sec")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", metavar="N", type=int, default=100000, help="Number of registered instances")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    print(f"Reconciling {args.instances} registered instances across {len(REGIONS)} regions")
+
+    measure("materialized", runMaterializedPipeline, buildFleet(args.instances))
+    measure("streaming", runStreamingPipeline, buildFleet(args.instances))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Measures how the reconcile pipeline scales with the fleet size, on synthetic
+Cloud Map and EC2 inventories spread across several regions. For each fleet
+size, it reports the wall time of each reconcile phase, the number of AWS API
+calls and the peak memory of a cold reconcile (regions of instances unknown)
+and a warm one (regions of instances learned by the previous reconcile).
+
+Results can be saved and then compared with a later run, failing if the wall
+time or peak memory grew more than --max-regression, or if more API calls
+are issued.
+
+Run it with: python3 -m benchmarks.reconcile [--sizes N,N,...] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from prometheus_client.registry import REGISTRY
+from cloudunmap.cache import EC2InstanceRegions
+from cloudunmap.metrics import enableMetrics
+from cloudunmap.unmap import unmapTerminatedInstancesFromService
+from .fleet import REGIONS, buildFleet
+
+PHASES = ["list_service_instances", "describe_ec2_instances", "match", "deregister"]
+
+
+def runReconcile(scenario: str, instancesCount: int, traceMemory: bool) -> dict:
+    serviceId = f"bench-{scenario}-{instancesCount}-{'memory' if traceMemory else 'time'}"
+    clientPool = buildFleet(instancesCount)
+    instanceRegions = EC2InstanceRegions()
+
+    # The warm reconcile follows another one, which learns the regions of instances
+    if scenario == "warm":
+        unmapTerminatedInstancesFromService(f"{serviceId}-warmup", REGIONS[0], REGIONS, clientPool=clientPool, instanceRegions=instanceRegions)
+
+    callsBefore = sum((client.calls for client in clientPool.clients.values()), Counter())
+
+    if traceMemory:
+        tracemalloc.start()
+
+    startTime = time.perf_counter()
+    unmapTerminatedInstancesFromService(serviceId, REGIONS[0], REGIONS, clientPool=clientPool, instanceRegions=instanceRegions)
+    elapsedTime = time.perf_counter() - startTime
+
+    if traceMemory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"peak_memory_mb": peak / 1024 / 1024}
+
+    calls = sum((client.calls for client in clientPool.clients.values()), Counter()) - callsBefore
+    phases = {phase: REGISTRY.get_sample_value("aws_cloud_unmap_reconcile_phase_duration_seconds_sum", {"service_id": serviceId, "phase": phase}) or 0 for phase in PHASES}
+
+    return {"wall_time_seconds": elapsedTime, "phases_seconds": phases, "api_calls": dict(sorted(calls.items()))}
+
+
+def runBenchmarks(sizes: list) -> dict:
+    results = {}
+
+    for instancesCount in sizes:
+        for scenario in ["cold", "warm"]:
+            # Memory is traced in a separate run, because tracing slows the pipeline down
+            result = runReconcile(scenario, instancesCount, traceMemory=False)
+            result.update(runReconcile(scenario, instancesCount, traceMemory=True))
+            results[f"{scenario}/{instancesCount}"] = result
+
+            phases = "  ".join(f"{phase}: {seconds:6.3f}s" for phase, seconds in result["phases_seconds"].items())
+            calls = ", ".join(f"{operation}: {count}" for operation, count in result["api_calls"].items())
+            print(f"{scenario:<5} {instancesCount:>7} instances   wall time: {result['wall_time_seconds']:7.3f}s   peak memory: {result['peak_memory_mb']:7.1f} MB")
+            print(f"      phases: {phases}")
+            print(f"      API calls: {calls}")
+
+    return results
+
+
+def compareResults(results: dict, baseline: dict, maxRegression: float) -> list:
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        # Tiny absolute differences are noise, regardless of the ratio
+        for metric, minDelta in [("wall_time_seconds", 0.01), ("peak_memory_mb", 0.5)]:
+            if result[metric] > baseline[name][metric] * (1 + maxRegression) and result[metric] - baseline[name][metric] > minDelta:
+                regressions.append(f"{name} {metric}: {baseline[name][metric]:.3f} -> {result[metric]:.3f}")
+
+        for operation, count in result["api_calls"].items():
+            if count > baseline[name]["api_calls"].get(operation, 0):
+                regressions.append(f"{name} {operation} API calls: {baseline[name]['api_calls'].get(operation, 0)} -> {count}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", metavar="N,N,...", default="1000,10000,100000", help="Comma separated fleet sizes (number of registered instances)")
+    parser.add_argument("--output", metavar="FILE", help="Save results to a JSON file")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare results with the ones previously saved to a JSON file")
+    parser.add_argument("--max-regression", metavar="RATIO", type=float, default=0.2, help="Maximum accepted growth of wall time and peak memory compared to the baseline")
+    args = parser.parse_args()
+
+    # Phase durations are read from the metrics
+    enableMetrics()
+
+    logging.disable(logging.CRITICAL)
+    print(f"Reconciling across {len(REGIONS)} regions on Python {platform.python_version()}")
+
+    results = runBenchmarks([int(size) for size in args.sizes.split(",")])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"python": platform.python_version(), "results": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compareResults(results, json.load(file)["results"], args.max_regression)
+
+        for regression in regressions:
+            print(f"Regression: {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+        print("No regressions compared to the baseline")
+
+
+if __name__ == "__main__":
+    main()
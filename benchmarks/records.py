@@ -0,0 +1,104 @@
+"""
+Compares the representations of service and EC2 instances held by the
+reconcile pipeline: the raw dicts returned by boto, the slim dicts used
+before and the compact __slots__ records. For each one, it reports the memory
+retained by the instances, the time taken by a full garbage collection while
+they're alive, and the time taken to index and match them.
+
+Run it with: python3 -m benchmarks.records [--instances N]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from cloudunmap.aws import getEC2InstanceIps, slimEC2Instance, slimServiceInstance
+from cloudunmap.unmap import indexRunningInstances, matchServiceInstanceInIndex
+
+
+def buildRawInstances(instancesCount: int) -> tuple:
+    # Service and EC2 instances shaped like the ones parsed by boto, with the
+    # fields commonly returned by Cloud Map and EC2
+    serviceInstances = []
+    ec2Instances = []
+
+    for index in range(instancesCount):
+        instanceId = f"i-{index:017x}"
+        privateIp = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+        serviceInstances.append({"Id": instanceId, "Attributes": {"AWS_INSTANCE_IPV4": privateIp, "AWS_INSTANCE_PORT": "80", "AVAILABILITY_ZONE": "eu-west-1a", "REGION": "eu-west-1"}})
+        ec2Instances.append({
+            "AmiLaunchIndex": 0, "ImageId": "ami-0123456789abcdef0", "InstanceId": instanceId, "InstanceType": "m5.large", "KeyName": "default",
+            "Monitoring": {"State": "disabled"}, "Placement": {"AvailabilityZone": "eu-west-1a", "GroupName": "", "Tenancy": "default"},
+            "PrivateDnsName": f"ip-{privateIp.replace('.', '-')}.eu-west-1.compute.internal", "PrivateIpAddress": privateIp, "ProductCodes": [],
+            "PublicDnsName": "", "State": {"Code": 16, "Name": "running"}, "StateTransitionReason": "", "SubnetId": "subnet-0123456789abcdef0",
+            "VpcId": "vpc-0123456789abcdef0", "Architecture": "x86_64",
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"DeleteOnTermination": True, "Status": "attached", "VolumeId": "vol-0123456789abcdef0"}}],
+            "EbsOptimized": True, "Hypervisor": "xen", "RootDeviceName": "/dev/xvda", "RootDeviceType": "ebs", "SourceDestCheck": True,
+            "NetworkInterfaces": [{"NetworkInterfaceId": "eni-0123456789abcdef0", "PrivateIpAddress": privateIp, "PrivateIpAddresses": [{"Primary": True, "PrivateIpAddress": privateIp}], "Status": "in-use"}],
+            "SecurityGroups": [{"GroupName": "default", "GroupId": "sg-0123456789abcdef0"}], "Tags": [{"Key": "Name", "Value": f"web-{index}"}],
+            "VirtualizationType": "hvm", "CpuOptions": {"CoreCount": 1, "ThreadsPerCore": 2}})
+
+    return serviceInstances, ec2Instances
+
+
+def slimDictServiceInstance(serviceInstance: dict) -> dict:
+    return {"Id": serviceInstance["Id"], "Attributes": {"AWS_INSTANCE_IPV4": serviceInstance["Attributes"]["AWS_INSTANCE_IPV4"]}}
+
+
+def slimDictEC2Instance(instance: dict) -> dict:
+    return {"InstanceId": instance["InstanceId"], "State": {"Name": instance["State"]["Name"]}, "IpAddresses": getEC2InstanceIps(instance)}
+
+
+def measure(name: str, build, match):
+    gc.collect()
+    tracemalloc.start()
+    serviceInstances, ec2Instances = build()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    startTime = time.perf_counter()
+    gc.collect()
+    gcTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    unmatched = match(serviceInstances, ec2Instances)
+    matchTime = time.perf_counter() - startTime
+
+    print(f"{name:<12} retained memory: {retained / 1024 / 1024:8.1f} MB   full gc: {gcTime * 1000:7.1f} ms   index and match: {matchTime:6.3f} sec   unmatched: {unmatched}")
+
+
+def matchDicts(serviceInstances: list, ec2Instances: list) -> int:
+    # The index is built the same way, while the matching reads dict keys
+    index = {}
+
+    for instance in ec2Instances:
+        index.setdefault(instance["InstanceId"], set()).update(instance["IpAddresses"] if "IpAddresses" in instance else getEC2InstanceIps(instance))
+
+    return sum(1 for i in serviceInstances if i["Attributes"]["AWS_INSTANCE_IPV4"] not in index.get(i["Id"], ()))
+
+
+def matchRecords(serviceInstances: list, ec2Instances: list) -> int:
+    index = indexRunningInstances(ec2Instances)
+    return sum(1 for i in serviceInstances if not matchServiceInstanceInIndex(i, index))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", metavar="N", type=int, default=100000, help="Number of service and EC2 instances")
+    args = parser.parse_args()
+
+    print(f"Holding {args.instances} service instances and {args.instances} EC2 instances")
+
+    # Raw instances are converted to each representation and then released, so
+    # that only the converted ones are retained
+    def _convert(slimServiceInstanceFn, slimEC2InstanceFn):
+        rawServiceInstances, rawEC2Instances = buildRawInstances(args.instances)
+        return list(map(slimServiceInstanceFn, rawServiceInstances)), list(map(slimEC2InstanceFn, rawEC2Instances))
+
+    measure("raw dicts", lambda: buildRawInstances(args.instances), matchDicts)
+    measure("slim dicts", lambda: _convert(slimDictServiceInstance, slimDictEC2Instance), matchDicts)
+    measure("records", lambda: _convert(slimServiceInstance, slimEC2Instance), matchRecords)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Measures the reconcile pipeline on a real fleet, replaying a snapshot recorded
+in production with `aws-cloud-unmap --single-run --record-snapshot FILE`, without any
+network access. It reports the wall time of each reconcile phase, averaged
+over --repeat reconciles of all the services recorded in the snapshot (phases
+are summed over services).
+
+The call pattern of the replayed reconciles must match the recorded one, so
+the snapshot should be recorded by a --single-run reconcile.
+
+Run it with: python3 -m benchmarks.replay SNAPSHOT [--repeat N]
+"""
+import argparse
+import logging
+import time
+from prometheus_client.registry import REGISTRY
+from cloudunmap.clients import AwsClientPool
+from cloudunmap.metrics import enableMetrics
+from cloudunmap.snapshot import SnapshotReplayer
+from cloudunmap.unmap import unmapTerminatedInstancesFromServices
+from .reconcile import PHASES
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("snapshot", metavar="SNAPSHOT", help="Snapshot file recorded with --record-snapshot")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help="Number of reconciles to average")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    # Phase durations are read from the metrics
+    enableMetrics()
+
+    replayer = SnapshotReplayer(args.snapshot)
+    clientPool = AwsClientPool(snapshot=replayer)
+    serviceIds = replayer.serviceIds
+
+    print(f"Replaying {len(serviceIds)} services and EC2 instances in {replayer.instancesRegions}")
+
+    def _phasesSum():
+        return {phase: sum(REGISTRY.get_sample_value("aws_cloud_unmap_reconcile_phase_duration_seconds_sum", {"service_id": serviceId, "phase": phase}) or 0 for serviceId in serviceIds) for phase in PHASES}
+
+    phasesBefore = _phasesSum()
+    startTime = time.perf_counter()
+
+    for _ in range(args.repeat):
+        unmapTerminatedInstancesFromServices(serviceIds, replayer.serviceRegion, replayer.instancesRegions, clientPool=clientPool)
+
+    elapsedTime = (time.perf_counter() - startTime) / args.repeat
+    phases = "  ".join(f"{phase}: {(seconds - phasesBefore[phase]) / args.repeat:6.3f}s" for phase, seconds in _phasesSum().items())
+
+    print(f"wall time: {elapsedTime:7.3f}s per reconcile")
+    print(f"phases: {phases}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures the cold start of short-lived runs, each one in a fresh Python
+process against a local fake AWS endpoint:
+- the time taken to import the application
+- the time from the process start to the first AWS API call of a --single-run
+- the time taken by a cold and a warm invocation of the Lambda handler
+
+Each measure is the median of --repeat runs.
+
+Run it with: python3 -m benchmarks.startup [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from cloudunmap.fakeaws import FakeAwsFleet, FakeAwsServer
+
+ARGS = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1", "--log-level", "ERROR"]
+
+IMPORT_SCRIPT = """
+import time
+startTime = time.perf_counter()
+import cloudunmap.cli
+print(time.perf_counter() - startTime)
+"""
+
+LAMBDA_SCRIPT = """
+import json, time
+startTime = time.perf_counter()
+from cloudunmap.serverless import handler
+importTime = time.perf_counter()
+handler({}, None)
+coldTime = time.perf_counter()
+handler({}, None)
+print(json.dumps([importTime - startTime, coldTime - importTime, time.perf_counter() - coldTime]))
+"""
+
+
+class FirstCallRecorder:
+    """
+    Records the time of the first Cloud Map call received by the fake endpoint.
+    """
+
+    def __init__(self, fleet: FakeAwsFleet):
+        self._listServiceInstances = fleet.listServiceInstances
+        self._lock = threading.Lock()
+        self.firstCallTime = None
+        fleet.listServiceInstances = self
+
+    def __call__(self, serviceId):
+        with self._lock:
+            if self.firstCallTime is None:
+                self.firstCallTime = time.time()
+
+        return self._listServiceInstances(serviceId)
+
+
+def runPython(args: list, env: dict) -> str:
+    return subprocess.run([sys.executable, *args], env=env, check=True, capture_output=True, text=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help="Number of runs of each measure")
+    args = parser.parse_args()
+
+    fleet = FakeAwsFleet(100, ["eu-west-1"], ["srv-1"])
+    server = FakeAwsServer(("127.0.0.1", 0), fleet)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    env = {**os.environ, "AWS_ACCESS_KEY_ID": "fake", "AWS_SECRET_ACCESS_KEY": "fake", "AWS_DEFAULT_REGION": "eu-west-1"}
+    env["AWS_CLOUD_UNMAP_ARGS"] = " ".join(ARGS + ["--endpoint-url", server.endpointUrl])
+
+    importTimes = []
+    firstCallTimes = []
+    lambdaTimes = []
+
+    for _ in range(args.repeat):
+        importTimes.append(float(runPython(["-c", IMPORT_SCRIPT], env)))
+
+        recorder = FirstCallRecorder(fleet)
+        startTime = time.time()
+        runPython(["-m", "cloudunmap.cli", *ARGS, "--single-run", "--endpoint-url", server.endpointUrl], env)
+        firstCallTimes.append(recorder.firstCallTime - startTime)
+        fleet.listServiceInstances = recorder._listServiceInstances
+
+        lambdaTimes.append(json.loads(runPython(["-c", LAMBDA_SCRIPT], env)))
+
+    server.shutdown()
+
+    print(f"import cloudunmap.cli:                {statistics.median(importTimes) * 1000:7.1f} ms")
+    print(f"process start to first API call:      {statistics.median(firstCallTimes) * 1000:7.1f} ms")
+    print(f"import cloudunmap.serverless:         {statistics.median(t[0] for t in lambdaTimes) * 1000:7.1f} ms")
+    print(f"Lambda handler cold invocation:       {statistics.median(t[1] for t in lambdaTimes) * 1000:7.1f} ms")
+    print(f"Lambda handler warm invocation:       {statistics.median(t[2] for t in lambdaTimes) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
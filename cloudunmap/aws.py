@@ -1,9 +1,133 @@
-from typing import List
+import contextvars
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 
-def listEC2InstancesById(instanceIds: List[str], ec2Client):
-    instances = []
+def inCallerContext(fn: Callable) -> Callable:
+    # Wraps fn to run in a copy of the caller context when called from executor
+    # threads (ie. to be accounted to the profiled phase of the caller)
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
 
+
+def mapConcurrently(fn: Callable, items: Iterable, maxConcurrency: int) -> Iterator:
+    # Like executor.map(), but submitting at most maxConcurrency items ahead of
+    # the consumer, so that results don't pile up in memory
+    with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+        futures = deque()
+        fn = inCallerContext(fn)
+
+        try:
+            for item in items:
+                futures.append(executor.submit(fn, item))
+
+                if len(futures) >= maxConcurrency:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def getEC2InstanceIps(instance: dict) -> List[str]:
+    # All the known IPs of an instance: public, private and the private ones of its network interfaces
+    ips = [instance[key] for key in ("PublicIpAddress", "PrivateIpAddress") if key in instance]
+
+    for networkInterface in instance.get("NetworkInterfaces", []):
+        for privateIpAddress in networkInterface.get("PrivateIpAddresses", []):
+            if "PrivateIpAddress" in privateIpAddress:
+                ips.append(privateIpAddress["PrivateIpAddress"])
+
+    return ips
+
+
+class ServiceInstance:
+    """
+    Compact record of an instance registered to a Cloud Map service, holding
+    only the fields required to match it. ipv4 is None if the instance has been
+    registered without the AWS_INSTANCE_IPV4 attribute.
+    """
+
+    __slots__ = ("instanceId", "ipv4")
+
+    def __init__(self, instanceId: str, ipv4: Optional[str]):
+        self.instanceId = instanceId
+        self.ipv4 = ipv4
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ServiceInstance) and (self.instanceId, self.ipv4) == (other.instanceId, other.ipv4)
+
+    def __repr__(self) -> str:
+        return f"ServiceInstance({self.instanceId!r}, {self.ipv4!r})"
+
+
+class EC2Instance:
+    """
+    Compact record of an EC2 instance, holding only the fields required to
+    match it: its ID, state and all its known IPs.
+    """
+
+    __slots__ = ("instanceId", "state", "ips")
+
+    def __init__(self, instanceId: str, state: str, ips: List[str]):
+        self.instanceId = instanceId
+        self.state = state
+        self.ips = ips
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, EC2Instance) and (self.instanceId, self.state, self.ips) == (other.instanceId, other.state, other.ips)
+
+    def __repr__(self) -> str:
+        return f"EC2Instance({self.instanceId!r}, {self.state!r}, {self.ips!r})"
+
+
+def slimServiceInstance(serviceInstance: dict) -> ServiceInstance:
+    # Keep only the fields required to match the instance
+    return ServiceInstance(serviceInstance["Id"], serviceInstance["Attributes"].get("AWS_INSTANCE_IPV4"))
+
+
+def slimEC2Instance(instance: dict) -> EC2Instance:
+    # Keep only the fields required to match the instance, dropping the rest of
+    # the description (block devices, tags, security groups, ...)
+    return EC2Instance(instance["InstanceId"], instance["State"]["Name"], getEC2InstanceIps(instance))
+
+
+def iterEC2InstancesById(
+        instanceIds: List[str],
+        ec2Client,
+        batchSize: int = 200,
+        maxConcurrency: int = 1,
+        states: Optional[List[str]] = None,
+        slim: bool = False) -> Iterator[dict | EC2Instance]:
+    # Split the (deduplicated) instance IDs into batches, because the number of
+    # values accepted by a single filter is limited
+    instanceIds = list(dict.fromkeys(instanceIds))
+    batches = (instanceIds[i:i + batchSize] for i in range(0, len(instanceIds), batchSize))
+
+    # Fetch batches concurrently, preserving the batches order in the results.
+    # When fetched serially, pages are streamed as soon as they're received
+    if maxConcurrency > 1 and len(instanceIds) > batchSize:
+        batchesInstances = mapConcurrently(lambda batch: list(iterEC2InstancesByIdBatch(batch, ec2Client, states, slim)), batches, maxConcurrency)
+    else:
+        batchesInstances = (iterEC2InstancesByIdBatch(batch, ec2Client, states, slim) for batch in batches)
+
+    # Deduplicate results
+    seenIds = set()
+
+    for batchInstances in batchesInstances:
+        for instance in batchInstances:
+            instanceId = instance.instanceId if slim else instance["InstanceId"]
+
+            if instanceId not in seenIds:
+                seenIds.add(instanceId)
+                yield instance
+
+
+def iterEC2InstancesByIdBatch(instanceIds: List[str], ec2Client, states: Optional[List[str]] = None, slim: bool = False) -> Iterator[dict | EC2Instance]:
     # Create a paginator
     paginator = ec2Client.get_paginator("describe_instances")
 
@@ -11,6 +135,10 @@ def listEC2InstancesById(instanceIds: List[str], ec2Client):
     # an instance ID is missing or invalid
     filters = [{"Name": "instance-id", "Values": instanceIds}]
 
+    # Let EC2 filter instances by state, so that unwanted ones are not even transferred
+    if states:
+        filters.append({"Name": "instance-state-name", "Values": states})
+
     # Pick instances from all pages
     for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": 1000}):
         if "Reservations" not in page:
@@ -18,19 +146,81 @@ def listEC2InstancesById(instanceIds: List[str], ec2Client):
 
         for reservation in page["Reservations"]:
             if "Instances" in reservation:
-                instances.extend(reservation["Instances"])
+                yield from map(slimEC2Instance, reservation["Instances"]) if slim else reservation["Instances"]
 
-    return instances
 
+def listEC2InstancesById(
+        instanceIds: List[str],
+        ec2Client,
+        batchSize: int = 200,
+        maxConcurrency: int = 1,
+        states: Optional[List[str]] = None,
+        slim: bool = False) -> List[dict | EC2Instance]:
+    return list(iterEC2InstancesById(instanceIds, ec2Client, batchSize, maxConcurrency, states, slim))
 
-def listServiceInstances(serviceId: str, sdClient):
-    instances = []
 
+def iterServiceInstances(serviceId: str, sdClient, slim: bool = False) -> Iterator[dict | ServiceInstance]:
     # Create a paginator
     paginator = sdClient.get_paginator("list_instances")
 
-    # Pick instances from all pages
+    # Pick instances from all pages, converting them right away to compact
+    # records if slim, so that pages can be released
     for page in paginator.paginate(ServiceId=serviceId, PaginationConfig={"PageSize": 100}):
-        instances.extend(page["Instances"])
+        yield from map(slimServiceInstance, page["Instances"]) if slim else page["Instances"]
+
+
+def listServiceInstances(serviceId: str, sdClient, slim: bool = False) -> List[dict | ServiceInstance]:
+    return list(iterServiceInstances(serviceId, sdClient, slim))
+
+
+def listNamespaceServiceIds(namespaceId: str, sdClient) -> List[str]:
+    serviceIds = []
+
+    # Create a paginator
+    paginator = sdClient.get_paginator("list_services")
+
+    # Pick services from all pages
+    filters = [{"Name": "NAMESPACE_ID", "Values": [namespaceId], "Condition": "EQ"}]
+
+    for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": 100}):
+        serviceIds.extend(service["Id"] for service in page["Services"])
+
+    return serviceIds
+
+
+def deregisterServiceInstances(serviceId: str, instanceIds: List[str], sdClient, maxConcurrency: int = 1) -> Dict[str, Tuple[Optional[str], Optional[Exception]]]:
+    @inCallerContext
+    def _deregister(instanceId):
+        try:
+            return sdClient.deregister_instance(ServiceId=serviceId, InstanceId=instanceId).get("OperationId"), None
+        except Exception as error:
+            return None, error
+
+    # Deregister instances concurrently. Errors are returned instead of raised,
+    # so that a failing deregistration doesn't prevent the others
+    with ThreadPoolExecutor(max_workers=max(1, min(maxConcurrency, len(instanceIds)))) as executor:
+        return dict(zip(instanceIds, executor.map(_deregister, instanceIds)))
+
+
+def waitServiceOperations(operationIds: List[str], sdClient, timeout: float, interval: float = 1, maxConcurrency: int = 1) -> Dict[str, str]:
+    statuses = {operationId: "SUBMITTED" for operationId in operationIds}
+    deadline = time.monotonic() + timeout
+
+    @inCallerContext
+    def _getStatus(operationId):
+        return sdClient.get_operation(OperationId=operationId)["Operation"]["Status"]
+
+    # Poll all the pending operations until they're completed or the timeout expires
+    pendingIds = list(operationIds)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(maxConcurrency, len(operationIds)))) as executor:
+        while pendingIds:
+            statuses.update(zip(pendingIds, executor.map(_getStatus, pendingIds)))
+            pendingIds = [operationId for operationId in pendingIds if statuses[operationId] not in ("SUCCESS", "FAIL")]
+
+            if not pendingIds or time.monotonic() + interval >= deadline:
+                break
+
+            time.sleep(interval)
 
-    return instances
+    return statuses
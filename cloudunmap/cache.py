@@ -0,0 +1,88 @@
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class EC2InstanceCache:
+    """
+    In-memory cache of running EC2 instances IPs, keyed by instance ID (which
+    is unique across regions). Only running instances are cached, so terminated
+    or missing instances are described again on every reconcile.
+    """
+
+    def __init__(self, ttl: float, fullResyncEvery: int = 0):
+        self._ttl = ttl
+        self._fullResyncEvery = fullResyncEvery
+        self._cycles = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def startCycle(self) -> bool:
+        # Force a full resync every N cycles, dropping all the cached instances
+        with self._lock:
+            self._cycles += 1
+
+            if self._fullResyncEvery > 0 and (self._cycles - 1) % self._fullResyncEvery == 0:
+                self._entries.clear()
+                return True
+
+            return False
+
+    def get(self, instanceIds: Iterable[str]) -> Tuple[Dict[str, Set[str]], List[str]]:
+        now = time.monotonic()
+        cachedIndex = {}
+        missingIds = []
+
+        with self._lock:
+            for instanceId in instanceIds:
+                entry = self._entries.get(instanceId)
+
+                if entry and entry[0] > now:
+                    cachedIndex[instanceId] = entry[1]
+                else:
+                    missingIds.append(instanceId)
+
+        return cachedIndex, missingIds
+
+    def put(self, runningInstancesIndex: Dict[str, Set[str]]):
+        expiresAt = time.monotonic() + self._ttl
+
+        with self._lock:
+            for instanceId, ips in runningInstancesIndex.items():
+                self._entries[instanceId] = (expiresAt, ips)
+
+    def invalidate(self, instanceIds: Iterable[str]):
+        with self._lock:
+            for instanceId in instanceIds:
+                self._entries.pop(instanceId, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class EC2InstanceRegions:
+    """
+    In-memory map of the region where each EC2 instance has been found running,
+    keyed by instance ID. Instances never move across regions, so a known
+    instance is described only in its region.
+    """
+
+    def __init__(self):
+        self._regions = {}
+        self._lock = threading.Lock()
+
+    def get(self, instanceId: str) -> Optional[str]:
+        with self._lock:
+            return self._regions.get(instanceId)
+
+    def put(self, instancesRegion: Dict[str, str]):
+        with self._lock:
+            self._regions.update(instancesRegion)
+
+    def forget(self, instanceIds: Iterable[str]):
+        with self._lock:
+            for instanceId in instanceIds:
+                self._regions.pop(instanceId, None)
+
+    def __len__(self):
+        return len(self._regions)
@@ -1,57 +1,325 @@
 import argparse
 import logging
+import os
+import socket
 import time
 import sys
 import signal
-from typing import List
-from pythonjsonlogger import jsonlogger
-from .unmap import unmapTerminatedInstancesFromService
-from prometheus_client import start_http_server, Gauge
+import threading
+from typing import List, TYPE_CHECKING
+from .unmap import unmapTerminatedInstancesFromServices
+from .aws import listNamespaceServiceIds
+from .clients import AwsClientPool
+from .credentials import MIN_ROLE_DURATION, parseInstancesTarget
+from .ratelimit import RateLimiter, parseOperationValues
+from .cache import EC2InstanceCache, EC2InstanceRegions
+from .metrics import upMetric, ownedServicesMetric, observeReconcile, enableMetrics
+from .sharding import StaticSharding, FileLeaseSharding
+from .snapshot import SnapshotRecorder, SnapshotReplayer
+from .profiling import enableProfiling, profileCalls
 
+if TYPE_CHECKING:
+    from .exporter import PrometheusExporter
 
-# Prometheus metrics
-upMetric = Gauge(
-    "aws_cloud_unmap_up",
-    "Always 1 - can by used to check if it's running",
-    labelnames=["service_id"])
-
-lastReconcileTimestampMetric = Gauge(
-    "aws_cloud_unmap_last_reconcile_success_timestamp_seconds",
-    "The timestamp (in seconds) of the last successful reconciliation",
-    labelnames=["service_id"])
+# Heavy dependencies only required by some code paths (ie. the asyncio engine,
+# the Prometheus exporter and the JSON logger) are imported where used, to
+# speed up the cold start of --single-run reconciles
 
 
 def parseArguments(argv: List[str]):
     # Parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument("--service-id", metavar="ID", required=True, help="AWS CloudMap service ID")
-    parser.add_argument("--service-region", metavar="REGION", required=True, help="AWS CloudMap service region")
-    parser.add_argument("--instances-region", metavar="REGION", required=True, nargs='+', help="AWS region where EC2 instances should be checked")
+    services = parser.add_mutually_exclusive_group(required=True)
+    services.add_argument("--service-id", metavar="ID", nargs='+', help="AWS CloudMap service IDs")
+    services.add_argument("--namespace-id", metavar="ID", help="AWS CloudMap namespace ID, to reconcile all its services")
+    parser.add_argument("--namespace-refresh-frequency", metavar="N", required=False, type=int, default=300, help="How frequently the services of the namespace should be listed (in seconds)")
+    parser.add_argument("--shard-index", metavar="N", required=False, type=int, default=0, help="Index (0-based) of this replica, when services are split among --shard-count replicas")
+    parser.add_argument("--shard-count", metavar="N", required=False, type=int, default=1, help="Number of replicas among which services are split by hashing")
+    parser.add_argument("--lease-file", metavar="PATH", required=False, help="Path of a lease file shared by replicas (ie. on a shared volume), to split services among a dynamic set of replicas")
+    parser.add_argument("--lease-ttl", metavar="N", required=False, type=int, default=30, help="How long the services of a replica not renewing its leases are kept before being taken over by other replicas (in seconds)")
+    parser.add_argument("--replica-id", metavar="ID", required=False, default=f"{socket.gethostname()}-{os.getpid()}", help="Unique ID of this replica in the lease file. Defaults to hostname and PID")
+    parser.add_argument("--service-region", metavar="REGION", required=True, help="AWS CloudMap services region")
+    parser.add_argument("--instances-region", metavar="[ACCOUNT_ID:]REGION", required=True, nargs='+', help="AWS region where EC2 instances should be checked, optionally in another account reached by assuming --assume-role-name (ie. 123456789012:eu-west-1)")
+    parser.add_argument("--assume-role-name", metavar="NAME", required=False, help="Name of the IAM role assumed through STS to check EC2 instances in the accounts of ACCOUNT_ID:REGION targets")
+    parser.add_argument("--assume-role-duration", metavar="N", required=False, type=int, default=3600, help="How long the credentials of assumed roles last, before being refreshed (in seconds). Must be at least 900 sec")
     parser.add_argument("--frequency", metavar="N", required=False, type=int, default=300, help="How frequently the service should be reconciled (in seconds)")
+    parser.add_argument("--min-frequency", metavar="N", required=False, type=int, default=None, help="Shortest interval between reconciles of a service while its instances change (in seconds). Defaults to --frequency")
+    parser.add_argument("--max-frequency", metavar="N", required=False, type=int, default=None, help="Longest interval between reconciles of a service while its instances don't change (in seconds). Defaults to --frequency")
+    parser.add_argument("--trigger-window", metavar="N", required=False, type=float, default=1, help="Triggers of an on-demand reconcile (SIGHUP or the reconcile endpoint) received within this window are coalesced into a single reconcile (in seconds)")
+    parser.add_argument("--jitter", metavar="RATIO", required=False, type=float, default=0.1, help="Random variation of the frequency of each service, as a ratio of the frequency (0 to disable)")
+    parser.add_argument("--max-concurrent-reconciles", metavar="N", required=False, type=int, default=4, help="Maximum number of services reconciled concurrently")
+    parser.add_argument("--max-concurrency", metavar="N", required=False, type=int, default=10, help="Maximum number of AWS regions queried concurrently")
+    parser.add_argument("--describe-batch-size", metavar="N", required=False, type=int, default=200, help="Maximum number of EC2 instance IDs described by a single request")
+    parser.add_argument("--describe-concurrency", metavar="N", required=False, type=int, default=4, help="Maximum number of concurrent describe requests per region")
+    parser.add_argument("--deregister-concurrency", metavar="N", required=False, type=int, default=10, help="Maximum number of instances deregistered concurrently")
+    parser.add_argument("--operation-timeout", metavar="N", required=False, type=int, default=60, help="How long to wait for deregistration operations to complete (in seconds)")
     parser.add_argument("--single-run", required=False, default=False, action="store_true", help="Run a single reconcile and then exit")
+    parser.add_argument("--instances-cache-ttl", metavar="N", required=False, type=int, default=0, help="How long running EC2 instances are cached and not described again (in seconds). Disabled by default")
+    parser.add_argument("--instances-cache-full-resync", metavar="N", required=False, type=int, default=10, help="Drop all cached EC2 instances every N reconciles")
+    parser.add_argument("--events-queue-url", metavar="URL", required=False, help="URL of an SQS queue receiving EC2 instance state-change notifications, to immediately reconcile terminated instances")
+    parser.add_argument("--events-queue-region", metavar="REGION", required=False, help="AWS region of the SQS queue. Defaults to the service region")
+    parser.add_argument("--rate-limit", metavar="[OPERATION=]N", required=False, nargs='+', default=[], help="Maximum AWS API requests per second, per region, for all operations or a specific one (ie. DescribeInstances=20). Disabled by default")
+    parser.add_argument("--rate-limit-burst", metavar="N", required=False, type=int, default=None, help="Maximum burst of AWS API requests above the rate limit. Defaults to 1 second worth of requests")
+    parser.add_argument("--retry-mode", required=False, choices=["legacy", "standard", "adaptive"], default="standard", help="The botocore retry mode of AWS API requests")
+    parser.add_argument("--retry-max-attempts", metavar="N", required=False, type=int, default=2, help="Maximum number of retries of a failed AWS API request")
+    parser.add_argument("--endpoint-url", metavar="URL", required=False, help="Send all AWS API requests to this endpoint instead of AWS (ie. a local fake endpoint for load testing)")
+    snapshot = parser.add_mutually_exclusive_group()
+    snapshot.add_argument("--record-snapshot", metavar="PATH", required=False, help="Record the Cloud Map and EC2 pages seen by a single reconcile (--single-run) to a gzipped snapshot file, to replay them offline")
+    snapshot.add_argument("--replay-snapshot", metavar="PATH", required=False, help="Run a single reconcile against a snapshot recorded with --record-snapshot, without any network access. Instances are not actually deregistered")
+    parser.add_argument("--profile", required=False, default=False, action="store_true", help="Log a structured record with elapsed time, item counts and pages fetched for each reconcile phase")
+    parser.add_argument("--profile-output", metavar="PATH", required=False, help="Profile a single reconcile (--single-run or --replay-snapshot) with cProfile, and dump the stats to this file")
     parser.add_argument("--enable-prometheus", required=False, default=False, action="store_true", help="Enable the Prometheus exporter")
     parser.add_argument("--prometheus-host", required=False, default="127.0.0.1", help="The host at which the Prometheus exporter should listen to")
     parser.add_argument("--prometheus-port", required=False, default="9100", type=int, help="The port at which the Prometheus exporter should listen to")
+    parser.add_argument("--enable-reconcile-endpoint", required=False, default=False, action="store_true", help="Trigger an on-demand reconcile of all services on POST requests to /reconcile of the Prometheus exporter")
     parser.add_argument("--log-level", help="Minimum log level. Accepted values are: DEBUG, INFO, WARNING, ERROR, CRITICAL", default="INFO")
 
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+
+    try:
+        accountIds = [accountId for accountId, _ in map(parseInstancesTarget, args.instances_region) if accountId]
+    except ValueError as error:
+        parser.error(str(error))
+
+    if accountIds and not args.assume_role_name:
+        parser.error("--assume-role-name is required to check EC2 instances in the accounts of ACCOUNT_ID:REGION targets")
+    if args.assume_role_duration < MIN_ROLE_DURATION:
+        parser.error(f"--assume-role-duration must be at least {MIN_ROLE_DURATION} seconds")
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    if args.lease_file and args.shard_count > 1:
+        parser.error("--lease-file can't be used along with --shard-count")
+    if args.events_queue_url and (args.lease_file or args.shard_count > 1):
+        parser.error("--events-queue-url can't be used along with --shard-count or --lease-file, because each replica would delete the notifications of the services owned by the others")
+    if args.record_snapshot and not args.single_run:
+        parser.error("--record-snapshot requires --single-run")
+    if args.profile_output and not (args.single_run or args.replay_snapshot):
+        parser.error("--profile-output requires --single-run or --replay-snapshot")
+    if args.enable_reconcile_endpoint and not args.enable_prometheus:
+        parser.error("--enable-reconcile-endpoint requires --enable-prometheus")
+
+    return args
 
 
-def reconcile(serviceId: str, serviceRegion: str, instancesRegion: List[str]):
+def reconcile(
+        args: argparse.Namespace,
+        serviceIds: List[str],
+        clientPool: AwsClientPool,
+        instanceCache: EC2InstanceCache = None,
+        instanceIds: List[str] = None,
+        instanceRegions: EC2InstanceRegions = None) -> bool:
     logger = logging.getLogger()
+    startTime = time.monotonic()
 
     try:
-        success = unmapTerminatedInstancesFromService(serviceId, serviceRegion, instancesRegion)
+        results = unmapTerminatedInstancesFromServices(
+            serviceIds,
+            args.service_region,
+            args.instances_region,
+            maxConcurrency=args.max_concurrency,
+            describeBatchSize=args.describe_batch_size,
+            describeConcurrency=args.describe_concurrency,
+            deregisterConcurrency=args.deregister_concurrency,
+            operationTimeout=args.operation_timeout,
+            clientPool=clientPool,
+            instanceIds=instanceIds,
+            instanceCache=instanceCache,
+            instanceRegions=instanceRegions)
     except Exception as error:
-        logger.error(f"An error occurred while reconciling service {serviceId}: {str(error)}")
-        success = False
+        for serviceId in serviceIds:
+            logger.error(f"An error occurred while reconciling service {serviceId}: {str(error)}")
+
+        results = {serviceId: False for serviceId in serviceIds}
+
+    # Only a full reconcile is tracked as such
+    if instanceIds is None:
+        for serviceId, success in results.items():
+            observeReconcile(serviceId, success, time.monotonic() - startTime)
+
+    return all(results.values())
+
+
+def listServiceIds(args: argparse.Namespace, clientPool: AwsClientPool) -> List[str]:
+    if args.namespace_id is None:
+        return args.service_id
+
+    serviceIds = listNamespaceServiceIds(args.namespace_id, clientPool.getClient("servicediscovery", args.service_region))
+    logging.getLogger().info(f"Found services {serviceIds} in namespace {args.namespace_id}")
+
+    return serviceIds
+
+
+def createSharding(args: argparse.Namespace):
+    if args.lease_file:
+        return FileLeaseSharding(args.lease_file, args.replica_id, args.lease_ttl)
+
+    return StaticSharding(args.shard_index, args.shard_count)
+
+
+def trackServiceIds(prevServiceIds: List[str], serviceIds: List[str]):
+    # Set the up metric value, which will be steady to 1 for the entire service lifecycle
+    for serviceId in set(prevServiceIds) - set(serviceIds):
+        upMetric.remove(serviceId)
+    for serviceId in serviceIds:
+        upMetric.labels(serviceId).set(1)
+
+    ownedServicesMetric.set(len(serviceIds))
 
-    if success:
-        lastReconcileTimestampMetric.labels(serviceId).set(int(time.time()))
+
+async def runEngine(args: argparse.Namespace, clientPool: AwsClientPool, instanceCache: EC2InstanceCache = None, instanceRegions: EC2InstanceRegions = None, exporter: "PrometheusExporter" = None):
+    import asyncio
+    from .engine import ReconcileEngine
+    from .events import EC2StateChangeConsumer
+
+    logger = logging.getLogger()
+    loop = asyncio.get_running_loop()
+
+    engine = ReconcileEngine(
+        args.service_region,
+        args.instances_region,
+        clientPool,
+        args.frequency,
+        minFrequency=args.min_frequency,
+        maxFrequency=args.max_frequency,
+        jitter=args.jitter,
+        triggerWindow=args.trigger_window,
+        maxConcurrentReconciles=args.max_concurrent_reconciles,
+        maxConcurrency=args.max_concurrency,
+        describeBatchSize=args.describe_batch_size,
+        describeConcurrency=args.describe_concurrency,
+        deregisterConcurrency=args.deregister_concurrency,
+        operationTimeout=args.operation_timeout,
+        instanceCache=instanceCache,
+        instanceRegions=instanceRegions)
+
+    # Register signal handler
+    def _on_sigterm():
+        logger.info("Shutting down")
+        engine.stop()
+
+    loop.add_signal_handler(signal.SIGINT, _on_sigterm)
+    loop.add_signal_handler(signal.SIGTERM, _on_sigterm)
+
+    # Reconcile all services on demand, on SIGHUP or through the reconcile
+    # endpoint of the Prometheus exporter (served by another thread)
+    def _on_trigger(source):
+        if engine.trigger(source):
+            logger.info(f"Reconcile of all services triggered by {source}")
+
+    loop.add_signal_handler(signal.SIGHUP, _on_trigger, "sighup")
+
+    if exporter is not None:
+        exporter.onReconcile = lambda: loop.call_soon_threadsafe(_on_trigger, "http")
+
+    # Start consuming EC2 state change notifications. The periodic reconcile
+    # keeps running as a safety net
+    if args.events_queue_url:
+        def _on_instances_terminating(instanceIds):
+            return asyncio.run_coroutine_threadsafe(engine.reconcileInstances(instanceIds), loop).result()
+
+        sqsClient = createEventsQueueClient(args, clientPool)
+        consumer = EC2StateChangeConsumer(args.events_queue_url, sqsClient, _on_instances_terminating)
+        threading.Thread(target=consumer.run, args=(engine.isStopping,), daemon=True).start()
+        logger.info(f"Consuming EC2 state change notifications from {args.events_queue_url}")
+
+    # The services to reconcile, owned by this replica. Services of a namespace
+    # are listed again every --namespace-refresh-frequency seconds, and the
+    # ownership is refreshed as required by the sharding, keeping the previous
+    # ones on error
+    sharding = createSharding(args)
+
+    async def _refresh_service_ids():
+        allServiceIds = None
+        allServiceIdsTime = None
+        serviceIds = []
+
+        while True:
+            if allServiceIds is None or (args.namespace_id is not None and time.monotonic() - allServiceIdsTime >= args.namespace_refresh_frequency):
+                try:
+                    allServiceIds = await loop.run_in_executor(None, listServiceIds, args, clientPool)
+                except Exception as error:
+                    logger.error(f"An error occurred while listing services in namespace {args.namespace_id}: {str(error)}")
+                finally:
+                    allServiceIdsTime = time.monotonic()
+
+            if allServiceIds is not None:
+                try:
+                    newServiceIds = await loop.run_in_executor(None, sharding.getOwnedServiceIds, allServiceIds)
+                except Exception as error:
+                    logger.error(f"An error occurred while refreshing the services owned by this replica: {str(error)}")
+                else:
+                    if newServiceIds != serviceIds:
+                        logger.info(f"Owning services {newServiceIds}")
+
+                    trackServiceIds(serviceIds, newServiceIds)
+                    engine.setServices(newServiceIds)
+                    serviceIds = newServiceIds
+
+            # Wait for the next refresh (if any)
+            intervals = [interval for interval in [sharding.refreshInterval, args.namespace_refresh_frequency if args.namespace_id else None] if interval]
+
+            if not intervals or await engine.waitStopping(min(intervals)):
+                return
+
+    refreshTask = loop.create_task(_refresh_service_ids())
+    await engine.run()
+    refreshTask.cancel()
+    sharding.release()
+
+
+def runOnce(args: argparse.Namespace, clientPool: AwsClientPool, instanceCache: EC2InstanceCache = None, instanceRegions: EC2InstanceRegions = None):
+    logger = logging.getLogger()
+    sharding = createSharding(args)
+
+    try:
+        serviceIds = sharding.getOwnedServiceIds(listServiceIds(args, clientPool))
+    except Exception as error:
+        logger.error(f"An error occurred while listing services in namespace {args.namespace_id}: {str(error)}")
+        return
+
+    trackServiceIds([], serviceIds)
+
+    try:
+        reconcile(args, serviceIds, clientPool, instanceCache, instanceRegions=instanceRegions)
+    finally:
+        sharding.release()
+
+
+def createClientPool(args: argparse.Namespace, snapshot: SnapshotRecorder | SnapshotReplayer = None) -> AwsClientPool:
+    # Create AWS clients once and reuse them across reconciles. The connections
+    # pool of each client is sized to serve the configured concurrency: the
+    # engine runs up to --max-concurrent-reconciles blocking jobs (plus one for
+    # the coalesced describe), each one deregistering up to --deregister-concurrency
+    # instances on the shared Cloud Map client, or describing up to
+    # --describe-concurrency batches on each EC2 client
+    maxConcurrentJobs = args.max_concurrent_reconciles + 1
+
+    return AwsClientPool(
+        maxPoolConnections=max(10, maxConcurrentJobs * max(args.describe_concurrency, args.deregister_concurrency)),
+        endpointUrl=args.endpoint_url,
+        retryMode=args.retry_mode,
+        maxAttempts=args.retry_max_attempts,
+        rateLimiter=RateLimiter(parseOperationValues(args.rate_limit), args.rate_limit_burst) if args.rate_limit else None,
+        snapshot=snapshot,
+        assumeRoleName=args.assume_role_name,
+        assumeRoleDuration=args.assume_role_duration,
+        stsRegion=args.service_region)
+
+
+def createEventsQueueClient(args: argparse.Namespace, clientPool: AwsClientPool):
+    from .events import RECEIVE_WAIT_TIME
+
+    # The read timeout must outlast the long polling of an empty queue
+    return clientPool.getClient("sqs", args.events_queue_region or args.service_region, readTimeout=RECEIVE_WAIT_TIME + 10)
+
+
+def createInstanceCache(args: argparse.Namespace) -> EC2InstanceCache:
+    # Cache running EC2 instances across reconciles
+    return EC2InstanceCache(args.instances_cache_ttl, args.instances_cache_full_resync) if args.instances_cache_ttl > 0 else None
 
 
 def main(args):
-    shutdown = False
+    from pythonjsonlogger import jsonlogger
 
     # Init logger
     logHandler = logging.StreamHandler()
@@ -62,39 +330,53 @@ def main(args):
     logger.addHandler(logHandler)
     logger.setLevel(args.log_level)
 
-    # Register signal handler
-    def _on_sigterm(signal, frame):
-        logger.info("Shutting down")
-        nonlocal shutdown
-        shutdown = True
+    # Log profiled phases
+    enableProfiling(args.profile)
 
-    signal.signal(signal.SIGINT, _on_sigterm)
-    signal.signal(signal.SIGTERM, _on_sigterm)
-
-    # Start Prometheus exporter
+    # Start Prometheus exporter. Metrics are collected only if exported
     if args.enable_prometheus:
-        start_http_server(args.prometheus_port, args.prometheus_host)
-        logger.info("Prometheus exporter listening on {host}:{port}".format(port=args.prometheus_port, host=args.prometheus_host))
+        from .exporter import PrometheusExporter
 
-    # Set the up metric value, which will be steady to 1 for the entire app lifecycle
-    upMetric.labels(args.service_id).set(1)
+        enableMetrics()
 
-    # Reconcile
-    if args.single_run:
-        reconcile(args.service_id, args.service_region, args.instances_region)
+        exporter = PrometheusExporter(args.prometheus_host, args.prometheus_port, args.enable_reconcile_endpoint)
+        exporter.start()
+        logger.info("Prometheus exporter listening on {host}:{port}".format(port=args.prometheus_port, host=args.prometheus_host))
+    else:
+        exporter = None
+
+    # Record AWS API responses to a snapshot, or replay them from it
+    if args.replay_snapshot:
+        snapshot = SnapshotReplayer(args.replay_snapshot)
+        logger.info(f"Replaying AWS API responses from snapshot {args.replay_snapshot}")
+    elif args.record_snapshot:
+        snapshot = SnapshotRecorder(args.record_snapshot)
+        logger.info(f"Recording AWS API responses to snapshot {args.record_snapshot}")
     else:
-        while not shutdown:
-            startTime = time.monotonic()
-            reconcile(args.service_id, args.service_region, args.instances_region)
+        snapshot = None
 
-            # Honor frequency
-            while not shutdown:
-                elapsedTime = time.monotonic() - startTime
+    clientPool = createClientPool(args, snapshot)
+    instanceCache = createInstanceCache(args)
 
-                if elapsedTime < args.frequency:
-                    time.sleep(min(1, args.frequency - elapsedTime))
-                else:
-                    break
+    # Remember the region of running EC2 instances across reconciles, to describe them only there
+    instanceRegions = EC2InstanceRegions()
+
+    # Reconcile. A snapshot is replayed by a single reconcile
+    try:
+        if args.profile_output:
+            with profileCalls(args.profile_output):
+                runOnce(args, clientPool, instanceCache, instanceRegions)
+
+            logger.info(f"Dumped cProfile stats to {args.profile_output}")
+        elif args.single_run or args.replay_snapshot:
+            runOnce(args, clientPool, instanceCache, instanceRegions)
+        else:
+            import asyncio
+
+            asyncio.run(runEngine(args, clientPool, instanceCache, instanceRegions, exporter))
+    finally:
+        if args.record_snapshot:
+            snapshot.close()
 
 
 def run():
@@ -0,0 +1,95 @@
+import threading
+from .credentials import AssumeRoleCredentialsCache, parseInstancesTarget
+from .ratelimit import RateLimiter
+from .snapshot import SnapshotRecorder, SnapshotReplayer
+from .telemetry import instrumentClient
+
+
+class AwsClientPool:
+    """
+    Long-lived pool of AWS clients, keyed by service name and region, so that
+    clients (and their warm HTTPS connections) are reused across reconciles.
+    Clients are instrumented to export per-API-call metrics.
+
+    If endpointUrl is set, all clients send requests to it instead of AWS
+    (ie. to run against a local fake endpoint). If rateLimiter is set, the
+    requests of all clients are rate limited by it. If snapshot is set, the
+    responses of all clients are either recorded to or replayed from it.
+
+    Clients of an account target (ie. 123456789012:eu-west-1) use the
+    credentials of the role assumeRoleName in that account, assumed through
+    STS in stsRegion and cached until they're about to expire.
+
+    boto3 is imported only once the first client is created, because it's
+    slow to import.
+    """
+
+    def __init__(
+            self,
+            maxPoolConnections: int = 10,
+            endpointUrl: str = None,
+            retryMode: str = "standard",
+            maxAttempts: int = 2,
+            rateLimiter: RateLimiter = None,
+            snapshot: SnapshotRecorder | SnapshotReplayer = None,
+            assumeRoleName: str = None,
+            assumeRoleDuration: int = 3600,
+            stsRegion: str = None):
+        self._endpointUrl = endpointUrl
+        self._rateLimiter = rateLimiter
+        self._snapshot = snapshot
+        self._config = {"connect_timeout": 5, "read_timeout": 15, "retries": {"mode": retryMode, "max_attempts": maxAttempts}, "max_pool_connections": maxPoolConnections}
+        self._clients = {}
+        self._accountSessions = {}
+        self._assumeRoleName = assumeRoleName
+        self._assumedRoleCredentials = AssumeRoleCredentialsCache(lambda: self.getClient("sts", stsRegion), assumeRoleDuration)
+        self._lock = threading.Lock()
+
+    def getClient(self, serviceName: str, region: str, readTimeout: int = None):
+        import boto3
+        import botocore.config
+
+        # Creating a client is not thread-safe, so the creation is serialized.
+        # Clients waiting for longer responses (ie. SQS long polling) override
+        # the read timeout, and are kept apart
+        with self._lock:
+            key = (serviceName, region, readTimeout)
+
+            if key not in self._clients:
+                accountId, regionName = parseInstancesTarget(region)
+                config = botocore.config.Config(**{**self._config, "read_timeout": readTimeout or self._config["read_timeout"]})
+
+                if accountId is None:
+                    client = boto3.client(serviceName, config=config, region_name=regionName, endpoint_url=self._endpointUrl)
+                else:
+                    client = self._getAccountSession(accountId).client(serviceName, config=config, region_name=regionName, endpoint_url=self._endpointUrl)
+
+                # Rate limits, metrics and snapshots are keyed by the target (passed
+                # as the region of the hooks) since AWS quotas are per account and region
+                instrumentClient(client, region)
+
+                if self._rateLimiter:
+                    self._rateLimiter.attachClient(client, region)
+                if self._snapshot:
+                    self._snapshot.attachClient(client, region)
+
+                self._clients[key] = client
+
+            return self._clients[key]
+
+    def _getAccountSession(self, accountId: str):
+        import boto3
+        import botocore.session
+        from botocore.credentials import CredentialResolver
+
+        if self._assumeRoleName is None:
+            raise ValueError(f"Can't create clients in account {accountId} without a role to assume")
+
+        # The clients of an account share the same session and credentials
+        if accountId not in self._accountSessions:
+            # The assumed role is the only source of credentials of the session
+            session = botocore.session.get_session()
+            session.register_component("credential_provider", CredentialResolver([self._assumedRoleCredentials.getCredentialProvider(f"arn:aws:iam::{accountId}:role/{self._assumeRoleName}")]))
+            self._accountSessions[accountId] = boto3.Session(botocore_session=session)
+
+        return self._accountSessions[accountId]
@@ -0,0 +1,89 @@
+import functools
+import logging
+import re
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+# Name of the STS sessions of the assumed roles, shown in CloudTrail
+ROLE_SESSION_NAME = "aws-cloud-unmap"
+
+# Shortest duration of the assumed roles credentials accepted by STS (in seconds)
+MIN_ROLE_DURATION = 900
+
+# EC2 instances are checked in a region, or in a region of another account
+# reached by assuming a role (ie. 123456789012:eu-west-1)
+INSTANCES_TARGET_PATTERN = re.compile(r"^(?:(\d{12}):)?([a-z0-9-]+)$")
+
+
+def parseInstancesTarget(target: str) -> Tuple[Optional[str], str]:
+    # Returns the account ID (None for the current one) and the region of the target
+    match = INSTANCES_TARGET_PATTERN.match(target)
+
+    if not match:
+        raise ValueError(f"Invalid EC2 instances target {target}, expected REGION or ACCOUNT_ID:REGION")
+
+    return match.group(1), match.group(2)
+
+
+class AssumeRoleCredentialProvider:
+    """
+    botocore credential provider (as listed by a CredentialResolver) loading
+    the cached credentials of an assumed role.
+    """
+
+    METHOD = "sts-assume-role"
+    CANONICAL_NAME = "custom-sts-assume-role"
+
+    def __init__(self, credentialsCache: "AssumeRoleCredentialsCache", roleArn: str):
+        self._credentialsCache = credentialsCache
+        self._roleArn = roleArn
+
+    def load(self):
+        return self._credentialsCache.getCredentials(self._roleArn)
+
+
+class AssumeRoleCredentialsCache:
+    """
+    Caches the credentials of the roles assumed through STS, keyed by role ARN,
+    so that each role is assumed once and not on every reconcile. A role is
+    assumed on the first use of its credentials (ie. never while replaying a
+    snapshot), and assumed again only once its credentials are about to expire
+    (botocore refreshes them within 15 minutes of the expiration, or within a
+    quarter of the duration for shorter lived credentials).
+    """
+
+    def __init__(self, getStsClient: Callable, durationSeconds: int = 3600, sessionName: str = ROLE_SESSION_NAME):
+        self._getStsClient = getStsClient
+        self._durationSeconds = durationSeconds
+        self._sessionName = sessionName
+        self._credentials: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def getCredentials(self, roleArn: str):
+        from botocore.credentials import DeferredRefreshableCredentials
+
+        with self._lock:
+            if roleArn not in self._credentials:
+                credentials = DeferredRefreshableCredentials(functools.partial(self._assumeRole, roleArn), "sts-assume-role")
+
+                # Short lived credentials would be always within the botocore refresh
+                # windows (15 and 10 minutes), and the role assumed on every request
+                credentials._advisory_refresh_timeout = min(credentials._advisory_refresh_timeout, self._durationSeconds // 4)
+                credentials._mandatory_refresh_timeout = min(credentials._mandatory_refresh_timeout, self._durationSeconds // 6)
+                self._credentials[roleArn] = credentials
+
+            return self._credentials[roleArn]
+
+    def getCredentialProvider(self, roleArn: str) -> AssumeRoleCredentialProvider:
+        return AssumeRoleCredentialProvider(self, roleArn)
+
+    def _assumeRole(self, roleArn: str) -> dict:
+        response = self._getStsClient().assume_role(RoleArn=roleArn, RoleSessionName=self._sessionName, DurationSeconds=self._durationSeconds)
+        credentials = response["Credentials"]
+        logging.getLogger().info(f"Assumed role {roleArn} until {credentials['Expiration'].isoformat()}")
+
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat()}
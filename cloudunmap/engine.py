@@ -0,0 +1,291 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from .cache import EC2InstanceCache, EC2InstanceRegions
+from .clients import AwsClientPool
+from .metrics import observeReconcile, reconcileIntervalMetric, reconcileTriggersMetric
+from .unmap import listServicesInstancesToCheck, describeServicesRunningInstances, unmapServicesUnmatchingInstances, matchServiceInstanceInIndex
+
+
+def nextReconcileInterval(interval: float, changed: bool, minInterval: float, maxInterval: float) -> float:
+    # Reconcile as frequently as allowed while instances change, and back off
+    # exponentially while nothing changes
+    if changed:
+        return minInterval
+
+    return min(maxInterval, max(minInterval, interval * 2))
+
+
+class ReconcileEngine:
+    """
+    Reconciles many services concurrently on an asyncio loop. Each service is
+    reconciled on its own schedule (with jitter), at most maxConcurrentReconciles
+    services at a time, and the blocking AWS calls run in a thread pool.
+
+    The interval of each service adapts between minFrequency and maxFrequency
+    (both defaulting to frequency): it drops to the minimum once a reconcile
+    finds unmatched or changed registered instances, and doubles otherwise.
+
+    The EC2 instances of services reaching the describe phase within the same
+    describeWindow (in seconds) are described once, and shared among them.
+
+    On trigger(), all services are reconciled right away, without waiting for
+    their next scheduled reconcile. Triggers received within the same
+    triggerWindow (in seconds) are coalesced into a single reconcile.
+
+    On stop(), reconciles in progress complete their current phase and exit
+    without starting the next one.
+    """
+
+    def __init__(
+            self,
+            serviceRegion: str,
+            instancesRegions: List[str],
+            clientPool: AwsClientPool,
+            frequency: float,
+            minFrequency: float = None,
+            maxFrequency: float = None,
+            jitter: float = 0.1,
+            maxConcurrentReconciles: int = 4,
+            describeWindow: float = 1,
+            triggerWindow: float = 1,
+            maxConcurrency: int = 10,
+            describeBatchSize: int = 200,
+            describeConcurrency: int = 4,
+            deregisterConcurrency: int = 10,
+            operationTimeout: float = 60,
+            instanceCache: EC2InstanceCache = None,
+            instanceRegions: EC2InstanceRegions = None):
+        self._serviceRegion = serviceRegion
+        self._instancesRegions = instancesRegions
+        self._minFrequency = minFrequency if minFrequency is not None else frequency
+        self._maxFrequency = maxFrequency if maxFrequency is not None else frequency
+        self._frequency = min(self._maxFrequency, max(self._minFrequency, frequency))
+        self._jitter = jitter
+        self._describeWindow = describeWindow
+        self._triggerWindow = triggerWindow
+        self._maxConcurrency = maxConcurrency
+        self._describeBatchSize = describeBatchSize
+        self._describeConcurrency = describeConcurrency
+        self._deregisterConcurrency = deregisterConcurrency
+        self._operationTimeout = operationTimeout
+        self._instanceCache = instanceCache
+        self._instanceRegions = instanceRegions
+
+        self._sdClient = clientPool.getClient("servicediscovery", serviceRegion)
+        self._ec2Clients = {region: clientPool.getClient("ec2", region) for region in instancesRegions}
+
+        self._executor = ThreadPoolExecutor(max_workers=maxConcurrentReconciles + 1)
+        self._semaphore = asyncio.Semaphore(maxConcurrentReconciles)
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._triggersCount = 0
+        self._pendingTrigger: Optional[asyncio.TimerHandle] = None
+        self._running = False
+        self._serviceIds: List[str] = []
+        self._servicesSet = False
+        self._serviceTasks: Dict[str, asyncio.Task] = {}
+        self._serviceLocks: Dict[str, asyncio.Lock] = {}
+        self._serviceRegistrations: Dict[str, Set[Tuple[str, str]]] = {}
+        self._pendingDescribe: Optional[Tuple[dict, asyncio.Future]] = None
+
+    def isStopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def waitStopping(self, timeout: float) -> bool:
+        # Returns True if the engine has been stopped within the timeout
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def waitNextReconcile(self, timeout: float) -> bool:
+        # Waits until the timeout expires or a reconcile is triggered. Returns
+        # True if the engine has been stopped in the meanwhile
+        waiters = [asyncio.create_task(self._stopping.wait()), asyncio.create_task(self._wakeup.wait())]
+
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+        return self.isStopping()
+
+    def trigger(self, source: str) -> bool:
+        # Must be called from the event loop thread. Returns False if the trigger
+        # has been coalesced with a pending one
+        reconcileTriggersMetric.labels(source).inc()
+
+        if self._pendingTrigger is not None:
+            return False
+
+        self._pendingTrigger = asyncio.get_running_loop().call_later(self._triggerWindow, self._fireTrigger)
+        return True
+
+    def _fireTrigger(self):
+        self._pendingTrigger = None
+        self._triggersCount += 1
+
+        # Wake up all the services waiting for their next reconcile
+        wakeup, self._wakeup = self._wakeup, asyncio.Event()
+        wakeup.set()
+
+    def setServices(self, serviceIds: List[str]):
+        self._serviceIds = list(serviceIds)
+        self._servicesSet = True
+
+        for serviceId in serviceIds:
+            self._serviceLocks.setdefault(serviceId, asyncio.Lock())
+
+        if self._running:
+            self._scheduleServices()
+
+    async def run(self):
+        self._running = True
+        self._scheduleServices()
+
+        await self._stopping.wait()
+        await asyncio.gather(*self._serviceTasks.values(), return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def reconcileService(self, serviceId: str, onlyInstanceIds: Optional[Set[str]] = None) -> bool:
+        success, _ = await self._reconcileService(serviceId, onlyInstanceIds)
+
+        return success
+
+    async def reconcileInstances(self, instanceIds: List[str]) -> bool:
+        # Until the services are known (ie. while the services of the namespace
+        # are being listed) the instances can't be reconciled, and they're
+        # reported as failed to be retried later
+        if not self._servicesSet:
+            return False
+
+        onlyInstanceIds = set(instanceIds)
+        results = await asyncio.gather(*[self.reconcileService(serviceId, onlyInstanceIds) for serviceId in self._serviceIds])
+
+        return all(results)
+
+    async def _reconcileService(self, serviceId: str, onlyInstanceIds: Optional[Set[str]]) -> Tuple[bool, bool]:
+        # Returns whether the reconcile succeeded, and whether it found unmatched
+        # or changed registered instances
+        logger = logging.getLogger()
+        changed = False
+
+        async with self._semaphore, self._serviceLocks[serviceId]:
+            logger.info(f"Checking EC2 instances registered to service {serviceId} in {self._serviceRegion}")
+            startTime = time.monotonic()
+            servicesInstances, results = await self._run(listServicesInstancesToCheck, [serviceId], self._sdClient, onlyInstanceIds)
+
+            # Look for registration churn since the previous full reconcile. A
+            # failed listing tells nothing about the registrations
+            if onlyInstanceIds is None and (serviceId in servicesInstances or results.get(serviceId)):
+                serviceInstances = servicesInstances[serviceId][0] if serviceId in servicesInstances else []
+                registrations = {(i.instanceId, i.ipv4) for i in serviceInstances}
+                changed = serviceId in self._serviceRegistrations and registrations != self._serviceRegistrations[serviceId]
+                self._serviceRegistrations[serviceId] = registrations
+
+            if servicesInstances and not self.isStopping():
+                try:
+                    runningInstancesIndex = await self._describe(servicesInstances, onlyInstanceIds)
+                except Exception as error:
+                    logger.error(f"An error occurred while reconciling service {serviceId}: {str(error)}")
+                    results[serviceId] = False
+
+                if serviceId not in results and not self.isStopping():
+                    changed = changed or any(not matchServiceInstanceInIndex(i, runningInstancesIndex) for i in servicesInstances[serviceId][1])
+
+                    results.update(await self._run(
+                        unmapServicesUnmatchingInstances, servicesInstances, runningInstancesIndex, self._sdClient, self._serviceRegion,
+                        self._instancesRegions, self._deregisterConcurrency, self._operationTimeout, onlyInstanceIds))
+
+            # The reconcile has been interrupted
+            if serviceId not in results:
+                return False, changed
+
+            # Only a full reconcile is tracked as such
+            if onlyInstanceIds is None:
+                observeReconcile(serviceId, results[serviceId], time.monotonic() - startTime)
+
+            return results[serviceId], changed
+
+    def _scheduleServices(self):
+        # Stop reconciling removed services
+        for serviceId in set(self._serviceTasks) - set(self._serviceIds):
+            self._serviceTasks.pop(serviceId).cancel()
+            self._serviceRegistrations.pop(serviceId, None)
+            reconcileIntervalMetric.remove(serviceId)
+
+        # Start reconciling new services
+        for serviceId in self._serviceIds:
+            if serviceId not in self._serviceTasks:
+                self._serviceTasks[serviceId] = asyncio.create_task(self._runService(serviceId))
+                reconcileIntervalMetric.labels(serviceId).set(self._frequency)
+
+    async def _runService(self, serviceId: str):
+        # Spread the first reconcile of services over the jitter, so that they don't all run at the same time
+        delay = random.uniform(0, self._frequency * self._jitter)
+        interval = self._frequency
+
+        while not await self.waitNextReconcile(delay):
+            startTime = time.monotonic()
+            triggersCount = self._triggersCount
+            success, changed = await self._reconcileService(serviceId, None)
+
+            # A failed reconcile tells nothing about changes, so the interval is kept
+            if success or changed:
+                interval = nextReconcileInterval(interval, changed, self._minFrequency, self._maxFrequency)
+                reconcileIntervalMetric.labels(serviceId).set(interval)
+
+            # Honor frequency
+            delay = max(0, interval * random.uniform(1 - self._jitter, 1 + self._jitter) - (time.monotonic() - startTime))
+
+            # A reconcile triggered while reconciling may have missed the changes
+            # it was triggered for, so it's run again right away
+            if self._triggersCount != triggersCount:
+                delay = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def _describe(self, servicesInstances: dict, onlyInstanceIds: Optional[Set[str]]) -> Dict[str, Set[str]]:
+        # Instances to reconcile on demand are described right away
+        if onlyInstanceIds is not None:
+            return await self._describeNow(servicesInstances, onlyInstanceIds)
+
+        # Coalesce the describe of services waiting within the same window
+        if self._pendingDescribe is None:
+            self._pendingDescribe = ({}, asyncio.get_running_loop().create_future())
+            asyncio.get_running_loop().call_later(self._describeWindow, self._flushDescribe)
+
+        pendingServicesInstances, future = self._pendingDescribe
+        pendingServicesInstances.update(servicesInstances)
+
+        return await asyncio.shield(future)
+
+    def _flushDescribe(self):
+        servicesInstances, future = self._pendingDescribe
+        self._pendingDescribe = None
+
+        def _on_done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception():
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        asyncio.create_task(self._describeNow(servicesInstances, None)).add_done_callback(_on_done)
+
+    async def _describeNow(self, servicesInstances: dict, onlyInstanceIds: Optional[Set[str]]) -> Dict[str, Set[str]]:
+        return await self._run(
+            describeServicesRunningInstances, servicesInstances, self._ec2Clients, self._maxConcurrency,
+            self._describeBatchSize, self._describeConcurrency, self._instanceCache, onlyInstanceIds, self._instanceRegions)
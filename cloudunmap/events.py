@@ -0,0 +1,82 @@
+import json
+import logging
+import time
+from typing import Callable, Iterable, List
+
+# EC2 instance states which trigger an immediate reconcile
+TERMINATING_STATES = ("shutting-down", "terminated")
+
+# How long (in seconds) a receive waits for messages (SQS long polling)
+RECEIVE_WAIT_TIME = 20
+
+
+def parseEC2StateChangeInstanceIds(messagesBody: Iterable[str]) -> List[str]:
+    instanceIds = {}
+
+    for body in messagesBody:
+        try:
+            event = json.loads(body)
+
+            # Unwrap events delivered through SNS
+            if event.get("Type") == "Notification" and "Message" in event:
+                event = json.loads(event["Message"])
+        except (ValueError, TypeError, AttributeError):
+            continue
+
+        if not isinstance(event, dict) or event.get("detail-type") != "EC2 Instance State-change Notification":
+            continue
+
+        detail = event.get("detail")
+        if not isinstance(detail, dict):
+            continue
+
+        if detail.get("state") in TERMINATING_STATES and "instance-id" in detail:
+            instanceIds[detail["instance-id"]] = True
+
+    return list(instanceIds)
+
+
+class EC2StateChangeConsumer:
+    """
+    Consumes EC2 instance state-change notifications (delivered by EventBridge
+    to an SQS queue) and notifies the terminating instance IDs to a callback.
+    Messages are deleted only once the callback succeeds, otherwise they will
+    be received again after the queue visibility timeout.
+    """
+
+    def __init__(self, queueUrl: str, sqsClient, onInstancesTerminating: Callable[[List[str]], bool], waitTime: int = RECEIVE_WAIT_TIME):
+        self._queueUrl = queueUrl
+        self._sqsClient = sqsClient
+        self._onInstancesTerminating = onInstancesTerminating
+        self._waitTime = waitTime
+
+    def poll(self) -> int:
+        response = self._sqsClient.receive_message(QueueUrl=self._queueUrl, MaxNumberOfMessages=10, WaitTimeSeconds=self._waitTime)
+        messages = response.get("Messages", [])
+
+        if not messages:
+            return 0
+
+        instanceIds = parseEC2StateChangeInstanceIds(message["Body"] for message in messages)
+
+        if instanceIds:
+            logging.getLogger().info(f"Received state change notifications for EC2 instances {instanceIds}")
+
+            if not self._onInstancesTerminating(instanceIds):
+                return len(messages)
+
+        self._sqsClient.delete_message_batch(
+            QueueUrl=self._queueUrl,
+            Entries=[{"Id": str(index), "ReceiptHandle": message["ReceiptHandle"]} for index, message in enumerate(messages)])
+
+        return len(messages)
+
+    def run(self, isShutdown: Callable[[], bool], errorBackoff: float = 5):
+        logger = logging.getLogger()
+
+        while not isShutdown():
+            try:
+                self.poll()
+            except Exception as error:
+                logger.error(f"An error occurred while consuming EC2 state change notifications from {self._queueUrl}: {str(error)}")
+                time.sleep(errorBackoff)
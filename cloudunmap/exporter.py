@@ -0,0 +1,69 @@
+import socket
+import threading
+from socketserver import ThreadingMixIn
+from typing import Callable, Optional
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from prometheus_client import make_wsgi_app
+
+# Path of the endpoint triggering a reconcile
+RECONCILE_PATH = "/reconcile"
+
+
+class ExporterRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ExporterServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int):
+        # Listen on IPv4 or IPv6, depending on the host
+        self.address_family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        super().__init__(address[:2], ExporterRequestHandler)
+
+
+class PrometheusExporter:
+    """
+    Serves the Prometheus metrics over HTTP. If enableReconcile is set, POST
+    requests to /reconcile call onReconcile, once set, to trigger a reconcile.
+    """
+
+    def __init__(self, host: str, port: int, enableReconcile: bool = False):
+        self.onReconcile: Optional[Callable[[], None]] = None
+        self._enableReconcile = enableReconcile
+        self._metricsApp = make_wsgi_app()
+        self._server = ExporterServer(host, port)
+        self._server.set_app(self._app)
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        # Shutting down a server which isn't serving would wait forever
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+
+        self._server.server_close()
+
+    def _app(self, environ: dict, start_response):
+        if not self._enableReconcile or environ.get("PATH_INFO") != RECONCILE_PATH:
+            return self._metricsApp(environ, start_response)
+        if environ["REQUEST_METHOD"] != "POST":
+            return self._respond(start_response, "405 Method Not Allowed", "Only POST requests are allowed\n", [("Allow", "POST")])
+        if self.onReconcile is None:
+            return self._respond(start_response, "503 Service Unavailable", "Reconciles can't be triggered yet\n")
+
+        self.onReconcile()
+        return self._respond(start_response, "202 Accepted", "Reconcile triggered\n")
+
+    def _respond(self, start_response, status: str, body: str, headers: list = None):
+        start_response(status, [("Content-Type", "text/plain; charset=utf-8"), *(headers or [])])
+        return [body.encode("utf-8")]
@@ -0,0 +1,266 @@
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+from .ratelimit import parseOperationValues
+
+# Region used when it can't be picked from the request signature
+DEFAULT_REGION = "us-east-1"
+
+# Error codes returned by AWS when throttling requests
+THROTTLING_ERROR_CODES = {"servicediscovery": "ThrottlingException", "ec2": "RequestLimitExceeded"}
+
+
+class FakeAwsFleet:
+    """
+    In-memory fleet of EC2 instances spread across regions, and registered to
+    Cloud Map services. A share of the instances is terminated, but still
+    registered, so that they're expected to be deregistered.
+    """
+
+    def __init__(self, instancesCount: int, regions: List[str], serviceIds: List[str], terminatedRatio: float = 0.01):
+        terminatedEvery = round(1 / terminatedRatio) if terminatedRatio > 0 else 0
+
+        self.regions = regions
+        self.ec2Instances = {region: {} for region in regions}
+        self.serviceInstances = {serviceId: {} for serviceId in serviceIds}
+        self.operations = {}
+        self._lock = threading.Lock()
+
+        for index in range(instancesCount):
+            instanceId = f"i-{index:017x}"
+            privateIp = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+            state = "terminated" if terminatedEvery and index % terminatedEvery == 0 else "running"
+
+            self.ec2Instances[regions[index % len(regions)]][instanceId] = (privateIp, state)
+            self.serviceInstances[serviceIds[index % len(serviceIds)]][instanceId] = privateIp
+
+    def listServices(self) -> List[str]:
+        return list(self.serviceInstances)
+
+    def listServiceInstances(self, serviceId: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self.serviceInstances[serviceId].items())
+
+    def deregisterServiceInstance(self, serviceId: str, instanceId: str) -> Optional[str]:
+        with self._lock:
+            if self.serviceInstances[serviceId].pop(instanceId, None) is None:
+                return None
+
+            operationId = uuid.uuid4().hex
+            self.operations[operationId] = time.monotonic()
+
+            return operationId
+
+    def getOperationSubmitTime(self, operationId: str) -> Optional[float]:
+        with self._lock:
+            return self.operations.get(operationId)
+
+    def describeInstances(self, region: str, instanceIds: Optional[List[str]], states: Optional[List[str]]) -> List[Tuple[str, str, str]]:
+        instances = self.ec2Instances.get(region, {})
+        instanceIds = instanceIds if instanceIds is not None else list(instances)
+
+        return [(i, *instances[i]) for i in instanceIds if i in instances and (states is None or instances[i][1] in states)]
+
+
+class FakeAwsError(Exception):
+    def __init__(self, code: str, message: str, status: int = 400):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+
+class FakeAwsServer(ThreadingHTTPServer):
+    """
+    Local HTTP stand-in for the Cloud Map and EC2 APIs used by the application,
+    serving a FakeAwsFleet. Each call is delayed by the configured latency and
+    throttled at the configured rate, both configurable per operation (the "*"
+    key applies to all operations).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], fleet: FakeAwsFleet, latencies: Dict[str, float] = None, throttleRates: Dict[str, float] = None, operationDelay: float = 0):
+        super().__init__(address, FakeAwsRequestHandler)
+        self.fleet = fleet
+        self.latencies = latencies or {}
+        self.throttleRates = throttleRates or {}
+        self.operationDelay = operationDelay
+
+    @property
+    def endpointUrl(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def getLatency(self, operationName: str) -> float:
+        return self.latencies.get(operationName, self.latencies.get("*", 0))
+
+    def getThrottleRate(self, operationName: str) -> float:
+        return self.throttleRates.get(operationName, self.throttleRates.get("*", 0))
+
+
+class FakeAwsRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # Cloud Map uses the JSON protocol, while EC2 uses the query protocol
+        if "X-Amz-Target" in self.headers:
+            serviceName = "servicediscovery"
+            operationName = self.headers["X-Amz-Target"].split(".")[-1]
+            params = json.loads(body or b"{}")
+        else:
+            serviceName = "ec2"
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            operationName = params.get("Action")
+
+        time.sleep(self.server.getLatency(operationName))
+
+        try:
+            if random.random() < self.server.getThrottleRate(operationName):
+                raise FakeAwsError(THROTTLING_ERROR_CODES[serviceName], "Rate exceeded")
+
+            if serviceName == "servicediscovery":
+                self._sendJson(200, self._handleServiceDiscovery(operationName, params))
+            else:
+                self._sendXml(200, self._handleEC2(operationName, params))
+        except FakeAwsError as error:
+            if serviceName == "servicediscovery":
+                self._sendJson(error.status, {"__type": error.code, "message": str(error)})
+            else:
+                self._sendXml(error.status, f"<Response><Errors><Error><Code>{error.code}</Code><Message>{escape(str(error))}</Message></Error></Errors><RequestID>{uuid.uuid4()}</RequestID></Response>")
+
+    def _getRegion(self) -> str:
+        # Pick the region from the credential scope of the SigV4 signature
+        match = re.search(r"Credential=[^/]+/[^/]+/([^/]+)/", self.headers.get("Authorization", ""))
+        return match.group(1) if match else DEFAULT_REGION
+
+    def _handleServiceDiscovery(self, operationName: str, params: dict) -> dict:
+        fleet = self.server.fleet
+
+        if operationName == "ListServices":
+            return {"Services": [{"Id": serviceId, "Name": serviceId} for serviceId in fleet.listServices()]}
+
+        if operationName == "ListInstances":
+            if params["ServiceId"] not in fleet.serviceInstances:
+                raise FakeAwsError("ServiceNotFound", f"Service {params['ServiceId']} not found")
+
+            instances = fleet.listServiceInstances(params["ServiceId"])
+            offset = int(params.get("NextToken", 0))
+            limit = params.get("MaxResults", 100)
+            response = {"Instances": [{"Id": i, "Attributes": {"AWS_INSTANCE_IPV4": ip, "AWS_INSTANCE_PORT": "80"}} for i, ip in instances[offset:offset + limit]]}
+
+            if offset + limit < len(instances):
+                response["NextToken"] = str(offset + limit)
+
+            return response
+
+        if operationName == "DeregisterInstance":
+            if params["ServiceId"] not in fleet.serviceInstances:
+                raise FakeAwsError("ServiceNotFound", f"Service {params['ServiceId']} not found")
+
+            operationId = fleet.deregisterServiceInstance(params["ServiceId"], params["InstanceId"])
+
+            if operationId is None:
+                raise FakeAwsError("InstanceNotFound", f"Instance {params['InstanceId']} not found")
+
+            return {"OperationId": operationId}
+
+        if operationName == "GetOperation":
+            submitTime = fleet.getOperationSubmitTime(params["OperationId"])
+
+            if submitTime is None:
+                raise FakeAwsError("OperationNotFound", f"Operation {params['OperationId']} not found")
+
+            status = "SUCCESS" if time.monotonic() - submitTime >= self.server.operationDelay else "PENDING"
+            return {"Operation": {"Id": params["OperationId"], "Type": "DEREGISTER_INSTANCE", "Status": status}}
+
+        raise FakeAwsError("InvalidAction", f"Operation {operationName} is not supported")
+
+    def _handleEC2(self, operationName: str, params: dict) -> str:
+        if operationName != "DescribeInstances":
+            raise FakeAwsError("InvalidAction", f"Operation {operationName} is not supported")
+
+        # Parse filters, like Filter.1.Name=instance-id&Filter.1.Value.1=i-1
+        filters = {}
+
+        for key, value in params.items():
+            match = re.fullmatch(r"Filter\.(\d+)\.Name", key)
+
+            if match:
+                filters[value] = [v for k, v in sorted(params.items()) if k.startswith(f"Filter.{match.group(1)}.Value.")]
+
+        instances = self.server.fleet.describeInstances(self._getRegion(), filters.get("instance-id"), filters.get("instance-state-name"))
+        offset = int(params.get("NextToken", 0))
+        limit = int(params.get("MaxResults", 1000))
+        instancesXml = "".join(
+            f"<item><instanceId>{i}</instanceId><instanceState><code>{16 if state == 'running' else 48}</code><name>{state}</name></instanceState><privateIpAddress>{ip}</privateIpAddress></item>"
+            for i, ip, state in instances[offset:offset + limit])
+        nextTokenXml = f"<nextToken>{offset + limit}</nextToken>" if offset + limit < len(instances) else ""
+
+        return (
+            f'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><requestId>{uuid.uuid4()}</requestId>'
+            f'<reservationSet><item><reservationId>r-0</reservationId><ownerId>000000000000</ownerId><instancesSet>{instancesXml}</instancesSet></item></reservationSet>'
+            f'{nextTokenXml}</DescribeInstancesResponse>')
+
+    def _sendJson(self, status: int, body: dict):
+        self._send(status, "application/x-amz-json-1.1", json.dumps(body).encode())
+
+    def _sendXml(self, status: int, body: str):
+        self._send(status, "text/xml", body.encode())
+
+    def _send(self, status: int, contentType: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-amzn-RequestId", str(uuid.uuid4()))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parseArguments(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Local fake AWS endpoint serving the Cloud Map and EC2 APIs used by aws-cloud-unmap")
+    parser.add_argument("--host", required=False, default="127.0.0.1", help="The host at which the fake endpoint should listen to")
+    parser.add_argument("--port", required=False, type=int, default=4566, help="The port at which the fake endpoint should listen to")
+    parser.add_argument("--instances", metavar="N", required=False, type=int, default=10000, help="Number of EC2 instances in the fleet")
+    parser.add_argument("--terminated-ratio", metavar="RATIO", required=False, type=float, default=0.01, help="Ratio of EC2 instances terminated but still registered")
+    parser.add_argument("--regions", metavar="REGION", required=False, nargs='+', default=["eu-west-1", "us-east-1", "us-west-2"], help="Regions where EC2 instances are spread")
+    parser.add_argument("--service-id", metavar="ID", required=False, nargs='+', default=["srv-1"], help="Cloud Map service IDs where EC2 instances are registered")
+    parser.add_argument("--latency", metavar="[OPERATION=]SECONDS", required=False, nargs='+', default=[], help="Latency of each call, for all operations or a specific one")
+    parser.add_argument("--throttle-rate", metavar="[OPERATION=]RATIO", required=False, nargs='+', default=[], help="Ratio of throttled calls, for all operations or a specific one")
+    parser.add_argument("--operation-delay", metavar="SECONDS", required=False, type=float, default=0, help="How long deregistration operations stay pending")
+
+    return parser.parse_args(argv)
+
+
+def main(args):
+    fleet = FakeAwsFleet(args.instances, args.regions, args.service_id, args.terminated_ratio)
+    server = FakeAwsServer((args.host, args.port), fleet, parseOperationValues(args.latency), parseOperationValues(args.throttle_rate), args.operation_delay)
+
+    print(f"Fake AWS endpoint listening on {server.endpointUrl}, serving {args.instances} EC2 instances in {args.regions} registered to services {args.service_id}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run():
+    main(parseArguments(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    run()
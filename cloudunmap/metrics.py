@@ -0,0 +1,191 @@
+import threading
+import time
+from typing import List
+
+
+# Metrics are collected only once enabled, so that prometheus_client (slow to
+# import) is imported only when the Prometheus exporter is enabled, and not by
+# short-lived runs (ie. --single-run or the Lambda handler)
+_metrics: List["LazyMetric"] = []
+_metricsLock = threading.Lock()
+
+
+class NoopMetric:
+    """
+    Accepts and ignores any call of a Prometheus metric (including labels() and
+    the time() context manager).
+    """
+
+    def __getattr__(self, name):
+        return self._ignore
+
+    def _ignore(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOOP_METRIC = NoopMetric()
+
+
+class LazyMetric:
+    """
+    Stands for a Prometheus metric of type metricType (Counter, Gauge or
+    Histogram), created on enable(). Until then, the metric is a no-op.
+    """
+
+    def __init__(self, metricType: str, *args, **kwargs):
+        self._metricType = metricType
+        self._args = args
+        self._kwargs = kwargs
+        self._metric = None
+
+        _metrics.append(self)
+
+    def enable(self):
+        import prometheus_client
+
+        if self._metric is None:
+            self._metric = getattr(prometheus_client, self._metricType)(*self._args, **self._kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._metric if self._metric is not None else NOOP_METRIC, name)
+
+
+def enableMetrics():
+    with _metricsLock:
+        for metric in _metrics:
+            metric.enable()
+
+
+# Buckets (in seconds) suitable for reconciles lasting from milliseconds to several minutes
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+upMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_up",
+    "Always 1 - can by used to check if it's running",
+    labelnames=["service_id"])
+
+ownedServicesMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_owned_services",
+    "The number of services owned (and reconciled) by this replica")
+
+lastReconcileTimestampMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_last_reconcile_success_timestamp_seconds",
+    "The timestamp (in seconds) of the last successful reconciliation",
+    labelnames=["service_id"])
+
+reconcileDurationMetric = LazyMetric(
+    "Histogram",
+    "aws_cloud_unmap_reconcile_duration_seconds",
+    "The time (in seconds) taken by a full reconciliation",
+    labelnames=["service_id"],
+    buckets=DURATION_BUCKETS)
+
+reconcileTriggersMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_reconcile_triggers_total",
+    "The number of on-demand reconciles triggered, including the ones coalesced",
+    labelnames=["source"])
+
+reconcileIntervalMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_reconcile_interval_seconds",
+    "The current interval (in seconds) between reconciliations, adapted to the observed changes",
+    labelnames=["service_id"])
+
+reconcilePhaseDurationMetric = LazyMetric(
+    "Histogram",
+    "aws_cloud_unmap_reconcile_phase_duration_seconds",
+    "The time (in seconds) taken by each reconciliation phase",
+    labelnames=["service_id", "phase"],
+    buckets=DURATION_BUCKETS)
+
+describeRegionDurationMetric = LazyMetric(
+    "Histogram",
+    "aws_cloud_unmap_describe_instances_duration_seconds",
+    "The time (in seconds) taken to describe the EC2 instances in a region",
+    labelnames=["service_id", "region"],
+    buckets=DURATION_BUCKETS)
+
+registeredInstancesMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_registered_instances",
+    "The number of instances registered to the service",
+    labelnames=["service_id"])
+
+skippedInstancesMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_skipped_instances",
+    "The number of instances registered to the service without the AWS_INSTANCE_IPV4 attribute",
+    labelnames=["service_id"])
+
+runningInstancesMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_running_instances",
+    "The number of running EC2 instances found for the instances registered to the service",
+    labelnames=["service_id"])
+
+unmatchedInstancesMetric = LazyMetric(
+    "Gauge",
+    "aws_cloud_unmap_unmatched_instances",
+    "The number of instances registered to the service not matching any running EC2 instance",
+    labelnames=["service_id"])
+
+deregisteredInstancesMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_deregistered_instances",
+    "The number of instances deregistered from the service",
+    labelnames=["service_id"])
+
+awsApiCallsMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_aws_api_calls",
+    "The number of AWS API calls (each one may include several retried attempts)",
+    labelnames=["operation", "region"])
+
+awsApiCallDurationMetric = LazyMetric(
+    "Histogram",
+    "aws_cloud_unmap_aws_api_call_duration_seconds",
+    "The time (in seconds) taken by AWS API calls, including retries",
+    labelnames=["operation", "region"],
+    buckets=DURATION_BUCKETS)
+
+awsApiRetriesMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_aws_api_retries",
+    "The number of retried AWS API call attempts",
+    labelnames=["operation", "region"])
+
+awsApiThrottlesMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_aws_api_throttles",
+    "The number of AWS API call attempts failed because throttled",
+    labelnames=["operation", "region"])
+
+awsApiErrorsMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_aws_api_errors",
+    "The number of AWS API calls failed (after retries)",
+    labelnames=["operation", "region"])
+
+awsApiRateLimitWaitMetric = LazyMetric(
+    "Counter",
+    "aws_cloud_unmap_aws_api_rate_limit_wait_seconds",
+    "The time (in seconds) AWS API call attempts waited for the client-side rate limiter",
+    labelnames=["operation", "region"])
+
+
+def observeReconcile(serviceId: str, success: bool, duration: float):
+    reconcileDurationMetric.labels(serviceId).observe(duration)
+
+    if success:
+        lastReconcileTimestampMetric.labels(serviceId).set(int(time.time()))
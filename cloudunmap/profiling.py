@@ -0,0 +1,99 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Whether profiled phases are logged. Spans are tracked anyway, being cheap
+_profilingEnabled = False
+
+# The span of the phase running in the current context, if any
+_currentSpan = contextvars.ContextVar("currentSpan", default=None)
+
+
+def enableProfiling(enabled: bool = True):
+    global _profilingEnabled
+    _profilingEnabled = enabled
+
+
+def isProfilingEnabled() -> bool:
+    return _profilingEnabled
+
+
+class ProfileSpan:
+    """
+    Times a reconcile phase and counts the AWS API pages fetched within it, by
+    instrumented clients running in the same context. When profiling is
+    enabled, the span is logged as a structured record on exit, along with
+    the item counts set on it.
+    """
+
+    def __init__(self, phase: str, **fields):
+        self.phase = phase
+        self.fields = fields
+        self.pages = 0
+        self.elapsedTime = None
+        self._lock = threading.Lock()
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def addPage(self):
+        # Pages may be fetched by concurrent threads sharing the context
+        with self._lock:
+            self.pages += 1
+
+    def __enter__(self):
+        self._startTime = time.monotonic()
+        self._token = _currentSpan.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsedTime = time.monotonic() - self._startTime
+        _currentSpan.reset(self._token)
+
+        if _profilingEnabled:
+            logging.getLogger().info(
+                f"Profiled phase {self.phase} in {self.elapsedTime:.3f} seconds",
+                extra={"phase": self.phase, "elapsed_seconds": round(self.elapsedTime, 6), "pages": self.pages, "failed": exc_type is not None, **self.fields})
+
+
+def countProfiledPage():
+    span = _currentSpan.get()
+
+    if span is not None:
+        span.addPage()
+
+
+@contextmanager
+def profileCalls(path: str):
+    """
+    Profiles the calls of all threads with cProfile (the threads started while
+    profiling get their own profiler), and dumps the merged stats to path.
+    """
+    import cProfile
+    import pstats
+
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def _on_thread_start(frame, event, arg):
+        # Replaces itself with a new profiler on the first event of each thread
+        profiler = cProfile.Profile()
+
+        with lock:
+            profilers.append(profiler)
+
+        profiler.enable()
+
+    threading.setprofile(_on_thread_start)
+    profilers[0].enable()
+
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+
+        with lock:
+            pstats.Stats(*profilers).dump_stats(path)
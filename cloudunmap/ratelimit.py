@@ -0,0 +1,87 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from .metrics import awsApiRateLimitWaitMetric
+from .telemetry import getOperationName
+
+
+def parseOperationValues(values: List[str]) -> Dict[str, float]:
+    # Values are either "N", applied to all operations, or "Operation=N"
+    parsed = {}
+
+    for value in values:
+        operationName, _, number = value.rpartition("=")
+        parsed[operationName or "*"] = float(number)
+
+    return parsed
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, refilled at rate tokens per second up to burst
+    tokens. Callers reserve a token and then sleep until it's available, so
+    that they're served in order without busy waiting.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updatedAt = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # Returns how long (in seconds) the caller waited for the token
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updatedAt) * self._rate) - 1
+            self._updatedAt = now
+            waitTime = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+        return waitTime
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter of AWS API requests, with a token bucket per
+    operation and region shared by all the clients it's attached to. Rates
+    (requests per second) are configured per operation, with the "*" key
+    applying to all operations. Each attempt consumes a token, so retries
+    are rate limited too.
+    """
+
+    def __init__(self, rates: Dict[str, float], burst: Optional[float] = None):
+        self._rates = rates
+        self._burst = burst
+        self._buckets: Dict[Tuple[str, str], Optional[TokenBucket]] = {}
+        self._lock = threading.Lock()
+
+    def getBucket(self, operationName: str, region: str) -> Optional[TokenBucket]:
+        with self._lock:
+            key = (operationName, region)
+
+            if key not in self._buckets:
+                rate = self._rates.get(operationName, self._rates.get("*"))
+                self._buckets[key] = TokenBucket(rate, self._burst or max(1, rate)) if rate else None
+
+            return self._buckets[key]
+
+    def attachClient(self, client, region: str = None):
+        region = region or client.meta.region_name
+
+        def _on_before_send(event_name, **kwargs):
+            operationName = getOperationName(event_name)
+            bucket = self.getBucket(operationName, region)
+
+            if bucket:
+                waitTime = bucket.acquire()
+
+                if waitTime > 0:
+                    awsApiRateLimitWaitMetric.labels(operationName, region).inc(waitTime)
+
+        client.meta.events.register("before-send", _on_before_send)
+
+        return client
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import shlex
+from typing import List, Optional
+from .cli import parseArguments, createClientPool, createInstanceCache, listServiceIds, reconcile
+from .cache import EC2InstanceRegions
+from .events import parseEC2StateChangeInstanceIds
+
+# Environment variable holding the command line arguments of the handler
+ARGS_ENV_VAR = "AWS_CLOUD_UNMAP_ARGS"
+
+# Arguments, clients and state learned by previous reconciles, initialized by
+# the first (cold) invocation and reused by the following (warm) ones
+_state = None
+
+
+class ReconcileError(Exception):
+    pass
+
+
+def getState():
+    global _state
+
+    if _state is None:
+        args = parseArguments(shlex.split(os.environ.get(ARGS_ENV_VAR, "")))
+        _state = (args, createClientPool(args), createInstanceCache(args), EC2InstanceRegions())
+
+    return _state
+
+
+def isSQSEvent(event: dict) -> bool:
+    return isinstance(event, dict) and any(record.get("eventSource") == "aws:sqs" for record in event.get("Records", []))
+
+
+def parseEventInstanceIds(event: dict) -> Optional[List[str]]:
+    # EC2 state-change notifications are delivered either directly by
+    # EventBridge or through an SQS queue. Any other event (ie. a schedule)
+    # triggers a full reconcile
+    if not isinstance(event, dict):
+        return None
+    if isSQSEvent(event):
+        return parseEC2StateChangeInstanceIds(record.get("body", "") for record in event["Records"])
+    if event.get("detail-type") == "EC2 Instance State-change Notification":
+        return parseEC2StateChangeInstanceIds([json.dumps(event)])
+
+    return None
+
+
+def handler(event, context):
+    """
+    AWS Lambda entry point, reconciling the services configured by the command
+    line arguments in the AWS_CLOUD_UNMAP_ARGS environment variable. When
+    invoked by EC2 state-change notifications, only the terminating instances
+    are reconciled, and a failure is raised when they're received from SQS,
+    so that they're not deleted from the queue and get received again.
+    """
+    args, clientPool, instanceCache, instanceRegions = getState()
+    logger = logging.getLogger()
+    logger.setLevel(args.log_level)
+
+    instanceIds = parseEventInstanceIds(event)
+
+    if instanceIds is not None and not instanceIds:
+        logger.info("No terminating EC2 instances in the event. Skipping")
+        return {"success": True, "serviceIds": [], "instanceIds": []}
+
+    serviceIds = listServiceIds(args, clientPool)
+    success = reconcile(args, serviceIds, clientPool, instanceCache, instanceIds, instanceRegions)
+
+    # Lambda deletes the batch of SQS messages unless the invocation fails
+    if not success and isSQSEvent(event):
+        raise ReconcileError(f"Failed to reconcile EC2 instances {instanceIds}")
+
+    return {"success": success, "serviceIds": serviceIds, "instanceIds": instanceIds}
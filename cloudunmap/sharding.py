@@ -0,0 +1,116 @@
+import fcntl
+import hashlib
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+def hashKey(key: str) -> int:
+    # Stable across processes and hosts, unlike the built-in hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class StaticSharding:
+    """
+    Splits services among a fixed number of replicas, each one owning the
+    services hashed to its shard index. With a single shard, all services are
+    owned.
+    """
+
+    # Ownership never changes, so there's no need to refresh it
+    refreshInterval: Optional[float] = None
+
+    def __init__(self, shardIndex: int = 0, shardCount: int = 1):
+        self._shardIndex = shardIndex
+        self._shardCount = shardCount
+
+    def getOwnedServiceIds(self, serviceIds: List[str]) -> List[str]:
+        return [serviceId for serviceId in serviceIds if hashKey(serviceId) % self._shardCount == self._shardIndex]
+
+    def release(self):
+        pass
+
+
+class FileLeaseSharding:
+    """
+    Splits services among a dynamic set of replicas sharing a lease file,
+    locked on each access. Each replica heartbeats and renews the leases of
+    its services every ttl / 3 seconds, owning about the same number of
+    services as the others. The services of a replica not heartbeating anymore
+    are taken over by the others once its leases expire.
+
+    Each replica prefers services by rendezvous hashing, so that services
+    don't move among replicas unless the set of replicas changes.
+    """
+
+    def __init__(self, path: str, replicaId: str, ttl: float = 30):
+        self._path = path
+        self._replicaId = replicaId
+        self._ttl = ttl
+        self.refreshInterval = ttl / 3
+
+    @contextmanager
+    def _lockedState(self):
+        # Read, update and write the state while holding an exclusive lock
+        with open(self._path, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+
+            try:
+                file.seek(0)
+                content = file.read()
+                state = json.loads(content) if content else {}
+                state.setdefault("replicas", {})
+                state.setdefault("leases", {})
+
+                yield state
+
+                file.seek(0)
+                file.truncate()
+                json.dump(state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def getOwnedServiceIds(self, serviceIds: List[str]) -> List[str]:
+        now = time.time()
+
+        with self._lockedState() as state:
+            # Heartbeat, and drop replicas and leases expired or of services not existing anymore
+            replicas = {replicaId: expiresAt for replicaId, expiresAt in state["replicas"].items() if expiresAt > now}
+            replicas[self._replicaId] = now + self._ttl
+            leases = {serviceId: lease for serviceId, lease in state["leases"].items() if lease["expiresAt"] > now and serviceId in serviceIds}
+
+            # Keep the preferred services already owned, up to a fair share of all services
+            fairShare = math.ceil(len(serviceIds) / len(replicas))
+            preferredServiceIds = sorted(serviceIds, key=lambda serviceId: hashKey(f"{serviceId}/{self._replicaId}"))
+            ownedServiceIds = [serviceId for serviceId in preferredServiceIds if leases.get(serviceId, {}).get("holder") == self._replicaId][:fairShare]
+
+            for serviceId, lease in list(leases.items()):
+                if lease["holder"] == self._replicaId and serviceId not in ownedServiceIds:
+                    del leases[serviceId]
+
+            # Take over the preferred services not owned by any replica
+            for serviceId in preferredServiceIds:
+                if len(ownedServiceIds) >= fairShare:
+                    break
+                if serviceId not in leases:
+                    ownedServiceIds.append(serviceId)
+
+            for serviceId in ownedServiceIds:
+                leases[serviceId] = {"holder": self._replicaId, "expiresAt": now + self._ttl}
+
+            state["replicas"] = replicas
+            state["leases"] = leases
+
+        ownedServiceIds = set(ownedServiceIds)
+        return [serviceId for serviceId in serviceIds if serviceId in ownedServiceIds]
+
+    def release(self):
+        # Let the other replicas take over the services right away
+        with self._lockedState() as state:
+            state["replicas"].pop(self._replicaId, None)
+            state["leases"] = {serviceId: lease for serviceId, lease in state["leases"].items() if lease["holder"] != self._replicaId}
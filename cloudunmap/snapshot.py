@@ -0,0 +1,126 @@
+import gzip
+import json
+import threading
+from typing import Dict, List, Tuple
+from .telemetry import getOperationName
+
+# Read operations whose responses are recorded and replayed
+RECORDED_OPERATIONS = frozenset(["ListServices", "ListInstances", "DescribeInstances"])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def getSnapshotKey(serviceName: str, region: str, operationName: str, params: dict) -> Tuple[str, str, str, str]:
+    # Params are serialized in a canonical form, so that they can be matched on replay
+    return (serviceName, region, operationName, json.dumps(params, sort_keys=True, default=str))
+
+
+class SnapshotRecorder:
+    """
+    Records the raw pages of the read operations (ListServices, ListInstances
+    and DescribeInstances) returned to the clients it's attached to, into a
+    gzipped JSON lines snapshot file, to be later replayed by SnapshotReplayer.
+    """
+
+    def __init__(self, path: str):
+        self._file = gzip.open(path, "wt")
+        self._lock = threading.Lock()
+
+    def attachClient(self, client, region: str = None):
+        serviceName = client.meta.service_model.service_name
+        region = region or client.meta.region_name
+
+        def _on_before_parameter_build(params, context, **kwargs):
+            context["snapshotParams"] = dict(params)
+
+        def _on_after_call(http_response, parsed, context, event_name, **kwargs):
+            operationName = getOperationName(event_name)
+
+            if operationName not in RECORDED_OPERATIONS or http_response.status_code >= 300 or "snapshotParams" not in context:
+                return
+
+            response = {key: value for key, value in parsed.items() if key != "ResponseMetadata"}
+            self.record(serviceName, region, operationName, context["snapshotParams"], response)
+
+        client.meta.events.register("before-parameter-build", _on_before_parameter_build)
+        client.meta.events.register("after-call", _on_after_call)
+
+        return client
+
+    def record(self, serviceName: str, region: str, operationName: str, params: dict, response: dict):
+        entry = json.dumps({"service": serviceName, "region": region, "operation": operationName, "params": params, "response": response}, default=str)
+
+        with self._lock:
+            self._file.write(entry + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SnapshotReplayer:
+    """
+    Serves the API calls of the clients it's attached to from a snapshot
+    recorded by SnapshotRecorder, without any network access. Deregistrations
+    are not recorded, so they're acknowledged (and reported as succeeded)
+    without any effect.
+    """
+
+    def __init__(self, path: str):
+        self._responses: Dict[Tuple[str, str, str, str], dict] = {}
+
+        with gzip.open(path, "rt") as file:
+            for line in file:
+                entry = json.loads(line)
+                self._responses[getSnapshotKey(entry["service"], entry["region"], entry["operation"], entry["params"])] = entry["response"]
+
+    @property
+    def serviceIds(self) -> List[str]:
+        # The services whose instances have been recorded
+        return sorted({json.loads(params)["ServiceId"] for _, _, operationName, params in self._responses if operationName == "ListInstances"})
+
+    @property
+    def serviceRegion(self) -> str:
+        # The region of the recorded services
+        return next(region for serviceName, region, _, _ in self._responses if serviceName == "servicediscovery")
+
+    @property
+    def instancesRegions(self) -> List[str]:
+        # The regions where EC2 instances have been described
+        return sorted({region for _, region, operationName, _ in self._responses if operationName == "DescribeInstances"})
+
+    def getResponse(self, serviceName: str, region: str, operationName: str, params: dict) -> dict:
+        if operationName == "DeregisterInstance":
+            return {"OperationId": f"replay-{params['ServiceId']}-{params['InstanceId']}"}
+        if operationName == "GetOperation":
+            return {"Operation": {"Id": params["OperationId"], "Type": "DEREGISTER_INSTANCE", "Status": "SUCCESS"}}
+
+        key = getSnapshotKey(serviceName, region, operationName, params)
+
+        if key not in self._responses:
+            raise SnapshotError(f"No response recorded in the snapshot for {operationName} in {region} with params {key[3]}")
+
+        return self._responses[key]
+
+    def attachClient(self, client, region: str = None):
+        from botocore.awsrequest import AWSResponse
+
+        serviceName = client.meta.service_model.service_name
+        region = region or client.meta.region_name
+
+        def _on_before_parameter_build(params, context, **kwargs):
+            context["snapshotParams"] = dict(params)
+
+        def _on_before_call(model, context, **kwargs):
+            # Returning a response short-circuits the request, which is never sent
+            parsed = json.loads(json.dumps(self.getResponse(serviceName, region, model.name, context["snapshotParams"])))
+            parsed["ResponseMetadata"] = {"HTTPStatusCode": 200, "RetryAttempts": 0}
+
+            return AWSResponse(None, 200, {}, None), parsed
+
+        client.meta.events.register("before-parameter-build", _on_before_parameter_build)
+        client.meta.events.register("before-call", _on_before_call)
+
+        return client
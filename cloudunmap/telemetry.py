@@ -0,0 +1,64 @@
+import time
+from .metrics import awsApiCallsMetric, awsApiCallDurationMetric, awsApiRetriesMetric, awsApiThrottlesMetric, awsApiErrorsMetric
+from .profiling import countProfiledPage
+
+# Error codes returned by AWS APIs when a request is throttled
+THROTTLING_ERROR_CODES = frozenset([
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "SlowDown",
+    "EC2ThrottledException",
+])
+
+
+def getOperationName(eventName: str) -> str:
+    # Event names are in the format "<event>.<service>.<operation>"
+    return eventName.rsplit(".", 1)[-1]
+
+
+def instrumentClient(client, region: str = None):
+    """
+    Registers botocore event hooks on the input client, to track count,
+    latency, retries and throttling errors of each API call. Each call is also
+    counted as a page fetched by the profiled phase running it (if any).
+    """
+    region = region or client.meta.region_name
+    events = client.meta.events
+
+    def _on_before_parameter_build(context, event_name, **kwargs):
+        context["telemetryStartTime"] = time.monotonic()
+
+    def _on_call_completed(operationName, context, failed, retries=0):
+        awsApiCallsMetric.labels(operationName, region).inc()
+
+        if retries:
+            awsApiRetriesMetric.labels(operationName, region).inc(retries)
+        if failed:
+            awsApiErrorsMetric.labels(operationName, region).inc()
+        if "telemetryStartTime" in context:
+            awsApiCallDurationMetric.labels(operationName, region).observe(time.monotonic() - context["telemetryStartTime"])
+
+    def _on_after_call(http_response, parsed, context, event_name, **kwargs):
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        countProfiledPage()
+        _on_call_completed(getOperationName(event_name), context, http_response.status_code >= 300, retries)
+
+    def _on_after_call_error(context, event_name, **kwargs):
+        _on_call_completed(getOperationName(event_name), context, True)
+
+    def _on_needs_retry(response, event_name, **kwargs):
+        # Called for each attempt, so it also counts throttled attempts later retried
+        if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            awsApiThrottlesMetric.labels(getOperationName(event_name), region).inc()
+
+    events.register("before-parameter-build", _on_before_parameter_build)
+    events.register("after-call", _on_after_call)
+    events.register("after-call-error", _on_after_call_error)
+    events.register("needs-retry", _on_needs_retry)
+
+    return client
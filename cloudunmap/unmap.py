@@ -1,68 +1,227 @@
-import boto3
-import botocore
 import logging
-from typing import List
-from .aws import listServiceInstances, listEC2InstancesById
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .clients import AwsClientPool
+from .cache import EC2InstanceCache, EC2InstanceRegions
+from .metrics import (
+    reconcilePhaseDurationMetric, describeRegionDurationMetric, registeredInstancesMetric, skippedInstancesMetric,
+    runningInstancesMetric, unmatchedInstancesMetric, deregisteredInstancesMetric)
+from .profiling import ProfileSpan
+from .aws import ServiceInstance, EC2Instance, slimServiceInstance, iterServiceInstances, iterEC2InstancesById, getEC2InstanceIps, deregisterServiceInstances, waitServiceOperations
 
+# EC2 instance states considered running, that is all but shutting-down and terminated
+EC2_RUNNING_STATES = ["pending", "running", "stopping", "stopped"]
 
-def matchServiceInstanceInRunningInstances(serviceInstance, runningInstances):
-    serviceInstanceId = serviceInstance["Id"]
-    serviceInstanceIp = serviceInstance["Attributes"]["AWS_INSTANCE_IPV4"]
 
+def indexRunningInstances(runningInstances: Iterable[EC2Instance | dict], index: Dict[str, Set[str]] = None) -> Dict[str, Set[str]]:
+    index = {} if index is None else index
+
+    # Map each instance ID to the set of all its known IPs, so that
+    # matching a service instance is a constant time lookup. Instances
+    # are consumed one by one, so that they can be streamed from the API.
+    # Both compact records and full instance descriptions are supported
     for runningInstance in runningInstances:
-        # The instance ID must match
-        if runningInstance["InstanceId"] != serviceInstanceId:
-            continue
+        if isinstance(runningInstance, EC2Instance):
+            index.setdefault(runningInstance.instanceId, set()).update(runningInstance.ips)
+        else:
+            index.setdefault(runningInstance["InstanceId"], set()).update(getEC2InstanceIps(runningInstance))
+
+    return index
+
+
+def matchServiceInstanceInIndex(serviceInstance: ServiceInstance | dict, runningInstancesIndex: Dict[str, Set[str]]) -> bool:
+    # Both compact records and full service instances (as returned by Cloud Map) are supported
+    if isinstance(serviceInstance, dict):
+        serviceInstance = slimServiceInstance(serviceInstance)
 
-        # The service IP must match any of the instance IPs
-        if "PublicIpAddress" in runningInstance and runningInstance["PublicIpAddress"] == serviceInstanceIp:
-            return True
-        elif "PrivateIpAddress" in runningInstance and runningInstance["PrivateIpAddress"] == serviceInstanceIp:
-            return True
+    # The instance ID must match and the service IP must match any of the instance IPs
+    ips = runningInstancesIndex.get(serviceInstance.instanceId)
 
-    return False
+    return ips is not None and serviceInstance.ipv4 in ips
 
 
-def unmapTerminatedInstancesFromService(serviceId: str, serviceRegion: str, instancesRegions: List[str]) -> bool:
+def matchServiceInstanceInRunningInstances(serviceInstance: ServiceInstance | dict, runningInstances: Iterable[EC2Instance | dict]) -> bool:
+    return matchServiceInstanceInIndex(serviceInstance, indexRunningInstances(runningInstances))
+
+
+def isRunningEC2Instance(instance: EC2Instance) -> bool:
+    return instance.state != "shutting-down" and instance.state != "terminated"
+
+
+def indexRunningEC2InstancesById(serviceIds: List[str], instanceIds: List[str], ec2Client, region: str, describeBatchSize: int, describeConcurrency: int) -> Dict[str, Set[str]]:
     logger = logging.getLogger()
-    logger.info(f"Checking EC2 instances registered to service {serviceId} in {serviceRegion}")
+    startTime = time.monotonic()
 
-    # Customize the boto client config
-    botoConfig = botocore.client.Config(connect_timeout=5, read_timeout=15, retries={"max_attempts": 2})
+    # Stream slim instances straight into the index. Terminated instances are
+    # filtered out by EC2, and then again here in case the filter is not honored
+    with ProfileSpan("describe_ec2_instances", region=region, service_ids=serviceIds, described=len(instanceIds)) as span:
+        instances = iterEC2InstancesById(instanceIds, ec2Client, describeBatchSize, describeConcurrency, EC2_RUNNING_STATES, slim=True)
+        index = indexRunningInstances(filter(isRunningEC2Instance, instances))
+        span.set(running=len(index))
 
-    # Instance Cloud Map client
-    sdClient = boto3.client("servicediscovery", config=botoConfig, region_name=serviceRegion)
+    # The describe is shared by all services, so it's tracked for each one of them
+    elapsedTime = time.monotonic() - startTime
 
-    # Instance EC2 clients
-    ec2Clients = [boto3.client("ec2", config=botoConfig, region_name=region) for region in instancesRegions]
+    for serviceId in serviceIds:
+        describeRegionDurationMetric.labels(serviceId, region).observe(elapsedTime)
 
-    # List registered instances on CloudMap
-    serviceInstances = listServiceInstances(serviceId, sdClient)
+    logger.info(f"Found {len(index)} running EC2 instances in {region} in {elapsedTime:.3f} seconds")
+    return index
 
-    # Skip in case there are no registered instances
-    if not serviceInstances:
-        logger.info(f"No registered instances in the service {serviceId}. Skipping")
-        return True
 
-    # Filter out service instances without the AWS_INSTANCE_IPV4 attribute
-    # and extract instance ids
-    serviceInstances = list(filter(lambda i: "AWS_INSTANCE_IPV4" in i["Attributes"], serviceInstances))
-    serviceInstancesId = list(map(lambda i: i["Id"], serviceInstances))
+def listServiceInstancesToCheck(serviceId: str, sdClient, instanceIds: Optional[Set[str]]) -> Tuple[int, List[ServiceInstance], List[ServiceInstance]]:
+    # List registered instances on CloudMap, filtering out service instances
+    # without the AWS_INSTANCE_IPV4 attribute while pages are streamed
+    registeredCount = 0
+    serviceInstances = []
+
+    with reconcilePhaseDurationMetric.labels(serviceId, "list_service_instances").time(), ProfileSpan("list_service_instances", service_id=serviceId) as span:
+        for serviceInstance in iterServiceInstances(serviceId, sdClient, slim=True):
+            registeredCount += 1
+
+            if serviceInstance.ipv4 is not None:
+                serviceInstances.append(serviceInstance)
+
+        span.set(registered=registeredCount, skipped=registeredCount - len(serviceInstances))
+
+    # Fleet size metrics are tracked only on full reconciles
+    if instanceIds is None:
+        registeredInstancesMetric.labels(serviceId).set(registeredCount)
+        skippedInstancesMetric.labels(serviceId).set(registeredCount - len(serviceInstances))
+
+    # When only some instance IDs should be reconciled, check just them. The
+    # circuit breaker still protects all the instances registered to the service
+    with ProfileSpan("filter", service_id=serviceId) as span:
+        if instanceIds is None:
+            checkedInstances = serviceInstances
+        else:
+            checkedInstances = list(filter(lambda i: i.instanceId in instanceIds, serviceInstances))
+
+        span.set(registered=len(serviceInstances), checked=len(checkedInstances))
+
+    return registeredCount, serviceInstances, checkedInstances
+
+
+def describeRunningInstancesInRegions(
+        serviceIds: List[str],
+        regionsInstanceIds: Dict[str, List[str]],
+        ec2Clients: Dict[str, object],
+        maxConcurrency: int,
+        describeBatchSize: int,
+        describeConcurrency: int) -> Dict[str, Dict[str, Set[str]]]:
+    regionsInstanceIds = {region: instanceIds for region, instanceIds in regionsInstanceIds.items() if instanceIds}
+    regionsIndex = {region: {} for region in ec2Clients}
+
+    # List EC2 instances in all expected regions concurrently. If any region
+    # fails, the whole reconcile fails (and the regions not started yet are
+    # cancelled), because we can't tell which instances are not running
+    with ThreadPoolExecutor(max_workers=max(1, min(maxConcurrency, len(regionsInstanceIds)))) as executor:
+        futures = {region: executor.submit(indexRunningEC2InstancesById, serviceIds, instanceIds, ec2Clients[region], region, describeBatchSize, describeConcurrency) for region, instanceIds in regionsInstanceIds.items()}
 
-    # List EC2 instances in all expected regions
-    runningInstances = []
+        try:
+            for region, future in futures.items():
+                regionsIndex[region] = future.result()
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            raise
 
-    for ec2Client in ec2Clients:
-        instances = listEC2InstancesById(serviceInstancesId, ec2Client)
-        # Filter out terminated instances
-        instances = list(filter(lambda i: i["State"]["Name"] != "shutting-down" and i["State"]["Name"] != "terminated", instances))
+    return regionsIndex
 
-        runningInstances += instances
+
+def describeRunningInstances(
+        serviceIds: List[str],
+        instanceIds: List[str],
+        ec2Clients: Dict[str, object],
+        maxConcurrency: int,
+        describeBatchSize: int,
+        describeConcurrency: int,
+        instanceCache: Optional[EC2InstanceCache],
+        onlyInstanceIds: bool,
+        instanceRegions: Optional[EC2InstanceRegions] = None) -> Dict[str, Set[str]]:
+    logger = logging.getLogger()
+
+    # Reuse the running instances cached by previous reconciles, and describe
+    # only the others. The instances to reconcile on demand are always described
+    runningInstancesIndex = {}
+
+    if instanceCache is not None:
+        if onlyInstanceIds:
+            instanceCache.invalidate(instanceIds)
+        elif instanceCache.startCycle():
+            logger.info("Forcing a full resync of the cached EC2 instances")
+
+        runningInstancesIndex, instanceIds = instanceCache.get(instanceIds)
+        logger.info(f"Reusing {len(runningInstancesIndex)} cached running EC2 instances, describing {len(instanceIds)} EC2 instances")
+
+    # Describe the instances whose region is known only in that region, and
+    # the others in all regions
+    regionsInstanceIds = {region: [] for region in ec2Clients}
+    knownInstanceIds = []
+    unknownInstanceIds = []
+
+    for instanceId in instanceIds:
+        region = instanceRegions.get(instanceId) if instanceRegions is not None else None
+
+        if region in regionsInstanceIds:
+            regionsInstanceIds[region].append(instanceId)
+            knownInstanceIds.append(instanceId)
+        else:
+            unknownInstanceIds.append(instanceId)
+
+    for regionInstanceIds in regionsInstanceIds.values():
+        regionInstanceIds.extend(unknownInstanceIds)
+
+    regionsIndex = describeRunningInstancesInRegions(serviceIds, regionsInstanceIds, ec2Clients, maxConcurrency, describeBatchSize, describeConcurrency)
+    describedIndex = {instanceId: ips for index in regionsIndex.values() for instanceId, ips in index.items()}
+
+    # Instances not found in their known region are looked up in all the other ones
+    missingInstanceIds = [instanceId for instanceId in knownInstanceIds if instanceId not in describedIndex]
+
+    if missingInstanceIds:
+        logger.info(f"Describing in all regions {len(missingInstanceIds)} EC2 instances not found in their known region")
+
+        regionsMissingInstanceIds = {region: [i for i in missingInstanceIds if instanceRegions.get(i) != region] for region in ec2Clients}
+
+        for region, index in describeRunningInstancesInRegions(serviceIds, regionsMissingInstanceIds, ec2Clients, maxConcurrency, describeBatchSize, describeConcurrency).items():
+            regionsIndex[region].update(index)
+            describedIndex.update(index)
+
+    # Remember where instances are running, and forget the ones not running anymore
+    if instanceRegions is not None:
+        instanceRegions.put({instanceId: region for region, index in regionsIndex.items() for instanceId in index})
+        instanceRegions.forget(instanceId for instanceId in instanceIds if instanceId not in describedIndex)
+
+    if instanceCache is not None:
+        instanceCache.put(describedIndex)
+
+    runningInstancesIndex.update(describedIndex)
+    return runningInstancesIndex
+
+
+def unmapUnmatchingServiceInstances(
+        serviceId: str,
+        serviceInstances: List[ServiceInstance],
+        checkedInstances: List[ServiceInstance],
+        runningInstancesIndex: Dict[str, Set[str]],
+        sdClient,
+        instancesRegions: List[str],
+        deregisterConcurrency: int,
+        operationTimeout: float,
+        trackFleetSize: bool) -> bool:
+    logger = logging.getLogger()
 
     # Find the list of unmatching instances. The match is done both by
     # instance ID and IP, to avoid edge cases with recycled IPs on different
     # instance IDs
-    unmatchingInstances = list(filter(lambda i: not matchServiceInstanceInRunningInstances(i, runningInstances), serviceInstances))
+    with reconcilePhaseDurationMetric.labels(serviceId, "match").time(), ProfileSpan("match", service_id=serviceId) as span:
+        unmatchingInstances = list(filter(lambda i: not matchServiceInstanceInIndex(i, runningInstancesIndex), checkedInstances))
+        span.set(checked=len(checkedInstances), running=len(runningInstancesIndex), unmatched=len(unmatchingInstances))
+
+    if trackFleetSize:
+        runningInstancesMetric.labels(serviceId).set(sum(1 for i in checkedInstances if i.instanceId in runningInstancesIndex))
+        unmatchedInstancesMetric.labels(serviceId).set(len(unmatchingInstances))
 
     # Circuit breaker: ensure that we're not going to remove ALL instances
     # from the service
@@ -74,8 +233,153 @@ def unmapTerminatedInstancesFromService(serviceId: str, serviceRegion: str, inst
     logger.info(f"Found {len(unmatchingInstances)} instances in service {serviceId} not matching any running EC2 instance in {instancesRegions}")
 
     for unmatchingInstance in unmatchingInstances:
-        logger.warning(f"Deregistering instance {unmatchingInstance['Id']} from service {serviceId} because not matching any running EC2 instance in {instancesRegions}")
-        sdClient.deregister_instance(ServiceId=serviceId, InstanceId=unmatchingInstance["Id"])
+        logger.warning(f"Deregistering instance {unmatchingInstance.instanceId} from service {serviceId} because not matching any running EC2 instance in {instancesRegions}")
+
+    if not unmatchingInstances:
+        return True
+
+    # Deregister all instances concurrently and then wait until the async
+    # operations have been completed, to track the end-to-end removal latency
+    startTime = time.monotonic()
+
+    with reconcilePhaseDurationMetric.labels(serviceId, "deregister").time(), ProfileSpan("deregister", service_id=serviceId, deregistered=len(unmatchingInstances)):
+        results = deregisterServiceInstances(serviceId, [i.instanceId for i in unmatchingInstances], sdClient, deregisterConcurrency)
+
+        for instanceId, (_, error) in results.items():
+            if error:
+                logger.error(f"An error occurred while deregistering instance {instanceId} from service {serviceId}: {str(error)}")
+            else:
+                deregisteredInstancesMetric.labels(serviceId).inc()
+
+        operationIds = [operationId for operationId, _ in results.values() if operationId]
+        statuses = waitServiceOperations(operationIds, sdClient, operationTimeout, maxConcurrency=deregisterConcurrency)
+
+    # Instances deregistered without an operation ID have nothing to track
+    failedCount = sum(1 for _, error in results.values() if error) + sum(1 for status in statuses.values() if status == "FAIL")
+    pendingCount = sum(1 for status in statuses.values() if status not in ("SUCCESS", "FAIL"))
+    successCount = len(results) - failedCount - pendingCount
+
+    logger.info(f"Deregistered instances from service {serviceId} in {time.monotonic() - startTime:.3f} seconds: {successCount} succeeded, {failedCount} failed, {pendingCount} pending")
+
+    return failedCount == 0
+
+
+def listServicesInstancesToCheck(serviceIds: List[str], sdClient, onlyInstanceIds: Optional[Set[str]]) -> Tuple[Dict[str, Tuple[List[ServiceInstance], List[ServiceInstance]]], Dict[str, bool]]:
+    logger = logging.getLogger()
+
+    # List the instances registered to each service. A service failing or
+    # without instances to check doesn't prevent reconciling the others
+    servicesInstances = {}
+    results = {}
+
+    for serviceId in serviceIds:
+        try:
+            registeredCount, serviceInstances, checkedInstances = listServiceInstancesToCheck(serviceId, sdClient, onlyInstanceIds)
+        except Exception as error:
+            logger.error(f"An error occurred while reconciling service {serviceId}: {str(error)}")
+            results[serviceId] = False
+            continue
+
+        if not registeredCount:
+            logger.info(f"No registered instances in the service {serviceId}. Skipping")
+            results[serviceId] = True
+        elif onlyInstanceIds is not None and not checkedInstances:
+            logger.info(f"None of the instances {sorted(onlyInstanceIds)} is registered to the service {serviceId}. Skipping")
+            results[serviceId] = True
+        else:
+            servicesInstances[serviceId] = (serviceInstances, checkedInstances)
+
+    return servicesInstances, results
+
+
+def describeServicesRunningInstances(
+        servicesInstances: Dict[str, Tuple[List[ServiceInstance], List[ServiceInstance]]],
+        ec2Clients: Dict[str, object],
+        maxConcurrency: int,
+        describeBatchSize: int,
+        describeConcurrency: int,
+        instanceCache: Optional[EC2InstanceCache],
+        onlyInstanceIds: Optional[Set[str]],
+        instanceRegions: Optional[EC2InstanceRegions] = None) -> Dict[str, Set[str]]:
+    # Describe the union of the instances registered to all services once,
+    # so that every service is matched against this shared snapshot
+    startTime = time.monotonic()
+    checkedInstanceIds = list(dict.fromkeys(i.instanceId for _, checkedInstances in servicesInstances.values() for i in checkedInstances))
+    runningInstancesIndex = describeRunningInstances(
+        list(servicesInstances), checkedInstanceIds, ec2Clients, maxConcurrency, describeBatchSize, describeConcurrency, instanceCache, onlyInstanceIds is not None, instanceRegions)
+
+    for serviceId in servicesInstances:
+        reconcilePhaseDurationMetric.labels(serviceId, "describe_ec2_instances").observe(time.monotonic() - startTime)
+
+    return runningInstancesIndex
+
+
+def unmapServicesUnmatchingInstances(
+        servicesInstances: Dict[str, Tuple[List[ServiceInstance], List[ServiceInstance]]],
+        runningInstancesIndex: Dict[str, Set[str]],
+        sdClient,
+        serviceRegion: str,
+        instancesRegions: List[str],
+        deregisterConcurrency: int,
+        operationTimeout: float,
+        onlyInstanceIds: Optional[Set[str]]) -> Dict[str, bool]:
+    logger = logging.getLogger()
+    results = {}
+
+    # Match and deregister instances of each service
+    for serviceId, (serviceInstances, checkedInstances) in servicesInstances.items():
+        try:
+            results[serviceId] = unmapUnmatchingServiceInstances(
+                serviceId, serviceInstances, checkedInstances, runningInstancesIndex, sdClient, instancesRegions, deregisterConcurrency, operationTimeout, onlyInstanceIds is None)
+        except Exception as error:
+            logger.error(f"An error occurred while reconciling service {serviceId}: {str(error)}")
+            results[serviceId] = False
+
+        if results[serviceId]:
+            logger.info(f"Checked EC2 instances registered to service {serviceId} in {serviceRegion}")
+
+    return results
+
+
+def unmapTerminatedInstancesFromServices(
+        serviceIds: List[str],
+        serviceRegion: str,
+        instancesRegions: List[str],
+        maxConcurrency: int = 10,
+        describeBatchSize: int = 200,
+        describeConcurrency: int = 4,
+        deregisterConcurrency: int = 10,
+        operationTimeout: float = 60,
+        clientPool: AwsClientPool = None,
+        instanceIds: List[str] = None,
+        instanceCache: EC2InstanceCache = None,
+        instanceRegions: EC2InstanceRegions = None) -> Dict[str, bool]:
+    logger = logging.getLogger()
+    for serviceId in serviceIds:
+        logger.info(f"Checking EC2 instances registered to service {serviceId} in {serviceRegion}")
+
+    # Get clients from the pool (if not provided, clients are created for this reconcile only)
+    startTime = time.monotonic()
+
+    if clientPool is None:
+        clientPool = AwsClientPool(maxPoolConnections=max(10, describeConcurrency, deregisterConcurrency))
+
+    sdClient = clientPool.getClient("servicediscovery", serviceRegion)
+
+    logger.debug(f"Initialized AWS clients in {time.monotonic() - startTime:.3f} seconds")
+
+    onlyInstanceIds = None if instanceIds is None else set(instanceIds)
+    servicesInstances, results = listServicesInstancesToCheck(serviceIds, sdClient, onlyInstanceIds)
+
+    # EC2 clients are slow to create (on a cold start), so they're created only
+    # once there are instances to describe
+    if servicesInstances:
+        ec2Clients = {region: clientPool.getClient("ec2", region) for region in instancesRegions}
+        runningInstancesIndex = describeServicesRunningInstances(servicesInstances, ec2Clients, maxConcurrency, describeBatchSize, describeConcurrency, instanceCache, onlyInstanceIds, instanceRegions)
+        results.update(unmapServicesUnmatchingInstances(servicesInstances, runningInstancesIndex, sdClient, serviceRegion, instancesRegions, deregisterConcurrency, operationTimeout, onlyInstanceIds))
+
+    return results
+
 
-    logger.info(f"Checked EC2 instances registered to service {serviceId} in {serviceRegion}")
-    return True
+def unmapTerminatedInstancesFromService(serviceId: str, serviceRegion: str, instancesRegions: List[str], **kwargs) -> bool:
+    return unmapTerminatedInstancesFromServices([serviceId], serviceRegion, instancesRegions, **kwargs)[serviceId]
@@ -36,6 +36,7 @@ setup(
   entry_points = {
     'console_scripts': [
         'aws-cloud-unmap=cloudunmap.cli:run',
+        'aws-cloud-unmap-fake-aws=cloudunmap.fakeaws:run',
     ]
   }
 )
@@ -1,4 +1,8 @@
 import logging
+from cloudunmap.metrics import enableMetrics
 
 # Disable logging when running tests
 logging.disable(logging.CRITICAL)
+
+# Collect metrics, as when the Prometheus exporter is enabled
+enableMetrics()
@@ -1,6 +1,13 @@
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple, Union
 from unittest.mock import MagicMock
 
 
+# The instance state filter applied when describing EC2 instances to reconcile
+RUNNING_STATES_FILTER = {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}
+
+
 def mockBotoClient(clients):
     mock = MagicMock()
     mock.side_effect = lambda name, **kwargs: clients[name]
@@ -17,7 +24,7 @@ def mockServiceInstance(instanceId, ipv4=None):
     return instance
 
 
-def mockEC2Instance(instanceId, privateIp=None, publicIp=None, state="running"):
+def mockEC2Instance(instanceId, privateIp=None, publicIp=None, state="running", eniPrivateIps=None):
     instance = {"InstanceId": instanceId, "State": {"Name": state}}
 
     if privateIp:
@@ -26,4 +33,92 @@ def mockEC2Instance(instanceId, privateIp=None, publicIp=None, state="running"):
     if publicIp:
         instance["PublicIpAddress"] = publicIp
 
+    if eniPrivateIps:
+        instance["NetworkInterfaces"] = [{"PrivateIpAddresses": [{"PrivateIpAddress": ip} for ip in eniPrivateIps]}]
+
     return instance
+
+
+class MockPaginator:
+    def __init__(self, paginate):
+        self.paginate = paginate
+
+
+class MockServiceDiscoveryClient:
+    """
+    Fake Cloud Map client serving a (possibly huge) list of registered
+    instances, either shared by all services or keyed by service ID. Pages
+    are built on the fly, like the real client does.
+    """
+
+    def __init__(self, serviceInstances: Union[List[Tuple[str, str]], Dict[str, List[Tuple[str, str]]]]):
+        self.serviceInstances = serviceInstances
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _countCall(self, operationName):
+        with self._lock:
+            self.calls[operationName] += 1
+
+    def get_paginator(self, operationName):
+        return MockPaginator({"list_instances": self._paginateListInstances}[operationName])
+
+    def _paginateListInstances(self, ServiceId, PaginationConfig):
+        pageSize = PaginationConfig["PageSize"]
+        serviceInstances = self.serviceInstances[ServiceId] if isinstance(self.serviceInstances, dict) else self.serviceInstances
+
+        for offset in range(0, len(serviceInstances), pageSize):
+            self._countCall("ListInstances")
+            yield {"Instances": [mockServiceInstance(instanceId, ipv4) for instanceId, ipv4 in serviceInstances[offset:offset + pageSize]]}
+
+    def deregister_instance(self, ServiceId, InstanceId):
+        self._countCall("DeregisterInstance")
+        return {"OperationId": f"op-{InstanceId}"}
+
+    def get_operation(self, OperationId):
+        self._countCall("GetOperation")
+        return {"Operation": {"Id": OperationId, "Status": "SUCCESS"}}
+
+
+class MockEC2Client:
+    """
+    Fake EC2 client serving the instances of a region, described as
+    instance ID -> (private IP, public IP, state).
+    """
+
+    def __init__(self, ec2Instances: Dict[str, Tuple[str, str, str]]):
+        self.ec2Instances = ec2Instances
+        self.calls = Counter()
+        self.describedIds = Counter()
+        self._lock = threading.Lock()
+
+    def _countCall(self, operationName):
+        with self._lock:
+            self.calls[operationName] += 1
+
+    def get_paginator(self, operationName):
+        return MockPaginator({"describe_instances": self._paginateDescribeInstances}[operationName])
+
+    def _paginateDescribeInstances(self, Filters, PaginationConfig):
+        pageSize = PaginationConfig["PageSize"]
+        filters = {f["Name"]: f["Values"] for f in Filters}
+
+        with self._lock:
+            self.describedIds.update(filters["instance-id"])
+
+        instanceIds = [instanceId for instanceId in filters["instance-id"] if instanceId in self.ec2Instances]
+
+        if "instance-state-name" in filters:
+            instanceIds = [instanceId for instanceId in instanceIds if self.ec2Instances[instanceId][2] in filters["instance-state-name"]]
+
+        for offset in range(0, max(1, len(instanceIds)), pageSize):
+            self._countCall("DescribeInstances")
+            yield {"Reservations": [{"Instances": [mockEC2Instance(instanceId, *self.ec2Instances[instanceId]) for instanceId in instanceIds[offset:offset + pageSize]]}]}
+
+
+class MockClientPool:
+    def __init__(self, clients: Dict[Tuple[str, str], object]):
+        self.clients = clients
+
+    def getClient(self, serviceName, region, readTimeout=None):
+        return self.clients[(serviceName, region)]
@@ -1,8 +1,8 @@
 import unittest
 import boto3
 from botocore.stub import Stubber
-from cloudunmap.aws import listEC2InstancesById, listServiceInstances
-from .mocks import mockEC2Instance, mockServiceInstance
+from cloudunmap.aws import ServiceInstance, EC2Instance, getEC2InstanceIps, slimEC2Instance, slimServiceInstance, listNamespaceServiceIds, iterEC2InstancesById, iterServiceInstances, listEC2InstancesById, listServiceInstances, deregisterServiceInstances, waitServiceOperations
+from .mocks import mockEC2Instance, mockServiceInstance, MockEC2Client
 
 
 class TestAws(unittest.TestCase):
@@ -57,6 +57,154 @@ class TestAws(unittest.TestCase):
 
         stubber.assert_no_pending_responses()
 
+    def testListEC2InstancesByIdShouldSplitInstanceIdsInBatches(self):
+        ec2Client = boto3.client("ec2")
+
+        # Mock EC2 client
+        stubber = Stubber(ec2Client)
+        stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1"), mockEC2Instance("i-2", privateIp="172.0.0.2")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+        stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-3", privateIp="172.0.0.3")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-3"]}], "MaxResults": 1000})
+        stubber.activate()
+
+        instances = listEC2InstancesById(["i-1", "i-2", "i-3", "i-1"], ec2Client, batchSize=2)
+        self.assertEqual([i["InstanceId"] for i in instances], ["i-1", "i-2", "i-3"])
+
+        stubber.assert_no_pending_responses()
+
+    def testListEC2InstancesByIdShouldFetchBatchesConcurrentlyAndDeduplicateResults(self):
+        ec2Client = boto3.client("ec2")
+
+        # Mock EC2 client (batches may be fetched in any order)
+        stubber = Stubber(ec2Client)
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [mockEC2Instance("i-1"), mockEC2Instance("i-2")]}]})
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [mockEC2Instance("i-2"), mockEC2Instance("i-3")]}]})
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [mockEC2Instance("i-4")]}]})
+        stubber.activate()
+
+        instances = listEC2InstancesById(["i-1", "i-2", "i-3", "i-4", "i-5"], ec2Client, batchSize=2, maxConcurrency=3)
+        self.assertEqual(sorted([i["InstanceId"] for i in instances]), ["i-1", "i-2", "i-3", "i-4"])
+
+        stubber.assert_no_pending_responses()
+
+    def testListEC2InstancesByIdShouldFilterInstancesByStateServerSide(self):
+        ec2Client = boto3.client("ec2")
+
+        # Mock EC2 client
+        stubber = Stubber(ec2Client)
+        stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, {"Name": "instance-state-name", "Values": ["running"]}], "MaxResults": 1000})
+        stubber.activate()
+
+        instances = listEC2InstancesById(["i-1", "i-2"], ec2Client, states=["running"])
+        self.assertEqual([i["InstanceId"] for i in instances], ["i-1"])
+
+        stubber.assert_no_pending_responses()
+
+    def testListEC2InstancesByIdShouldReturnSlimInstancesIfRequested(self):
+        ec2Client = boto3.client("ec2")
+
+        # Mock EC2 client
+        stubber = Stubber(ec2Client)
+        stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1", publicIp="1.1.1.1", eniPrivateIps=["172.0.0.1", "172.0.1.1"])]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}], "MaxResults": 1000})
+        stubber.activate()
+
+        instances = listEC2InstancesById(["i-1"], ec2Client, slim=True)
+        self.assertEqual(instances, [EC2Instance("i-1", "running", ["1.1.1.1", "172.0.0.1", "172.0.0.1", "172.0.1.1"])])
+
+        stubber.assert_no_pending_responses()
+
+    def testListEC2InstancesByIdShouldNotCallTheAPIOnEmptyInstanceIds(self):
+        ec2Client = boto3.client("ec2")
+
+        # Mock EC2 client
+        stubber = Stubber(ec2Client)
+        stubber.activate()
+
+        self.assertEqual(listEC2InstancesById([], ec2Client), [])
+
+        stubber.assert_no_pending_responses()
+
+    #
+    # getEC2InstanceIps()
+    #
+
+    def testGetEC2InstanceIpsShouldReturnAllKnownIps(self):
+        self.assertEqual(getEC2InstanceIps(mockEC2Instance("i-1")), [])
+        self.assertEqual(getEC2InstanceIps(mockEC2Instance("i-1", privateIp="172.0.0.1")), ["172.0.0.1"])
+        self.assertEqual(getEC2InstanceIps(mockEC2Instance("i-1", privateIp="172.0.0.1", publicIp="1.1.1.1", eniPrivateIps=["172.0.1.1"])), ["1.1.1.1", "172.0.0.1", "172.0.1.1"])
+
+    #
+    # slimEC2Instance()
+    #
+
+    def testSlimEC2InstanceShouldKeepOnlyTheFieldsRequiredToMatch(self):
+        instance = mockEC2Instance("i-1", privateIp="172.0.0.1", state="stopped")
+        instance.update({"Tags": [{"Key": "Name", "Value": "web"}], "BlockDeviceMappings": [{"DeviceName": "/dev/xvda"}]})
+
+        self.assertEqual(slimEC2Instance(instance), EC2Instance("i-1", "stopped", ["172.0.0.1"]))
+
+    #
+    # slimServiceInstance()
+    #
+
+    def testSlimServiceInstanceShouldKeepOnlyTheFieldsRequiredToMatch(self):
+        self.assertEqual(slimServiceInstance(mockServiceInstance("i-1", "172.0.0.1")), ServiceInstance("i-1", "172.0.0.1"))
+        self.assertEqual(slimServiceInstance(mockServiceInstance("i-2")), ServiceInstance("i-2", None))
+
+        # Records don't have a dict
+        with self.assertRaises(AttributeError):
+            ServiceInstance("i-1", "172.0.0.1").port = 80
+
+    #
+    # iterEC2InstancesById()
+    #
+
+    def testIterEC2InstancesByIdShouldDescribeInstancesOnlyWhenConsumed(self):
+        ec2Client = MockEC2Client({"i-1": ("172.0.0.1", None, "running"), "i-2": ("172.0.0.2", None, "running")})
+
+        instances = iterEC2InstancesById(["i-1", "i-2", "i-3"], ec2Client, batchSize=2)
+        self.assertEqual(ec2Client.calls["DescribeInstances"], 0)
+
+        self.assertEqual(next(instances)["InstanceId"], "i-1")
+        self.assertEqual(ec2Client.calls["DescribeInstances"], 1)
+
+        self.assertEqual([i["InstanceId"] for i in instances], ["i-2"])
+        self.assertEqual(ec2Client.calls["DescribeInstances"], 2)
+
+    #
+    # iterServiceInstances()
+    #
+
+    def testIterServiceInstancesShouldStreamAllPages(self):
+        sdClient = boto3.client("servicediscovery")
+
+        # Mock Cloud Map client
+        stubber = Stubber(sdClient)
+        stubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", ipv4="172.0.0.1")], "NextToken": "page-2"},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        stubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-2", ipv4="2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100, "NextToken": "page-2"})
+        stubber.activate()
+
+        self.assertEqual(list(iterServiceInstances("srv-1", sdClient, slim=True)), [ServiceInstance("i-1", "172.0.0.1"), ServiceInstance("i-2", "2.2.2.2")])
+
+        stubber.assert_no_pending_responses()
+
     #
     # listServiceInstances()
     #
@@ -91,3 +239,74 @@ class TestAws(unittest.TestCase):
             listServiceInstances("srv-1", sdClient)
 
         stubber.assert_no_pending_responses()
+
+    #
+    # listNamespaceServiceIds()
+    #
+
+    def testListNamespaceServiceIdsShouldReturnServicesInTheNamespace(self):
+        sdClient = boto3.client("servicediscovery")
+
+        # Mock Cloud Map client
+        stubber = Stubber(sdClient)
+        stubber.add_response(
+            "list_services",
+            {"Services": [{"Id": "srv-1"}, {"Id": "srv-2"}]},
+            {"Filters": [{"Name": "NAMESPACE_ID", "Values": ["ns-1"], "Condition": "EQ"}], "MaxResults": 100})
+        stubber.activate()
+
+        self.assertEqual(listNamespaceServiceIds("ns-1", sdClient), ["srv-1", "srv-2"])
+
+        stubber.assert_no_pending_responses()
+
+    #
+    # deregisterServiceInstances()
+    #
+
+    def testDeregisterServiceInstancesShouldReturnOperationIdsAndErrors(self):
+        sdClient = boto3.client("servicediscovery")
+
+        # Mock Cloud Map client
+        stubber = Stubber(sdClient)
+        stubber.add_response("deregister_instance", {"OperationId": "op-1"}, {"ServiceId": "srv-1", "InstanceId": "i-1"})
+        stubber.add_client_error("deregister_instance", expected_params={"ServiceId": "srv-1", "InstanceId": "i-2"})
+        stubber.activate()
+
+        results = deregisterServiceInstances("srv-1", ["i-1", "i-2"], sdClient)
+        self.assertEqual(results["i-1"], ("op-1", None))
+        self.assertIsNone(results["i-2"][0])
+        self.assertIsInstance(results["i-2"][1], Exception)
+
+        stubber.assert_no_pending_responses()
+
+    #
+    # waitServiceOperations()
+    #
+
+    def testWaitServiceOperationsShouldPollPendingOperationsUntilCompleted(self):
+        sdClient = boto3.client("servicediscovery")
+
+        # Mock Cloud Map client
+        stubber = Stubber(sdClient)
+        stubber.add_response("get_operation", {"Operation": {"Id": "op-1", "Status": "PENDING"}}, {"OperationId": "op-1"})
+        stubber.add_response("get_operation", {"Operation": {"Id": "op-2", "Status": "SUCCESS"}}, {"OperationId": "op-2"})
+        stubber.add_response("get_operation", {"Operation": {"Id": "op-1", "Status": "FAIL"}}, {"OperationId": "op-1"})
+        stubber.activate()
+
+        statuses = waitServiceOperations(["op-1", "op-2"], sdClient, timeout=5, interval=0.01)
+        self.assertEqual(statuses, {"op-1": "FAIL", "op-2": "SUCCESS"})
+
+        stubber.assert_no_pending_responses()
+
+    def testWaitServiceOperationsShouldStopPollingOnTimeout(self):
+        sdClient = boto3.client("servicediscovery")
+
+        # Mock Cloud Map client
+        stubber = Stubber(sdClient)
+        stubber.add_response("get_operation", {"Operation": {"Id": "op-1", "Status": "PENDING"}}, {"OperationId": "op-1"})
+        stubber.activate()
+
+        statuses = waitServiceOperations(["op-1"], sdClient, timeout=0, interval=0.01)
+        self.assertEqual(statuses, {"op-1": "PENDING"})
+
+        stubber.assert_no_pending_responses()
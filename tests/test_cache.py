@@ -0,0 +1,83 @@
+import unittest
+from unittest.mock import patch
+from cloudunmap.cache import EC2InstanceCache, EC2InstanceRegions
+
+
+class TestCache(unittest.TestCase):
+    #
+    # EC2InstanceCache.get()
+    #
+
+    def testGetShouldReturnCachedInstancesAndMissingIds(self):
+        cache = EC2InstanceCache(ttl=60)
+        cache.put({"i-1": {"172.0.0.1"}})
+
+        cachedIndex, missingIds = cache.get(["i-1", "i-2"])
+        self.assertEqual(cachedIndex, {"i-1": {"172.0.0.1"}})
+        self.assertEqual(missingIds, ["i-2"])
+
+    def testGetShouldNotReturnExpiredInstances(self):
+        cache = EC2InstanceCache(ttl=60)
+
+        with patch("time.monotonic", return_value=100):
+            cache.put({"i-1": {"172.0.0.1"}})
+
+        with patch("time.monotonic", return_value=159):
+            self.assertEqual(cache.get(["i-1"])[1], [])
+
+        with patch("time.monotonic", return_value=160):
+            self.assertEqual(cache.get(["i-1"])[1], ["i-1"])
+
+    #
+    # EC2InstanceCache.invalidate()
+    #
+
+    def testInvalidateShouldDropInstances(self):
+        cache = EC2InstanceCache(ttl=60)
+        cache.put({"i-1": set(), "i-2": set()})
+        cache.invalidate(["i-1", "i-3"])
+
+        self.assertEqual(cache.get(["i-1", "i-2"])[1], ["i-1"])
+        self.assertEqual(len(cache), 1)
+
+    #
+    # EC2InstanceCache.startCycle()
+    #
+
+    def testStartCycleShouldForceAFullResyncEveryNCycles(self):
+        cache = EC2InstanceCache(ttl=60, fullResyncEvery=3)
+        results = []
+
+        for _ in range(7):
+            results.append(cache.startCycle())
+            cache.put({"i-1": set()})
+
+        self.assertEqual(results, [True, False, False, True, False, False, True])
+
+        cache.put({"i-1": set()})
+        self.assertFalse(cache.startCycle())
+        self.assertEqual(len(cache), 1)
+        self.assertFalse(cache.startCycle())
+        self.assertTrue(cache.startCycle())
+        self.assertEqual(len(cache), 0)
+
+    def testStartCycleShouldNeverForceAFullResyncIfDisabled(self):
+        cache = EC2InstanceCache(ttl=60)
+
+        self.assertEqual([cache.startCycle() for _ in range(3)], [False, False, False])
+
+    #
+    # EC2InstanceRegions
+    #
+
+    def testInstanceRegionsShouldRememberAndForgetTheRegionOfInstances(self):
+        instanceRegions = EC2InstanceRegions()
+        instanceRegions.put({"i-1": "eu-west-1", "i-2": "us-east-1"})
+
+        self.assertEqual(instanceRegions.get("i-1"), "eu-west-1")
+        self.assertEqual(instanceRegions.get("i-2"), "us-east-1")
+        self.assertIsNone(instanceRegions.get("i-3"))
+
+        instanceRegions.forget(["i-1", "i-3"])
+        self.assertIsNone(instanceRegions.get("i-1"))
+        self.assertEqual(len(instanceRegions), 1)
@@ -1,10 +1,15 @@
+import os
+import tempfile
 import unittest
 import boto3
 import time
 from unittest.mock import patch
 from botocore.stub import Stubber
-from cloudunmap.cli import main, parseArguments, upMetric, lastReconcileTimestampMetric
-from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance
+from cloudunmap.cli import main, parseArguments, createClientPool, createEventsQueueClient
+from cloudunmap.events import RECEIVE_WAIT_TIME
+from cloudunmap.sharding import hashKey
+from cloudunmap.metrics import upMetric, lastReconcileTimestampMetric
+from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance, RUNNING_STATES_FILTER
 from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
 
 
@@ -21,16 +26,22 @@ class TestCli(unittest.TestCase):
 
         self.botoClientMock = mockBotoClient({"ec2": self.ec2Client, "servicediscovery": self.sdClient})
 
-        try:
-            lastReconcileTimestampMetric.remove("srv-1")
-            upMetric.remove("srv-1")
-        except KeyError:
-            pass
+        for serviceId in ["srv-1", "srv-2"]:
+            try:
+                lastReconcileTimestampMetric.remove(serviceId)
+                upMetric.remove(serviceId)
+            except KeyError:
+                pass
+
     #
     # main()
     #
 
     def testMainShouldReconcileService(self):
+        deregisteredCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}) or 0
+        reconcilesCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", labels={"service_id": "srv-1"}) or 0
+        describesCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_describe_instances_duration_seconds_count", labels={"service_id": "srv-1", "region": "eu-west-1"}) or 0
+
         # Mock Cloud Map client
         self.sdStubber.add_response(
             "list_instances",
@@ -47,7 +58,7 @@ class TestCli(unittest.TestCase):
             {"Reservations": [{"Instances": [
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             main(parseArguments(["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1", "--single-run"]))
@@ -55,6 +66,16 @@ class TestCli(unittest.TestCase):
         # Check exported metrics
         self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_up", labels={"service_id": "srv-1"}), 1)
         self.assertAlmostEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_last_reconcile_success_timestamp_seconds", labels={"service_id": "srv-1"}), time.time(), delta=2)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_registered_instances", labels={"service_id": "srv-1"}), 2)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_skipped_instances", labels={"service_id": "srv-1"}), 0)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_running_instances", labels={"service_id": "srv-1"}), 1)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_unmatched_instances", labels={"service_id": "srv-1"}), 1)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}), deregisteredCount + 1)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", labels={"service_id": "srv-1"}), reconcilesCount + 1)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_describe_instances_duration_seconds_count", labels={"service_id": "srv-1", "region": "eu-west-1"}), describesCount + 1)
+
+        for phase in ["list_service_instances", "describe_ec2_instances", "match", "deregister"]:
+            self.assertIsNotNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_phase_duration_seconds_count", labels={"service_id": "srv-1", "phase": phase}))
 
         self.ec2Stubber.assert_no_pending_responses()
         self.sdStubber.assert_no_pending_responses()
@@ -84,7 +105,7 @@ class TestCli(unittest.TestCase):
         self.ec2Stubber.add_response(
             "describe_instances",
             {"Reservations": []},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             main(parseArguments(["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1", "--single-run"]))
@@ -112,3 +133,210 @@ class TestCli(unittest.TestCase):
 
         self.ec2Stubber.assert_no_pending_responses()
         self.sdStubber.assert_no_pending_responses()
+
+    def testMainShouldReconcileAllServicesInNamespace(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_services",
+            {"Services": [{"Id": "srv-1"}, {"Id": "srv-2"}]},
+            {"Filters": [{"Name": "NAMESPACE_ID", "Values": ["ns-1"], "Condition": "EQ"}], "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-2", "MaxResults": 100})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            main(parseArguments(["--namespace-id", "ns-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1", "--single-run"]))
+
+        # Check exported metrics
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_up", labels={"service_id": "srv-1"}), 1)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_up", labels={"service_id": "srv-2"}), 1)
+        self.assertAlmostEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_last_reconcile_success_timestamp_seconds", labels={"service_id": "srv-1"}), time.time(), delta=2)
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_last_reconcile_success_timestamp_seconds", labels={"service_id": "srv-2"}))
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testMainShouldReconcileOnlyTheServicesOfItsShard(self):
+        shardIndex = hashKey("srv-1") % 2
+        self.assertNotEqual(hashKey("srv-3") % 2, shardIndex)
+
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_services",
+            {"Services": [{"Id": "srv-1"}, {"Id": "srv-3"}]},
+            {"Filters": [{"Name": "NAMESPACE_ID", "Values": ["ns-1"], "Condition": "EQ"}], "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            main(parseArguments(["--namespace-id", "ns-1", "--shard-index", str(shardIndex), "--shard-count", "2", "--service-region", "eu-west-1", "--instances-region", "eu-west-1", "--single-run"]))
+
+        # Check exported metrics
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_up", labels={"service_id": "srv-1"}), 1)
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_up", labels={"service_id": "srv-3"}))
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_owned_services"), 1)
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testMainShouldReplayARecordedSnapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshotPath = os.path.join(directory.name, "snapshot.jsonl.gz")
+        args = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        # Responses are recorded by region, so the mocked clients must be in the requested one
+        self.sdClient = boto3.client("servicediscovery", region_name="eu-west-1")
+        self.sdStubber = Stubber(self.sdClient)
+        self.sdStubber.activate()
+
+        self.ec2Client = boto3.client("ec2", region_name="eu-west-1")
+        self.ec2Stubber = Stubber(self.ec2Client)
+        self.ec2Stubber.activate()
+
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-1", "InstanceId": "i-2"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=mockBotoClient({"ec2": self.ec2Client, "servicediscovery": self.sdClient})):
+            main(parseArguments(args + ["--single-run", "--record-snapshot", snapshotPath]))
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+        # Replay the snapshot, without any mocked client
+        deregisteredCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"})
+
+        main(parseArguments(args + ["--replay-snapshot", snapshotPath]))
+
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}), deregisteredCount + 1)
+        self.assertGreater(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_last_reconcile_success_timestamp_seconds", labels={"service_id": "srv-1"}), 0)
+
+    #
+    # createClientPool()
+    #
+
+    def testCreateClientPoolShouldSizeTheConnectionsPoolForConcurrentReconciles(self):
+        args = parseArguments([
+            "--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1",
+            "--max-concurrent-reconciles", "4", "--describe-concurrency", "2", "--deregister-concurrency", "10"])
+
+        with patch("boto3.client") as clientMock:
+            createClientPool(args).getClient("servicediscovery", "eu-west-1")
+
+            self.assertEqual(clientMock.call_args.kwargs["config"].max_pool_connections, 50)
+
+    #
+    # createEventsQueueClient()
+    #
+
+    def testCreateEventsQueueClientShouldOutlastTheLongPolling(self):
+        args = parseArguments([
+            "--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1",
+            "--events-queue-url", "https://sqs.eu-west-1.amazonaws.com/123456789012/events"])
+        clientPool = createClientPool(args)
+
+        with patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "fake", "AWS_SECRET_ACCESS_KEY": "fake"}):
+            sqsClient = createEventsQueueClient(args, clientPool)
+
+            self.assertGreater(sqsClient.meta.config.read_timeout, RECEIVE_WAIT_TIME)
+            self.assertEqual(sqsClient.meta.region_name, "eu-west-1")
+
+            # Other clients keep the default read timeout
+            self.assertEqual(clientPool.getClient("servicediscovery", "eu-west-1").meta.config.read_timeout, 15)
+
+    #
+    # parseArguments()
+    #
+
+    def testParseArgumentsShouldRejectInvalidSharding(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--shard-index", "2", "--shard-count", "2"])
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--shard-count", "2", "--lease-file", "/tmp/leases"])
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--shard-count", "2", "--events-queue-url", "https://sqs.eu-west-1.amazonaws.com/123456789012/events"])
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--lease-file", "/tmp/leases", "--events-queue-url", "https://sqs.eu-west-1.amazonaws.com/123456789012/events"])
+
+    def testParseArgumentsShouldRequireASingleRunToRecordASnapshot(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--record-snapshot", "/tmp/snapshot.jsonl.gz"])
+
+        self.assertEqual(parseArguments(requiredArgs + ["--single-run", "--record-snapshot", "/tmp/snapshot.jsonl.gz"]).record_snapshot, "/tmp/snapshot.jsonl.gz")
+
+    def testParseArgumentsShouldRequireASingleRunToProfileCalls(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--profile-output", "/tmp/reconcile.prof"])
+
+        self.assertEqual(parseArguments(requiredArgs + ["--single-run", "--profile-output", "/tmp/reconcile.prof"]).profile_output, "/tmp/reconcile.prof")
+
+    def testParseArgumentsShouldRequirePrometheusToEnableTheReconcileEndpoint(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--enable-reconcile-endpoint"])
+
+        self.assertTrue(parseArguments(requiredArgs + ["--enable-prometheus", "--enable-reconcile-endpoint"]).enable_reconcile_endpoint)
+
+    def testParseArgumentsShouldRequireARoleToAssumeInAccountTargets(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--instances-region", "eu-west-1", "123456789012:eu-west-1"])
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--instances-region", "eu_west_1", "--assume-role-name", "cloud-unmap"])
+
+        args = parseArguments(requiredArgs + ["--instances-region", "eu-west-1", "123456789012:eu-west-1", "--assume-role-name", "cloud-unmap"])
+        self.assertEqual(args.instances_region, ["eu-west-1", "123456789012:eu-west-1"])
+
+    def testParseArgumentsShouldRejectRoleDurationsShorterThanTheSTSMinimum(self):
+        requiredArgs = ["--service-id", "srv-1", "--service-region", "eu-west-1", "--instances-region", "eu-west-1"]
+
+        with patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                parseArguments(requiredArgs + ["--assume-role-duration", "899"])
+
+        self.assertEqual(parseArguments(requiredArgs + ["--assume-role-duration", "900"]).assume_role_duration, 900)
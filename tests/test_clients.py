@@ -0,0 +1,91 @@
+import datetime
+import unittest
+import boto3
+from unittest.mock import MagicMock, patch
+from botocore.stub import Stubber
+from cloudunmap.clients import AwsClientPool
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+from .mocks import mockBotoClient
+
+
+class TestClients(unittest.TestCase):
+    #
+    # AwsClientPool.getClient()
+    #
+
+    def testGetClientShouldReuseClientsByServiceAndRegion(self):
+        pool = AwsClientPool()
+
+        with patch("boto3.client", side_effect=lambda name, **kwargs: MagicMock()) as clientMock:
+            ec2Client = pool.getClient("ec2", "eu-west-1")
+
+            self.assertIs(pool.getClient("ec2", "eu-west-1"), ec2Client)
+            self.assertIsNot(pool.getClient("ec2", "us-east-1"), ec2Client)
+            self.assertIsNot(pool.getClient("servicediscovery", "eu-west-1"), ec2Client)
+            self.assertEqual(clientMock.call_count, 3)
+
+    def testGetClientShouldSizeTheConnectionsPool(self):
+        pool = AwsClientPool(maxPoolConnections=25)
+
+        with patch("boto3.client") as clientMock:
+            pool.getClient("ec2", "eu-west-1")
+
+            self.assertEqual(clientMock.call_args.kwargs["region_name"], "eu-west-1")
+            self.assertEqual(clientMock.call_args.kwargs["config"].max_pool_connections, 25)
+
+    def testGetClientShouldOverrideTheEndpointUrl(self):
+        pool = AwsClientPool(endpointUrl="http://127.0.0.1:4566")
+
+        with patch("boto3.client") as clientMock:
+            pool.getClient("ec2", "eu-west-1")
+
+            self.assertEqual(clientMock.call_args.kwargs["endpoint_url"], "http://127.0.0.1:4566")
+
+    def testGetClientShouldConfigureRetries(self):
+        pool = AwsClientPool(retryMode="adaptive", maxAttempts=5)
+
+        with patch("boto3.client") as clientMock:
+            pool.getClient("ec2", "eu-west-1")
+
+            self.assertEqual(clientMock.call_args.kwargs["config"].retries, {"mode": "adaptive", "max_attempts": 5})
+
+    def testGetClientShouldAssumeARoleInTheAccountOfTheTarget(self):
+        pool = AwsClientPool(assumeRoleName="cloud-unmap", stsRegion="eu-west-1")
+        stsClient = boto3.client("sts", region_name="eu-west-1")
+
+        with Stubber(stsClient) as stsStubber, patch("boto3.client", side_effect=mockBotoClient({"sts": stsClient})):
+            stsStubber.add_response(
+                "assume_role",
+                {"Credentials": {"AccessKeyId": "ASIAFAKEACCESSKEY1", "SecretAccessKey": "secret", "SessionToken": "token", "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}},
+                {"RoleArn": "arn:aws:iam::123456789012:role/cloud-unmap", "RoleSessionName": "aws-cloud-unmap", "DurationSeconds": 3600})
+
+            euClient = pool.getClient("ec2", "123456789012:eu-west-1")
+            usClient = pool.getClient("ec2", "123456789012:us-east-1")
+
+            # The clients of an account share the credentials of the role, assumed once
+            self.assertEqual(euClient.meta.region_name, "eu-west-1")
+            self.assertEqual(usClient.meta.region_name, "us-east-1")
+            self.assertIs(pool.getClient("ec2", "123456789012:eu-west-1"), euClient)
+            self.assertEqual(euClient._request_signer._credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+            self.assertEqual(usClient._request_signer._credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+
+            stsStubber.assert_no_pending_responses()
+
+    def testGetClientShouldRequireARoleToAssumeInAccountTargets(self):
+        with self.assertRaises(ValueError):
+            AwsClientPool().getClient("ec2", "123456789012:eu-west-1")
+
+    def testGetClientShouldTrackMetricsAndRateLimitsByAccountTarget(self):
+        rateLimiter = MagicMock()
+        pool = AwsClientPool(rateLimiter=rateLimiter, assumeRoleName="cloud-unmap", stsRegion="eu-west-1")
+        labels = {"operation": "DescribeInstances", "region": "123456789012:eu-west-1"}
+        callsCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_aws_api_calls_total", labels) or 0
+
+        ec2Client = pool.getClient("ec2", "123456789012:eu-west-1")
+        rateLimiter.attachClient.assert_called_once_with(ec2Client, "123456789012:eu-west-1")
+
+        with Stubber(ec2Client) as ec2Stubber:
+            ec2Stubber.add_response("describe_instances", {"Reservations": []})
+            ec2Client.describe_instances()
+
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_aws_api_calls_total", labels), callsCount + 1)
@@ -0,0 +1,91 @@
+import datetime
+import unittest
+import boto3
+from unittest.mock import patch
+from botocore.stub import Stubber
+from cloudunmap.credentials import AssumeRoleCredentialsCache, parseInstancesTarget
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/cloud-unmap"
+
+
+class TestCredentials(unittest.TestCase):
+    def setUp(self):
+        self.stsClient = boto3.client("sts", region_name="eu-west-1")
+        self.stsStubber = Stubber(self.stsClient)
+        self.stsStubber.activate()
+
+    def mockAssumeRole(self, accessKeyId, expiresIn, durationSeconds=3600):
+        self.stsStubber.add_response(
+            "assume_role",
+            {"Credentials": {
+                "AccessKeyId": accessKeyId,
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expiresIn)}},
+            {"RoleArn": ROLE_ARN, "RoleSessionName": "aws-cloud-unmap", "DurationSeconds": durationSeconds})
+
+    #
+    # parseInstancesTarget()
+    #
+
+    def testParseInstancesTargetShouldSupportRegionsAndAccountTargets(self):
+        self.assertEqual(parseInstancesTarget("eu-west-1"), (None, "eu-west-1"))
+        self.assertEqual(parseInstancesTarget("123456789012:eu-west-1"), ("123456789012", "eu-west-1"))
+
+        for target in ["", "1234:eu-west-1", "123456789012:", "arn:aws:iam::123456789012:role/cloud-unmap"]:
+            with self.assertRaises(ValueError):
+                parseInstancesTarget(target)
+
+    #
+    # AssumeRoleCredentialsCache
+    #
+
+    def testGetCredentialsShouldAssumeTheRoleOnFirstUse(self):
+        cache = AssumeRoleCredentialsCache(lambda: self.stsClient)
+        credentials = cache.getCredentials(ROLE_ARN)
+
+        # The role is not assumed until the credentials are used
+        self.stsStubber.assert_no_pending_responses()
+        self.mockAssumeRole("ASIAFAKEACCESSKEY1", 3600)
+
+        self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+        self.assertEqual(credentials.get_frozen_credentials().token, "token")
+        self.assertIs(cache.getCredentials(ROLE_ARN), credentials)
+        self.stsStubber.assert_no_pending_responses()
+
+    def testGetCredentialsShouldAssumeTheRoleAgainOnlyNearExpiry(self):
+        cache = AssumeRoleCredentialsCache(lambda: self.stsClient)
+        credentials = cache.getCredentials(ROLE_ARN)
+        self.mockAssumeRole("ASIAFAKEACCESSKEY1", 3600)
+        self.mockAssumeRole("ASIAFAKEACCESSKEY2", 3600)
+
+        self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+
+        # Credentials are reused until they're about to expire
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        with patch.object(credentials, "_time_fetcher", return_value=now + datetime.timedelta(minutes=30)):
+            self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+        with patch.object(credentials, "_time_fetcher", return_value=now + datetime.timedelta(minutes=55)):
+            self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY2")
+
+        self.stsStubber.assert_no_pending_responses()
+
+    def testGetCredentialsShouldReuseShortLivedCredentials(self):
+        cache = AssumeRoleCredentialsCache(lambda: self.stsClient, durationSeconds=900)
+        credentials = cache.getCredentials(ROLE_ARN)
+        self.mockAssumeRole("ASIAFAKEACCESSKEY1", 900, durationSeconds=900)
+        self.mockAssumeRole("ASIAFAKEACCESSKEY2", 900, durationSeconds=900)
+
+        for _ in range(5):
+            self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+
+        # Credentials are refreshed within a quarter of their duration
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        with patch.object(credentials, "_time_fetcher", return_value=now + datetime.timedelta(minutes=10)):
+            self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY1")
+        with patch.object(credentials, "_time_fetcher", return_value=now + datetime.timedelta(minutes=12)):
+            self.assertEqual(credentials.get_frozen_credentials().access_key, "ASIAFAKEACCESSKEY2")
+
+        self.stsStubber.assert_no_pending_responses()
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+import unittest
+from cloudunmap.engine import ReconcileEngine, nextReconcileInterval
+from cloudunmap.metrics import lastReconcileTimestampMetric, reconcileDurationMetric, reconcileIntervalMetric
+from .mocks import MockServiceDiscoveryClient, MockEC2Client, MockClientPool
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+
+
+class TestEngine(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sdClient = MockServiceDiscoveryClient({
+            "srv-1": [("i-1", "172.0.0.1"), ("i-2", "172.0.0.2")],
+            "srv-2": [("i-3", "172.0.0.3"), ("i-4", "172.0.0.4")]})
+
+        self.ec2Client = MockEC2Client({
+            "i-1": ("172.0.0.1", None, "running"),
+            "i-3": ("172.0.0.3", None, "running"),
+            "i-4": ("172.0.0.4", None, "running")})
+
+        self.clientPool = MockClientPool({
+            ("servicediscovery", "us-east-1"): self.sdClient,
+            ("ec2", "us-east-1"): self.ec2Client})
+
+        for serviceId in ["srv-1", "srv-2"]:
+            for metric in [lastReconcileTimestampMetric, reconcileDurationMetric, reconcileIntervalMetric]:
+                try:
+                    metric.remove(serviceId)
+                except KeyError:
+                    pass
+
+    def createEngine(self, **kwargs):
+        options = {"frequency": 60, "jitter": 0, "describeWindow": 0.01, "operationTimeout": 1}
+        options.update(kwargs)
+
+        return ReconcileEngine("us-east-1", ["us-east-1"], self.clientPool, **options)
+
+    #
+    # nextReconcileInterval()
+    #
+
+    def testNextReconcileIntervalShouldDropToTheMinimumOnChanges(self):
+        self.assertEqual(nextReconcileInterval(240, True, 30, 600), 30)
+
+    def testNextReconcileIntervalShouldBackOffExponentiallyUpToTheMaximum(self):
+        self.assertEqual(nextReconcileInterval(30, False, 30, 600), 60)
+        self.assertEqual(nextReconcileInterval(480, False, 30, 600), 600)
+        self.assertEqual(nextReconcileInterval(600, False, 30, 600), 600)
+
+    #
+    # reconcileService()
+    #
+
+    async def testReconcileServiceShouldDeregisterInstancesNotRunning(self):
+        engine = self.createEngine()
+        engine.setServices(["srv-1"])
+
+        self.assertTrue(await engine.reconcileService("srv-1"))
+        self.assertEqual(self.sdClient.calls["DeregisterInstance"], 1)
+        self.assertGreater(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_last_reconcile_success_timestamp_seconds", {"service_id": "srv-1"}), 0)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}), 1)
+
+    async def testReconcileServiceShouldLogTheServiceBeingChecked(self):
+        logging.disable(logging.NOTSET)
+        self.addCleanup(logging.disable, logging.CRITICAL)
+
+        engine = self.createEngine()
+        engine.setServices(["srv-1"])
+
+        with self.assertLogs(level="INFO") as logs:
+            self.assertTrue(await engine.reconcileService("srv-1"))
+
+        self.assertIn("Checking EC2 instances registered to service srv-1 in us-east-1", [record.getMessage() for record in logs.records])
+
+    async def testReconcileServiceShouldNotReportAFailedListingAsChanged(self):
+        engine = self.createEngine()
+        engine.setServices(["srv-2"])
+
+        # The second listing fails
+        paginateListInstances = self.sdClient._paginateListInstances
+        listings = []
+
+        def _paginate_list_instances(**kwargs):
+            listings.append(True)
+
+            if len(listings) == 2:
+                raise Exception("Throttled")
+
+            return paginateListInstances(**kwargs)
+
+        self.sdClient._paginateListInstances = _paginate_list_instances
+
+        self.assertEqual(await engine._reconcileService("srv-2", None), (True, False))
+        self.assertEqual(await engine._reconcileService("srv-2", None), (False, False))
+        self.assertEqual(await engine._reconcileService("srv-2", None), (True, False))
+
+    async def testReconcileServiceShouldShareTheDescribeOfConcurrentServices(self):
+        engine = self.createEngine(describeWindow=0.1)
+        engine.setServices(["srv-1", "srv-2"])
+
+        results = await asyncio.gather(engine.reconcileService("srv-1"), engine.reconcileService("srv-2"))
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.ec2Client.calls["DescribeInstances"], 1)
+        self.assertEqual(self.sdClient.calls["DeregisterInstance"], 1)
+
+    async def testReconcileServiceShouldNotStartNextPhaseOnceStopped(self):
+        engine = self.createEngine()
+        engine.setServices(["srv-1"])
+        engine.stop()
+
+        self.assertFalse(await engine.reconcileService("srv-1"))
+        self.assertEqual(self.ec2Client.calls["DescribeInstances"], 0)
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}))
+
+    #
+    # reconcileInstances()
+    #
+
+    async def testReconcileInstancesShouldOnlyCheckTheInputInstances(self):
+        engine = self.createEngine()
+        engine.setServices(["srv-1", "srv-2"])
+
+        self.assertTrue(await engine.reconcileInstances(["i-1", "i-3"]))
+        self.assertEqual(self.sdClient.calls["DeregisterInstance"], 0)
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}))
+
+    async def testReconcileInstancesShouldFailUntilTheServicesAreSet(self):
+        engine = self.createEngine()
+
+        self.assertFalse(await engine.reconcileInstances(["i-2"]))
+        self.assertEqual(self.sdClient.calls["ListInstances"], 0)
+
+        engine.setServices([])
+        self.assertTrue(await engine.reconcileInstances(["i-2"]))
+
+    #
+    # run()
+    #
+
+    async def testRunShouldReconcileEachServiceUntilStopped(self):
+        engine = self.createEngine(frequency=0.05)
+        engine.setServices(["srv-1", "srv-2"])
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.3)
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        self.assertGreaterEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}), 2)
+        self.assertGreaterEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-2"}), 2)
+
+    async def testSetServicesShouldStopReconcilingRemovedServices(self):
+        engine = self.createEngine(frequency=0.05)
+        engine.setServices(["srv-1", "srv-2"])
+        engine.setServices(["srv-2"])
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.2)
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}))
+        self.assertGreaterEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-2"}), 1)
+
+    async def testRunShouldAdaptTheIntervalOfEachServiceToTheObservedChanges(self):
+        engine = self.createEngine(frequency=1, minFrequency=0.5, maxFrequency=10)
+        engine.setServices(["srv-1", "srv-2"])
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.2)
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        # srv-1 has an instance not running, while srv-2 has not changed
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_interval_seconds", {"service_id": "srv-1"}), 0.5)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_interval_seconds", {"service_id": "srv-2"}), 2)
+
+    async def testRunShouldReconcileAllServicesOnceOnCoalescedTriggers(self):
+        engine = self.createEngine(frequency=60, triggerWindow=0.05)
+        engine.setServices(["srv-1", "srv-2"])
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sdClient.calls["ListInstances"], 2)
+
+        # A burst of triggers starts a single reconcile of each service
+        self.assertTrue(engine.trigger("http"))
+        self.assertFalse(engine.trigger("sighup"))
+        self.assertFalse(engine.trigger("http"))
+        await asyncio.sleep(0.2)
+
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        self.assertEqual(self.sdClient.calls["ListInstances"], 4)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_duration_seconds_count", {"service_id": "srv-1"}), 2)
+
+    async def testRunShouldReconcileAgainOnTriggersWhileReconciling(self):
+        engine = self.createEngine(frequency=60, triggerWindow=0)
+        engine.setServices(["srv-1"])
+
+        # The trigger fires while the first reconcile is listing the instances
+        loop = asyncio.get_running_loop()
+        paginateListInstances = self.sdClient._paginateListInstances
+
+        def _paginate_list_instances(**kwargs):
+            if self.sdClient.calls["ListInstances"] == 0:
+                loop.call_soon_threadsafe(engine.trigger, "http")
+                time.sleep(0.05)
+
+            return paginateListInstances(**kwargs)
+
+        self.sdClient._paginateListInstances = _paginate_list_instances
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.2)
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        self.assertEqual(self.sdClient.calls["ListInstances"], 2)
+
+    async def testRunShouldShortenTheIntervalOnRegistrationChurn(self):
+        engine = self.createEngine(frequency=0.05, minFrequency=0.05, maxFrequency=10)
+        engine.setServices(["srv-2"])
+
+        runTask = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.03)
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_interval_seconds", {"service_id": "srv-2"}), 0.1)
+
+        # A new instance is registered
+        self.sdClient.serviceInstances["srv-2"].append(("i-1", "172.0.0.1"))
+
+        for _ in range(100):
+            if prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_interval_seconds", {"service_id": "srv-2"}) == 0.05:
+                break
+            await asyncio.sleep(0.01)
+
+        engine.stop()
+        await asyncio.wait_for(runTask, timeout=5)
+
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_reconcile_interval_seconds", {"service_id": "srv-2"}), 0.05)
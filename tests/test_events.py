@@ -0,0 +1,98 @@
+import json
+import unittest
+import boto3
+from unittest.mock import MagicMock
+from botocore.stub import Stubber
+from cloudunmap.events import parseEC2StateChangeInstanceIds, EC2StateChangeConsumer
+
+QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/events"
+
+
+def mockStateChangeEvent(instanceId, state):
+    return json.dumps({
+        "source": "aws.ec2",
+        "detail-type": "EC2 Instance State-change Notification",
+        "detail": {"instance-id": instanceId, "state": state}})
+
+
+class TestEvents(unittest.TestCase):
+    def setUp(self):
+        self.sqsClient = boto3.client("sqs")
+        self.sqsStubber = Stubber(self.sqsClient)
+        self.sqsStubber.activate()
+
+    #
+    # parseEC2StateChangeInstanceIds()
+    #
+
+    def testParseEC2StateChangeInstanceIdsShouldReturnTerminatingInstances(self):
+        instanceIds = parseEC2StateChangeInstanceIds([
+            mockStateChangeEvent("i-1", "shutting-down"),
+            mockStateChangeEvent("i-2", "running"),
+            mockStateChangeEvent("i-3", "terminated"),
+            mockStateChangeEvent("i-1", "terminated"),
+            json.dumps({"Type": "Notification", "Message": mockStateChangeEvent("i-4", "terminated")}),
+            json.dumps({"detail-type": "AWS API Call via CloudTrail", "detail": {}}),
+            "not-a-json",
+        ])
+
+        self.assertEqual(instanceIds, ["i-1", "i-3", "i-4"])
+
+    def testParseEC2StateChangeInstanceIdsShouldSkipEventsWithMalformedDetail(self):
+        instanceIds = parseEC2StateChangeInstanceIds([
+            json.dumps({"detail-type": "EC2 Instance State-change Notification", "detail": None}),
+            json.dumps({"detail-type": "EC2 Instance State-change Notification", "detail": ["i-2"]}),
+            json.dumps({"detail-type": "EC2 Instance State-change Notification"}),
+            mockStateChangeEvent("i-1", "terminated"),
+        ])
+
+        self.assertEqual(instanceIds, ["i-1"])
+
+    #
+    # EC2StateChangeConsumer.poll()
+    #
+
+    def testPollShouldNotifyTerminatingInstancesAndDeleteMessages(self):
+        callback = MagicMock(return_value=True)
+
+        self.sqsStubber.add_response(
+            "receive_message",
+            {"Messages": [
+                {"Body": mockStateChangeEvent("i-1", "terminated"), "ReceiptHandle": "rh-1"},
+                {"Body": mockStateChangeEvent("i-2", "running"), "ReceiptHandle": "rh-2"}]},
+            {"QueueUrl": QUEUE_URL, "MaxNumberOfMessages": 10, "WaitTimeSeconds": 0})
+        self.sqsStubber.add_response(
+            "delete_message_batch",
+            {"Successful": [{"Id": "0"}, {"Id": "1"}], "Failed": []},
+            {"QueueUrl": QUEUE_URL, "Entries": [{"Id": "0", "ReceiptHandle": "rh-1"}, {"Id": "1", "ReceiptHandle": "rh-2"}]})
+
+        consumer = EC2StateChangeConsumer(QUEUE_URL, self.sqsClient, callback, waitTime=0)
+        self.assertEqual(consumer.poll(), 2)
+        callback.assert_called_once_with(["i-1"])
+
+        self.sqsStubber.assert_no_pending_responses()
+
+    def testPollShouldNotDeleteMessagesIfTheCallbackFails(self):
+        callback = MagicMock(return_value=False)
+
+        self.sqsStubber.add_response(
+            "receive_message",
+            {"Messages": [{"Body": mockStateChangeEvent("i-1", "terminated"), "ReceiptHandle": "rh-1"}]},
+            {"QueueUrl": QUEUE_URL, "MaxNumberOfMessages": 10, "WaitTimeSeconds": 0})
+
+        consumer = EC2StateChangeConsumer(QUEUE_URL, self.sqsClient, callback, waitTime=0)
+        self.assertEqual(consumer.poll(), 1)
+        callback.assert_called_once_with(["i-1"])
+
+        self.sqsStubber.assert_no_pending_responses()
+
+    def testPollShouldDoNothingOnNoMessages(self):
+        callback = MagicMock(return_value=True)
+
+        self.sqsStubber.add_response("receive_message", {}, {"QueueUrl": QUEUE_URL, "MaxNumberOfMessages": 10, "WaitTimeSeconds": 0})
+
+        consumer = EC2StateChangeConsumer(QUEUE_URL, self.sqsClient, callback, waitTime=0)
+        self.assertEqual(consumer.poll(), 0)
+        callback.assert_not_called()
+
+        self.sqsStubber.assert_no_pending_responses()
@@ -0,0 +1,51 @@
+import unittest
+import urllib.error
+import urllib.request
+from cloudunmap.exporter import PrometheusExporter
+from cloudunmap.metrics import ownedServicesMetric
+
+
+class TestExporter(unittest.TestCase):
+    def createExporter(self, enableReconcile: bool) -> PrometheusExporter:
+        exporter = PrometheusExporter("127.0.0.1", 0, enableReconcile)
+        exporter.start()
+        self.addCleanup(exporter.shutdown)
+
+        return exporter
+
+    def request(self, exporter: PrometheusExporter, path: str, method: str = "GET") -> int:
+        try:
+            with urllib.request.urlopen(urllib.request.Request(f"http://127.0.0.1:{exporter.port}{path}", method=method), timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    #
+    # PrometheusExporter
+    #
+
+    def testExporterShouldServeTheMetrics(self):
+        exporter = self.createExporter(False)
+        ownedServicesMetric.set(2)
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/metrics", timeout=5) as response:
+            self.assertIn(b"aws_cloud_unmap_owned_services 2.0", response.read())
+
+    def testExporterShouldTriggerAReconcileOnPostRequests(self):
+        exporter = self.createExporter(True)
+        triggers = []
+
+        # Triggers are refused until the engine is running
+        self.assertEqual(self.request(exporter, "/reconcile", "POST"), 503)
+
+        exporter.onReconcile = lambda: triggers.append(True)
+        self.assertEqual(self.request(exporter, "/reconcile", "GET"), 405)
+        self.assertEqual(self.request(exporter, "/reconcile", "POST"), 202)
+        self.assertEqual(self.request(exporter, "/metrics"), 200)
+        self.assertEqual(len(triggers), 1)
+
+    def testExporterShouldNotTriggerAReconcileIfDisabled(self):
+        exporter = self.createExporter(False)
+        exporter.onReconcile = self.fail
+
+        self.assertEqual(self.request(exporter, "/reconcile", "POST"), 200)
@@ -0,0 +1,78 @@
+import os
+import threading
+import unittest
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from cloudunmap.aws import listEC2InstancesById, listNamespaceServiceIds, listServiceInstances
+from cloudunmap.clients import AwsClientPool
+from cloudunmap.fakeaws import FakeAwsFleet, FakeAwsServer
+from cloudunmap.unmap import unmapTerminatedInstancesFromService
+
+
+class TestFakeAws(unittest.TestCase):
+    def setUp(self):
+        # Requests are signed, even if the fake endpoint doesn't check signatures
+        self.env = patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "fake", "AWS_SECRET_ACCESS_KEY": "fake"})
+        self.env.start()
+
+        self.fleet = FakeAwsFleet(250, ["eu-west-1", "us-east-1"], ["srv-1", "srv-2"], terminatedRatio=0.1)
+        self.server = self.startServer(self.fleet)
+        self.clientPool = AwsClientPool(endpointUrl=self.server.endpointUrl)
+
+    def tearDown(self):
+        self.env.stop()
+
+    def startServer(self, fleet: FakeAwsFleet, **kwargs) -> FakeAwsServer:
+        server = FakeAwsServer(("127.0.0.1", 0), fleet, **kwargs)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    #
+    # FakeAwsServer
+    #
+
+    def testServerShouldServeCloudMapPaginatedInstancesAndServices(self):
+        sdClient = self.clientPool.getClient("servicediscovery", "eu-west-1")
+
+        self.assertEqual(listNamespaceServiceIds("ns-1", sdClient), ["srv-1", "srv-2"])
+        self.assertEqual(len(listServiceInstances("srv-1", sdClient)), 125)
+
+    def testServerShouldServeEC2InstancesOfTheRequestRegionFilteredByIdAndState(self):
+        euClient = self.clientPool.getClient("ec2", "eu-west-1")
+        usClient = self.clientPool.getClient("ec2", "us-east-1")
+
+        # Instances are spread across regions, 1 every 10 is terminated
+        self.assertEqual([i["InstanceId"] for i in listEC2InstancesById(["i-00000000000000000", "i-00000000000000001"], euClient)], ["i-00000000000000000"])
+        self.assertEqual([i["InstanceId"] for i in listEC2InstancesById(["i-00000000000000000", "i-00000000000000001"], usClient)], ["i-00000000000000001"])
+        self.assertEqual(listEC2InstancesById(["i-00000000000000000"], euClient, states=["running"]), [])
+
+    def testServerShouldDeregisterInstancesThroughAsyncOperations(self):
+        sdClient = self.clientPool.getClient("servicediscovery", "eu-west-1")
+
+        operationId = sdClient.deregister_instance(ServiceId="srv-1", InstanceId="i-00000000000000000")["OperationId"]
+        self.assertEqual(sdClient.get_operation(OperationId=operationId)["Operation"]["Status"], "SUCCESS")
+        self.assertEqual(len(listServiceInstances("srv-1", sdClient)), 124)
+
+        with self.assertRaises(ClientError):
+            sdClient.deregister_instance(ServiceId="srv-1", InstanceId="i-00000000000000000")
+
+    def testServerShouldThrottleCallsAtTheConfiguredRate(self):
+        server = self.startServer(self.fleet, throttleRates={"ListInstances": 1})
+        sdClient = AwsClientPool(endpointUrl=server.endpointUrl).getClient("servicediscovery", "eu-west-1")
+
+        with self.assertRaises(ClientError) as context:
+            listServiceInstances("srv-1", sdClient)
+
+        self.assertEqual(context.exception.response["Error"]["Code"], "ThrottlingException")
+        self.assertEqual(listNamespaceServiceIds("ns-1", sdClient), ["srv-1", "srv-2"])
+
+    def testServerShouldServeAFullReconcile(self):
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1", "us-east-1"], clientPool=self.clientPool))
+
+        # Instances terminated (1 every 10, all registered to srv-1) have been deregistered
+        sdClient = self.clientPool.getClient("servicediscovery", "eu-west-1")
+        self.assertEqual(len(listServiceInstances("srv-1", sdClient)), 100)
@@ -0,0 +1,23 @@
+import unittest
+from cloudunmap.metrics import LazyMetric
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+
+
+class TestMetrics(unittest.TestCase):
+    #
+    # LazyMetric
+    #
+
+    def testLazyMetricShouldIgnoreCallsUntilEnabled(self):
+        metric = LazyMetric("Histogram", "aws_cloud_unmap_test_duration_seconds", "Test", labelnames=["service_id"])
+
+        metric.labels("srv-1").observe(1)
+        with metric.labels("srv-1").time():
+            pass
+
+        self.assertIsNone(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_test_duration_seconds_count", {"service_id": "srv-1"}))
+
+        metric.enable()
+        metric.labels("srv-1").observe(1)
+
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_test_duration_seconds_count", {"service_id": "srv-1"}), 1)
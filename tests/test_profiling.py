@@ -0,0 +1,85 @@
+import os
+import pstats
+import logging
+import tempfile
+import threading
+import unittest
+import boto3
+from botocore.stub import Stubber
+from cloudunmap.aws import listEC2InstancesById
+from cloudunmap.profiling import ProfileSpan, enableProfiling, profileCalls
+from cloudunmap.telemetry import instrumentClient
+from .mocks import mockEC2Instance
+
+
+def profiledThreadTarget():
+    pass
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        enableProfiling(True)
+        self.addCleanup(enableProfiling, False)
+
+        # Logs are disabled while running tests
+        logging.disable(logging.NOTSET)
+        self.addCleanup(logging.disable, logging.CRITICAL)
+
+    #
+    # ProfileSpan()
+    #
+
+    def testProfileSpanShouldLogTheElapsedTimeItemsAndPages(self):
+        ec2Client = instrumentClient(boto3.client("ec2", region_name="eu-west-1"))
+
+        # Batches are described concurrently, from executor threads
+        with Stubber(ec2Client) as stubber:
+            for instanceId in ["i-1", "i-2", "i-3"]:
+                stubber.add_response("describe_instances", {"Reservations": [{"Instances": [mockEC2Instance(instanceId)]}]})
+
+            with self.assertLogs(level="INFO") as logs:
+                with ProfileSpan("describe_ec2_instances", region="eu-west-1") as span:
+                    instances = listEC2InstancesById(["i-1", "i-2", "i-3"], ec2Client, batchSize=1, maxConcurrency=3)
+                    span.set(running=len(instances))
+
+        record = logs.records[0]
+        self.assertEqual(record.phase, "describe_ec2_instances")
+        self.assertEqual(record.region, "eu-west-1")
+        self.assertEqual(record.running, 3)
+        self.assertEqual(record.pages, 3)
+        self.assertFalse(record.failed)
+        self.assertGreaterEqual(record.elapsed_seconds, 0)
+
+    def testProfileSpanShouldNotLogWhenProfilingIsDisabled(self):
+        enableProfiling(False)
+
+        with self.assertNoLogs(level="INFO"):
+            with ProfileSpan("match", service_id="srv-1") as span:
+                span.set(unmatched=0)
+
+        self.assertIsNotNone(span.elapsedTime)
+
+    def testProfileSpanShouldTrackFailures(self):
+        with self.assertLogs(level="INFO") as logs:
+            with self.assertRaises(RuntimeError):
+                with ProfileSpan("match", service_id="srv-1"):
+                    raise RuntimeError("Failed")
+
+        self.assertTrue(logs.records[0].failed)
+
+    #
+    # profileCalls()
+    #
+
+    def testProfileCallsShouldDumpTheStatsOfAllThreads(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "reconcile.prof")
+
+        with profileCalls(path):
+            thread = threading.Thread(target=profiledThreadTarget)
+            thread.start()
+            thread.join()
+
+        functionNames = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn("profiledThreadTarget", functionNames)
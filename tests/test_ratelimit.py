@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from cloudunmap.aws import listServiceInstances
+from cloudunmap.clients import AwsClientPool
+from cloudunmap.fakeaws import FakeAwsFleet, FakeAwsServer
+from cloudunmap.ratelimit import RateLimiter, TokenBucket, parseOperationValues
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+
+
+class TestRateLimit(unittest.TestCase):
+    #
+    # parseOperationValues()
+    #
+
+    def testParseOperationValuesShouldSupportValuesForAllOrSpecificOperations(self):
+        self.assertEqual(parseOperationValues(["0.1", "DescribeInstances=0.5"]), {"*": 0.1, "DescribeInstances": 0.5})
+
+    #
+    # TokenBucket.acquire()
+    #
+
+    def testAcquireShouldNotWaitWithinTheBurst(self):
+        bucket = TokenBucket(rate=1, burst=3)
+
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0])
+
+    def testAcquireShouldWaitForTokensToBeRefilledAboveTheBurst(self):
+        bucket = TokenBucket(rate=50, burst=1)
+        startTime = time.monotonic()
+
+        for _ in range(6):
+            bucket.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - startTime, 0.09)
+
+    def testAcquireShouldServeConcurrentCallersAtTheConfiguredRate(self):
+        bucket = TokenBucket(rate=100, burst=1)
+        startTime = time.monotonic()
+
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreaterEqual(time.monotonic() - startTime, 0.09)
+
+    #
+    # RateLimiter.getBucket()
+    #
+
+    def testGetBucketShouldShareBucketsByOperationAndRegion(self):
+        limiter = RateLimiter({"*": 10, "DescribeInstances": 5})
+
+        self.assertIs(limiter.getBucket("DescribeInstances", "eu-west-1"), limiter.getBucket("DescribeInstances", "eu-west-1"))
+        self.assertIsNot(limiter.getBucket("DescribeInstances", "eu-west-1"), limiter.getBucket("DescribeInstances", "us-east-1"))
+        self.assertIsNot(limiter.getBucket("DescribeInstances", "eu-west-1"), limiter.getBucket("ListInstances", "eu-west-1"))
+
+    def testGetBucketShouldNotLimitOperationsWithoutRate(self):
+        limiter = RateLimiter({"DescribeInstances": 5})
+
+        self.assertIsNotNone(limiter.getBucket("DescribeInstances", "eu-west-1"))
+        self.assertIsNone(limiter.getBucket("ListInstances", "eu-west-1"))
+
+    #
+    # RateLimiter.attachClient()
+    #
+
+    def testAttachClientShouldRateLimitRequestsOfAllClients(self):
+        server = FakeAwsServer(("127.0.0.1", 0), FakeAwsFleet(500, ["eu-west-1"], ["srv-rl"]))
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        limiter = RateLimiter({"ListInstances": 50}, burst=1)
+
+        with patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "fake", "AWS_SECRET_ACCESS_KEY": "fake"}):
+            sdClients = [AwsClientPool(endpointUrl=server.endpointUrl, rateLimiter=limiter).getClient("servicediscovery", "eu-west-1") for _ in range(2)]
+
+            # 10 requests (5 pages for each client) at 50 requests/sec
+            startTime = time.monotonic()
+
+            for sdClient in sdClients:
+                self.assertEqual(len(listServiceInstances("srv-rl", sdClient)), 500)
+
+        self.assertGreaterEqual(time.monotonic() - startTime, 0.18)
+        self.assertGreater(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_aws_api_rate_limit_wait_seconds_total", {"operation": "ListInstances", "region": "eu-west-1"}), 0)
@@ -0,0 +1,96 @@
+import json
+import os
+import unittest
+import boto3
+from unittest.mock import patch
+from botocore.stub import Stubber
+from cloudunmap import serverless
+from cloudunmap.serverless import handler, parseEventInstanceIds, ReconcileError
+from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance, RUNNING_STATES_FILTER
+
+ARGS = "--service-id srv-1 --service-region eu-west-1 --instances-region eu-west-1"
+
+
+def mockStateChangeEvent(instanceId, state="terminated"):
+    return {"detail-type": "EC2 Instance State-change Notification", "source": "aws.ec2", "detail": {"instance-id": instanceId, "state": state}}
+
+
+class TestServerless(unittest.TestCase):
+    def setUp(self):
+        self.ec2Client = boto3.client("ec2", region_name="eu-west-1")
+        self.sdClient = boto3.client("servicediscovery", region_name="eu-west-1")
+
+        self.sdStubber = Stubber(self.sdClient)
+        self.sdStubber.activate()
+
+        self.ec2Stubber = Stubber(self.ec2Client)
+        self.ec2Stubber.activate()
+
+        self.botoClientMock = mockBotoClient({"ec2": self.ec2Client, "servicediscovery": self.sdClient})
+
+        # Each test starts from a cold invocation
+        patcher = patch.object(serverless, "_state", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mockReconcile(self, listedIds, describedIds, runningIds):
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance(instanceId, f"172.0.0.{index}") for index, instanceId in enumerate(listedIds)]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance(instanceId, privateIp=f"172.0.0.{listedIds.index(instanceId)}") for instanceId in runningIds]}]},
+            {"Filters": [{"Name": "instance-id", "Values": describedIds}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+    #
+    # handler()
+    #
+
+    def testHandlerShouldReuseClientsAcrossWarmInvocations(self):
+        self.mockReconcile(["i-1", "i-2"], ["i-1", "i-2"], ["i-1"])
+        self.sdStubber.add_response("deregister_instance", {}, {"ServiceId": "srv-1", "InstanceId": "i-2"})
+        self.mockReconcile(["i-1"], ["i-1"], ["i-1"])
+
+        with patch.dict(os.environ, {"AWS_CLOUD_UNMAP_ARGS": ARGS}), patch("boto3.client", side_effect=self.botoClientMock) as clientMock:
+            self.assertEqual(handler({}, None), {"success": True, "serviceIds": ["srv-1"], "instanceIds": None})
+            self.assertEqual(handler({}, None), {"success": True, "serviceIds": ["srv-1"], "instanceIds": None})
+
+            self.assertEqual(clientMock.call_count, 2)
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testHandlerShouldReconcileOnlyTheNotifiedInstances(self):
+        self.mockReconcile(["i-1", "i-2"], ["i-2"], [])
+        self.sdStubber.add_response("deregister_instance", {}, {"ServiceId": "srv-1", "InstanceId": "i-2"})
+
+        with patch.dict(os.environ, {"AWS_CLOUD_UNMAP_ARGS": ARGS}), patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertEqual(handler(mockStateChangeEvent("i-2"), None), {"success": True, "serviceIds": ["srv-1"], "instanceIds": ["i-2"]})
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testHandlerShouldFailOnSQSEventsNotReconciled(self):
+        self.sdStubber.add_client_error("list_instances")
+        event = {"Records": [{"eventSource": "aws:sqs", "body": json.dumps(mockStateChangeEvent("i-2"))}]}
+
+        with patch.dict(os.environ, {"AWS_CLOUD_UNMAP_ARGS": ARGS}), patch("boto3.client", side_effect=self.botoClientMock):
+            with self.assertRaises(ReconcileError):
+                handler(event, None)
+
+        self.sdStubber.assert_no_pending_responses()
+
+    def testHandlerShouldSkipEventsWithoutTerminatingInstances(self):
+        with patch.dict(os.environ, {"AWS_CLOUD_UNMAP_ARGS": ARGS}), patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertEqual(handler(mockStateChangeEvent("i-1", state="running"), None), {"success": True, "serviceIds": [], "instanceIds": []})
+
+    #
+    # parseEventInstanceIds()
+    #
+
+    def testParseEventInstanceIdsShouldSupportEventBridgeAndSQSEvents(self):
+        self.assertEqual(parseEventInstanceIds(mockStateChangeEvent("i-1")), ["i-1"])
+        self.assertEqual(parseEventInstanceIds({"Records": [{"eventSource": "aws:sqs", "body": json.dumps(mockStateChangeEvent(instanceId))} for instanceId in ["i-1", "i-2"]]}), ["i-1", "i-2"])
+        self.assertIsNone(parseEventInstanceIds({"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}))
+        self.assertIsNone(parseEventInstanceIds({}))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from cloudunmap.sharding import StaticSharding, FileLeaseSharding
+
+SERVICE_IDS = [f"srv-{index}" for index in range(10)]
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.leaseFile = os.path.join(directory.name, "leases.json")
+
+    #
+    # StaticSharding.getOwnedServiceIds()
+    #
+
+    def testStaticShardingShouldSplitServicesAmongShards(self):
+        shards = [StaticSharding(index, 3).getOwnedServiceIds(SERVICE_IDS) for index in range(3)]
+
+        self.assertEqual(sorted(sum(shards, [])), sorted(SERVICE_IDS))
+        self.assertTrue(all(shards))
+
+        # The split is deterministic
+        self.assertEqual(StaticSharding(1, 3).getOwnedServiceIds(SERVICE_IDS), shards[1])
+
+    def testStaticShardingShouldOwnAllServicesWithASingleShard(self):
+        self.assertEqual(StaticSharding().getOwnedServiceIds(SERVICE_IDS), SERVICE_IDS)
+
+    #
+    # FileLeaseSharding.getOwnedServiceIds()
+    #
+
+    def testFileLeaseShardingShouldSplitServicesAmongReplicas(self):
+        replicaA = FileLeaseSharding(self.leaseFile, "replica-a")
+        replicaB = FileLeaseSharding(self.leaseFile, "replica-b")
+
+        # The first replica owns all services, until the second one joins
+        self.assertEqual(replicaA.getOwnedServiceIds(SERVICE_IDS), SERVICE_IDS)
+        self.assertEqual(replicaB.getOwnedServiceIds(SERVICE_IDS), [])
+
+        # Then the first replica releases half of them, taken over by the second one
+        ownedA = replicaA.getOwnedServiceIds(SERVICE_IDS)
+        ownedB = replicaB.getOwnedServiceIds(SERVICE_IDS)
+
+        self.assertEqual(len(ownedA), 5)
+        self.assertEqual(sorted(ownedA + ownedB), sorted(SERVICE_IDS))
+
+        # The split is stable
+        self.assertEqual(replicaA.getOwnedServiceIds(SERVICE_IDS), ownedA)
+        self.assertEqual(replicaB.getOwnedServiceIds(SERVICE_IDS), ownedB)
+
+    def testFileLeaseShardingShouldTakeOverTheServicesOfAFailedReplica(self):
+        replicaA = FileLeaseSharding(self.leaseFile, "replica-a", ttl=30)
+        replicaB = FileLeaseSharding(self.leaseFile, "replica-b", ttl=30)
+
+        replicaA.getOwnedServiceIds(SERVICE_IDS)
+        replicaB.getOwnedServiceIds(SERVICE_IDS)
+        replicaA.getOwnedServiceIds(SERVICE_IDS)
+        self.assertEqual(len(replicaB.getOwnedServiceIds(SERVICE_IDS)), 5)
+
+        # The replica A stops renewing its leases, which expire
+        with patch("time.time", return_value=time.time() + 31):
+            self.assertEqual(replicaB.getOwnedServiceIds(SERVICE_IDS), SERVICE_IDS)
+
+    def testFileLeaseShardingShouldLetOtherReplicasTakeOverReleasedServices(self):
+        replicaA = FileLeaseSharding(self.leaseFile, "replica-a")
+        replicaB = FileLeaseSharding(self.leaseFile, "replica-b")
+
+        replicaA.getOwnedServiceIds(SERVICE_IDS)
+        replicaA.release()
+
+        self.assertEqual(replicaB.getOwnedServiceIds(SERVICE_IDS), SERVICE_IDS)
+
+    def testFileLeaseShardingShouldDropServicesNotExistingAnymore(self):
+        replicaA = FileLeaseSharding(self.leaseFile, "replica-a")
+
+        replicaA.getOwnedServiceIds(SERVICE_IDS)
+        self.assertEqual(replicaA.getOwnedServiceIds(SERVICE_IDS[:3]), SERVICE_IDS[:3])
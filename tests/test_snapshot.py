@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+import boto3
+from unittest.mock import patch
+from botocore.stub import Stubber
+from cloudunmap.clients import AwsClientPool
+from cloudunmap.snapshot import SnapshotRecorder, SnapshotReplayer, SnapshotError
+from cloudunmap.unmap import unmapTerminatedInstancesFromService
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance, RUNNING_STATES_FILTER
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshotPath = os.path.join(directory.name, "snapshot.jsonl.gz")
+
+    def recordSnapshot(self):
+        recorder = SnapshotRecorder(self.snapshotPath)
+        sdClient = boto3.client("servicediscovery", region_name="eu-west-1")
+        ec2Client = boto3.client("ec2", region_name="eu-west-1")
+
+        with Stubber(sdClient) as sdStubber, Stubber(ec2Client) as ec2Stubber:
+            sdStubber.add_response(
+                "list_instances",
+                {"Instances": [mockServiceInstance("i-1", "172.0.0.1")], "NextToken": "page-2"},
+                {"ServiceId": "srv-1", "MaxResults": 100})
+            sdStubber.add_response(
+                "list_instances",
+                {"Instances": [mockServiceInstance("i-2", "172.0.0.2")]},
+                {"ServiceId": "srv-1", "MaxResults": 100, "NextToken": "page-2"})
+            ec2Stubber.add_response(
+                "describe_instances",
+                {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+                {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+            sdStubber.add_response(
+                "deregister_instance",
+                {"OperationId": "op-1"},
+                {"ServiceId": "srv-1", "InstanceId": "i-2"})
+            sdStubber.add_response(
+                "get_operation",
+                {"Operation": {"Id": "op-1", "Status": "SUCCESS"}},
+                {"OperationId": "op-1"})
+
+            with patch("boto3.client", side_effect=mockBotoClient({"ec2": ec2Client, "servicediscovery": sdClient})):
+                self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1"], clientPool=AwsClientPool(snapshot=recorder)))
+
+        recorder.close()
+
+    #
+    # SnapshotRecorder.attachClient()
+    #
+
+    def testRecorderShouldRecordTheReadOperationsOnly(self):
+        self.recordSnapshot()
+
+        replayer = SnapshotReplayer(self.snapshotPath)
+
+        self.assertEqual(replayer.serviceIds, ["srv-1"])
+        self.assertEqual(replayer.serviceRegion, "eu-west-1")
+        self.assertEqual(replayer.instancesRegions, ["eu-west-1"])
+        self.assertEqual(len(replayer._responses), 3)
+
+    #
+    # SnapshotReplayer.attachClient()
+    #
+
+    def testReplayerShouldReconcileAgainstTheSnapshot(self):
+        self.recordSnapshot()
+
+        clientPool = AwsClientPool(snapshot=SnapshotReplayer(self.snapshotPath))
+        deregisteredCount = prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}) or 0
+
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1"], clientPool=clientPool))
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}), deregisteredCount + 1)
+
+        # Deregistrations have no effect, so the snapshot can be replayed again
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1"], clientPool=clientPool))
+        self.assertEqual(prometheusDefaultRegistry.get_sample_value("aws_cloud_unmap_deregistered_instances_total", labels={"service_id": "srv-1"}), deregisteredCount + 2)
+
+    def testReplayerShouldFailOnCallsNotRecorded(self):
+        self.recordSnapshot()
+
+        replayer = SnapshotReplayer(self.snapshotPath)
+        ec2Client = replayer.attachClient(boto3.client("ec2", region_name="us-east-1"))
+
+        with self.assertRaises(SnapshotError):
+            ec2Client.describe_instances(Filters=[{"Name": "instance-id", "Values": ["i-1"]}], MaxResults=1000)
+
+    def testReplayerShouldNotAssumeRolesOfAccountTargets(self):
+        recorder = SnapshotRecorder(self.snapshotPath)
+        recorder.record("servicediscovery", "eu-west-1", "ListInstances", {"ServiceId": "srv-1", "MaxResults": 100}, {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "172.0.0.2")]})
+        recorder.record(
+            "ec2", "123456789012:eu-west-1", "DescribeInstances",
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000},
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]})
+        recorder.close()
+
+        replayer = SnapshotReplayer(self.snapshotPath)
+        clientPool = AwsClientPool(snapshot=replayer, assumeRoleName="cloud-unmap", stsRegion="eu-west-1")
+        self.assertEqual(replayer.instancesRegions, ["123456789012:eu-west-1"])
+
+        with patch("cloudunmap.credentials.AssumeRoleCredentialsCache._assumeRole", side_effect=AssertionError("Role assumed")) as assumeRoleMock:
+            self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["123456789012:eu-west-1"], clientPool=clientPool))
+            assumeRoleMock.assert_not_called()
@@ -0,0 +1,62 @@
+import unittest
+import boto3
+from unittest.mock import MagicMock
+from botocore.stub import Stubber
+from cloudunmap.telemetry import instrumentClient
+from prometheus_client.registry import REGISTRY as prometheusDefaultRegistry
+
+
+def getSampleValue(name, operation, region="eu-west-3"):
+    return prometheusDefaultRegistry.get_sample_value(name, labels={"operation": operation, "region": region}) or 0
+
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.sdClient = instrumentClient(boto3.client("servicediscovery", region_name="eu-west-3"))
+
+        self.sdStubber = Stubber(self.sdClient)
+        self.sdStubber.activate()
+
+    #
+    # instrumentClient()
+    #
+
+    def testInstrumentClientShouldTrackApiCalls(self):
+        callsCount = getSampleValue("aws_cloud_unmap_aws_api_calls_total", "GetOperation")
+        durationsCount = getSampleValue("aws_cloud_unmap_aws_api_call_duration_seconds_count", "GetOperation")
+        errorsCount = getSampleValue("aws_cloud_unmap_aws_api_errors_total", "GetOperation")
+
+        self.sdStubber.add_response("get_operation", {"Operation": {"Id": "op-1", "Status": "SUCCESS"}, "ResponseMetadata": {"RetryAttempts": 0}})
+        self.sdClient.get_operation(OperationId="op-1")
+
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_calls_total", "GetOperation"), callsCount + 1)
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_call_duration_seconds_count", "GetOperation"), durationsCount + 1)
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_errors_total", "GetOperation"), errorsCount)
+
+    def testInstrumentClientShouldTrackRetriesAndErrors(self):
+        callsCount = getSampleValue("aws_cloud_unmap_aws_api_calls_total", "ListInstances")
+        retriesCount = getSampleValue("aws_cloud_unmap_aws_api_retries_total", "ListInstances")
+        errorsCount = getSampleValue("aws_cloud_unmap_aws_api_errors_total", "ListInstances")
+
+        self.sdStubber.add_response("list_instances", {"Instances": [], "ResponseMetadata": {"RetryAttempts": 2}})
+        self.sdStubber.add_client_error("list_instances", service_error_code="ThrottlingException", http_status_code=400)
+        self.sdClient.list_instances(ServiceId="srv-1")
+
+        with self.assertRaises(Exception):
+            self.sdClient.list_instances(ServiceId="srv-1")
+
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_calls_total", "ListInstances"), callsCount + 2)
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_retries_total", "ListInstances"), retriesCount + 2)
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_errors_total", "ListInstances"), errorsCount + 1)
+
+    def testInstrumentClientShouldTrackThrottledAttempts(self):
+        throttlesCount = getSampleValue("aws_cloud_unmap_aws_api_throttles_total", "ListInstances")
+
+        # Attempts are notified by the endpoint, which is bypassed by the Stubber
+        for code in ["ThrottlingException", "InvalidInput"]:
+            self.sdClient.meta.events.emit(
+                "needs-retry.servicediscovery.ListInstances",
+                response=(MagicMock(status_code=400, headers={}), {"Error": {"Code": code}}),
+                endpoint=None, operation=None, attempts=5, caught_exception=None, request_dict={"context": {}})
+
+        self.assertEqual(getSampleValue("aws_cloud_unmap_aws_api_throttles_total", "ListInstances"), throttlesCount + 1)
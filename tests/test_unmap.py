@@ -2,8 +2,10 @@ import unittest
 import boto3
 from unittest.mock import patch
 from botocore.stub import Stubber
-from cloudunmap.unmap import matchServiceInstanceInRunningInstances, unmapTerminatedInstancesFromService
-from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance
+from cloudunmap.aws import ServiceInstance, EC2Instance
+from cloudunmap.cache import EC2InstanceCache, EC2InstanceRegions
+from cloudunmap.unmap import indexRunningInstances, matchServiceInstanceInIndex, matchServiceInstanceInRunningInstances, unmapTerminatedInstancesFromService, unmapTerminatedInstancesFromServices
+from .mocks import mockBotoClient, mockServiceInstance, mockEC2Instance, RUNNING_STATES_FILTER, MockClientPool, MockEC2Client, MockServiceDiscoveryClient
 
 
 class TestUnmap(unittest.TestCase):
@@ -47,6 +49,62 @@ class TestUnmap(unittest.TestCase):
         self.assertTrue(matchServiceInstanceInRunningInstances(
             {"Id": "i-2", "Attributes": {"AWS_INSTANCE_IPV4": "2.2.2.2"}}, runningInstances))
 
+        self.assertTrue(matchServiceInstanceInRunningInstances(
+            {"Id": "i-3", "Attributes": {"AWS_INSTANCE_IPV4": "172.0.1.3"}}, [mockEC2Instance("i-3", privateIp="172.0.0.3", eniPrivateIps=["172.0.0.3", "172.0.1.3"])]))
+
+    def testMatchServiceInstanceInRunningInstancesShouldSupportCompactRecords(self):
+        runningInstances = [EC2Instance("i-1", "running", ["172.0.0.1"]), EC2Instance("i-2", "running", ["172.0.0.2", "2.2.2.2"])]
+
+        self.assertFalse(matchServiceInstanceInRunningInstances(ServiceInstance("i-1", "172.0.0.1"), []))
+        self.assertTrue(matchServiceInstanceInRunningInstances(ServiceInstance("i-1", "172.0.0.1"), runningInstances))
+        self.assertFalse(matchServiceInstanceInRunningInstances(ServiceInstance("i-x", "172.0.0.1"), runningInstances))
+        self.assertFalse(matchServiceInstanceInRunningInstances(ServiceInstance("i-1", "172.0.0.2"), runningInstances))
+        self.assertTrue(matchServiceInstanceInRunningInstances(ServiceInstance("i-2", "2.2.2.2"), runningInstances))
+
+    #
+    # indexRunningInstances()
+    #
+
+    def testIndexRunningInstancesShouldMapInstanceIdsToAllKnownIps(self):
+        index = indexRunningInstances([
+            mockEC2Instance("i-1", privateIp="172.0.0.1"),
+            mockEC2Instance("i-2", privateIp="172.0.0.2", publicIp="2.2.2.2", eniPrivateIps=["172.0.0.2", "172.0.1.2"]),
+            mockEC2Instance("i-3"),
+        ])
+
+        self.assertEqual(index, {
+            "i-1": {"172.0.0.1"},
+            "i-2": {"172.0.0.2", "2.2.2.2", "172.0.1.2"},
+            "i-3": set(),
+        })
+
+    def testIndexRunningInstancesShouldSupportCompactRecords(self):
+        index = indexRunningInstances([EC2Instance("i-1", "running", ["172.0.0.1"]), EC2Instance("i-2", "stopped", ["172.0.0.2", "2.2.2.2"])])
+
+        self.assertEqual(index, {"i-1": {"172.0.0.1"}, "i-2": {"172.0.0.2", "2.2.2.2"}})
+
+    #
+    # matchServiceInstanceInIndex()
+    #
+
+    def testMatchServiceInstanceInIndex(self):
+        index = {"i-1": {"172.0.0.1"}, "i-2": {"172.0.0.2", "2.2.2.2"}}
+
+        self.assertFalse(matchServiceInstanceInIndex(mockServiceInstance("i-1", "172.0.0.1"), {}))
+        self.assertTrue(matchServiceInstanceInIndex(mockServiceInstance("i-1", "172.0.0.1"), index))
+        self.assertFalse(matchServiceInstanceInIndex(mockServiceInstance("i-x", "172.0.0.1"), index))
+        self.assertFalse(matchServiceInstanceInIndex(mockServiceInstance("i-1", "172.0.0.2"), index))
+        self.assertTrue(matchServiceInstanceInIndex(mockServiceInstance("i-2", "2.2.2.2"), index))
+
+    def testMatchServiceInstanceInIndexShouldSupportCompactRecords(self):
+        index = {"i-1": {"172.0.0.1"}, "i-2": {"172.0.0.2", "2.2.2.2"}}
+
+        self.assertFalse(matchServiceInstanceInIndex(ServiceInstance("i-1", "172.0.0.1"), {}))
+        self.assertTrue(matchServiceInstanceInIndex(ServiceInstance("i-1", "172.0.0.1"), index))
+        self.assertFalse(matchServiceInstanceInIndex(ServiceInstance("i-x", "172.0.0.1"), index))
+        self.assertFalse(matchServiceInstanceInIndex(ServiceInstance("i-1", "172.0.0.2"), index))
+        self.assertTrue(matchServiceInstanceInIndex(ServiceInstance("i-2", "2.2.2.2"), index))
+
     #
     # unmapTerminatedInstancesFromService()
     #
@@ -65,7 +123,7 @@ class TestUnmap(unittest.TestCase):
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
                 mockEC2Instance("i-2", privateIp="172.0.0.2", publicIp="2.2.2.2"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -90,7 +148,7 @@ class TestUnmap(unittest.TestCase):
             {"Reservations": [{"Instances": [
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -116,7 +174,7 @@ class TestUnmap(unittest.TestCase):
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
                 mockEC2Instance("i-2", publicIp="1.1.1.1"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -142,7 +200,7 @@ class TestUnmap(unittest.TestCase):
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
                 mockEC2Instance("i-2", privateIp="172.0.0.2", publicIp="2.2.2.2", state="shutting-down"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -168,7 +226,7 @@ class TestUnmap(unittest.TestCase):
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
                 mockEC2Instance("i-2", privateIp="172.0.0.2", publicIp="2.2.2.2", state="terminated"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -189,7 +247,7 @@ class TestUnmap(unittest.TestCase):
             {"Reservations": [{"Instances": [
                 mockEC2Instance("i-1", privateIp="172.0.0.1"),
             ]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -208,7 +266,7 @@ class TestUnmap(unittest.TestCase):
         self.ec2Stubber.add_response(
             "describe_instances",
             {"Reservations": []},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
@@ -231,14 +289,268 @@ class TestUnmap(unittest.TestCase):
         self.ec2Stubber.add_response(
             "describe_instances",
             {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2", "i-3"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2", "i-3"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
         self.ec2Stubber.add_response(
             "describe_instances",
             {"Reservations": [{"Instances": [mockEC2Instance("i-2", publicIp="2.2.2.2")]}]},
-            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2", "i-3"]}], "MaxResults": 1000})
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2", "i-3"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
 
         with patch("boto3.client", side_effect=self.botoClientMock):
             unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1", "us-east-1"])
 
         self.ec2Stubber.assert_no_pending_responses()
         self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldFailIfAnyInstancesRegionFails(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+        self.ec2Stubber.add_client_error("describe_instances")
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            with self.assertRaises(Exception):
+                unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1", "us-east-1"], maxConcurrency=1)
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldWaitForDeregistrationOperations(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {"OperationId": "op-1"},
+            {"ServiceId": "srv-1", "InstanceId": "i-2"})
+        self.sdStubber.add_response(
+            "get_operation",
+            {"Operation": {"Id": "op-1", "Status": "SUCCESS"}},
+            {"OperationId": "op-1"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertTrue(unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"]))
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldFailIfADeregistrationOperationFails(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {"OperationId": "op-1"},
+            {"ServiceId": "srv-1", "InstanceId": "i-2"})
+        self.sdStubber.add_response(
+            "get_operation",
+            {"Operation": {"Id": "op-1", "Status": "FAIL"}},
+            {"OperationId": "op-1"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertFalse(unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"]))
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldCheckOnlyTheInputInstanceIds(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2"), mockServiceInstance("i-3", "3.3.3.3")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-1", "InstanceId": "i-2"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": []},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertTrue(unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"], instanceIds=["i-2", "i-4"]))
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldDescribeOnlyInstancesNotCached(self):
+        instanceCache = EC2InstanceCache(ttl=60)
+        instanceCache.startCycle()
+        instanceCache.put({"i-1": {"172.0.0.1"}})
+
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2"), mockServiceInstance("i-3", "3.3.3.3")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-1", "InstanceId": "i-3"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-2", publicIp="2.2.2.2")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-2", "i-3"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertTrue(unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"], instanceCache=instanceCache))
+
+        # Running instances have been cached
+        self.assertEqual(instanceCache.get(["i-1", "i-2", "i-3"])[1], ["i-3"])
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldAlwaysDescribeTheInputInstanceIds(self):
+        instanceCache = EC2InstanceCache(ttl=60)
+        instanceCache.put({"i-1": {"172.0.0.1"}, "i-2": {"2.2.2.2"}})
+
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-1", "InstanceId": "i-2"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-2", publicIp="2.2.2.2", state="terminated")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-2"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            self.assertTrue(unmapTerminatedInstancesFromService(serviceId="srv-1", serviceRegion="eu-west-1", instancesRegions=["eu-west-1"], instanceIds=["i-2"], instanceCache=instanceCache))
+
+        self.assertEqual(instanceCache.get(["i-1", "i-2"])[1], ["i-2"])
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServiceShouldDescribeKnownInstancesOnlyInTheirRegion(self):
+        instanceRegions = EC2InstanceRegions()
+        sdClient = MockServiceDiscoveryClient([("i-1", "172.0.0.1"), ("i-2", "172.0.0.2")])
+        euClient = MockEC2Client({"i-1": ("172.0.0.1", None, "running")})
+        usClient = MockEC2Client({"i-2": ("172.0.0.2", None, "running")})
+        clientPool = MockClientPool({("servicediscovery", "eu-west-1"): sdClient, ("ec2", "eu-west-1"): euClient, ("ec2", "us-east-1"): usClient})
+
+        # The first reconcile learns the region of each instance
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1", "us-east-1"], clientPool=clientPool, instanceRegions=instanceRegions))
+        self.assertEqual(euClient.describedIds, {"i-1": 1, "i-2": 1})
+        self.assertEqual(usClient.describedIds, {"i-1": 1, "i-2": 1})
+        self.assertEqual(instanceRegions.get("i-1"), "eu-west-1")
+        self.assertEqual(instanceRegions.get("i-2"), "us-east-1")
+
+        # The next ones describe each instance only in its region
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1", "us-east-1"], clientPool=clientPool, instanceRegions=instanceRegions))
+        self.assertEqual(euClient.describedIds, {"i-1": 2, "i-2": 1})
+        self.assertEqual(usClient.describedIds, {"i-1": 1, "i-2": 2})
+
+    def testUnmapTerminatedInstancesFromServiceShouldDescribeInAllRegionsInstancesNotFoundInTheirRegion(self):
+        instanceRegions = EC2InstanceRegions()
+        instanceRegions.put({"i-1": "eu-west-1", "i-2": "eu-west-1"})
+        sdClient = MockServiceDiscoveryClient([("i-1", "172.0.0.1"), ("i-2", "172.0.0.2")])
+        euClient = MockEC2Client({"i-1": ("172.0.0.1", None, "running")})
+        usClient = MockEC2Client({})
+        clientPool = MockClientPool({("servicediscovery", "eu-west-1"): sdClient, ("ec2", "eu-west-1"): euClient, ("ec2", "us-east-1"): usClient})
+
+        self.assertTrue(unmapTerminatedInstancesFromService("srv-1", "eu-west-1", ["eu-west-1", "us-east-1"], clientPool=clientPool, instanceRegions=instanceRegions))
+        self.assertEqual(euClient.describedIds, {"i-1": 1, "i-2": 1})
+        self.assertEqual(usClient.describedIds, {"i-2": 1})
+        self.assertEqual(sdClient.calls["DeregisterInstance"], 1)
+
+        # The region of instances not running anymore is forgotten
+        self.assertIsNone(instanceRegions.get("i-2"))
+
+    #
+    # unmapTerminatedInstancesFromServices()
+    #
+
+    def testUnmapTerminatedInstancesFromServicesShouldDescribeInstancesOfAllServicesOnce(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-3", "3.3.3.3")]},
+            {"ServiceId": "srv-2", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-2", "InstanceId": "i-3"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1"), mockEC2Instance("i-2", publicIp="2.2.2.2")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2", "i-3"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            results = unmapTerminatedInstancesFromServices(serviceIds=["srv-1", "srv-2"], serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
+
+        self.assertEqual(results, {"srv-1": True, "srv-2": True})
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()
+
+    def testUnmapTerminatedInstancesFromServicesShouldApplyTheCircuitBreakerToEachService(self):
+        # Mock Cloud Map client
+        self.sdStubber.add_client_error("list_instances", expected_params={"ServiceId": "srv-1", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-2", "2.2.2.2")]},
+            {"ServiceId": "srv-2", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "list_instances",
+            {"Instances": [mockServiceInstance("i-1", "172.0.0.1"), mockServiceInstance("i-3", "3.3.3.3")]},
+            {"ServiceId": "srv-3", "MaxResults": 100})
+        self.sdStubber.add_response(
+            "deregister_instance",
+            {},
+            {"ServiceId": "srv-3", "InstanceId": "i-3"})
+
+        # Mock EC2 client
+        self.ec2Stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [mockEC2Instance("i-1", privateIp="172.0.0.1")]}]},
+            {"Filters": [{"Name": "instance-id", "Values": ["i-2", "i-1", "i-3"]}, RUNNING_STATES_FILTER], "MaxResults": 1000})
+
+        with patch("boto3.client", side_effect=self.botoClientMock):
+            results = unmapTerminatedInstancesFromServices(serviceIds=["srv-1", "srv-2", "srv-3"], serviceRegion="eu-west-1", instancesRegions=["eu-west-1"])
+
+        self.assertEqual(results, {"srv-1": False, "srv-2": False, "srv-3": True})
+
+        self.ec2Stubber.assert_no_pending_responses()
+        self.sdStubber.assert_no_pending_responses()